@@ -0,0 +1,68 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Export the RealESRGAN models of ``inference.py`` to OpenVINO IR.
+
+The IR takes a static ``(batch_size, 3, tile + 2 * tile_pad, tile + 2 * tile_pad)``
+input, the tile batches of ``RealESRGANer.enhance_batch``, so the device
+compiles it once instead of for every frame size:
+
+    python3 RealESRGan/export_openvino.py --model RealESRGAN_x4plus_anime_6B --int8
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+
+import openvino as ov
+import torch
+
+from RealESRGan.inference import get_model_path, get_models, get_openvino_path
+from RealESRGan.realesrgan import RealESRGANer
+
+
+def export_model(model_name, output_path, tile=64, tile_pad=10, batch_size=16, compress=False):
+    """Convert a model of the ``initialize()`` table to an IR with static tile shapes.
+
+    Args:
+        compress (bool): Compress the weights to int8 with NNCF.
+    """
+    model = get_models()[model_name]
+    upsampler = RealESRGANer(scale=model["netscale"], model_path=get_model_path(model, model_name),
+                             model=model["model"], tile=0, tile_pad=tile_pad, pre_pad=0, half=False, device="cpu")
+
+    size = tile + 2 * tile_pad
+    input_shape = [batch_size, 3, size, size]
+    print(f"Converting {model_name} with input shape {input_shape}...")
+    with torch.no_grad():
+        ov_model = ov.convert_model(upsampler.model, example_input=torch.rand(input_shape), input=[input_shape])
+
+    if compress:
+        try:
+            import nncf
+        except ImportError as error:
+            raise ImportError("int8 weight compression requires NNCF: pip install nncf") from error
+        print("Compressing weights to int8...")
+        ov_model = nncf.compress_weights(ov_model)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    ov.save_model(ov_model, output_path)
+    print(f"Model saved to {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', nargs='+', default=list(get_models()), help='Models to export. Default: all')
+    parser.add_argument('--tile', type=int, default=64)
+    parser.add_argument('--tile_pad', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--int8', action='store_true', help='Compress the weights to int8 with NNCF')
+    args = parser.parse_args()
+
+    for model_name in args.model:
+        export_model(model_name, get_openvino_path(model_name, args.tile, args.tile_pad, args.batch_size, args.int8),
+                     tile=args.tile, tile_pad=args.tile_pad, batch_size=args.batch_size, compress=args.int8)
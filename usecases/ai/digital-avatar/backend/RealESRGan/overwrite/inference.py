@@ -5,12 +5,15 @@ import os
 
 from basicsr.archs.rrdbnet_arch import RRDBNet
 from basicsr.utils.download_util import load_file_from_url
-from RealESRGan.realesrgan import RealESRGANer
+from RealESRGan.realesrgan import OVRealESRGANer, RealESRGANer
 from RealESRGan.realesrgan.archs.srvgg_arch import SRVGGNetCompact
 
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ENHANCER_BACKENDS = ["torch", "openvino"]
 
-def initialize(model_name="RealESRGAN_x2plus", device="cpu"):
-    models = {
+
+def get_models():
+    return {
         "RealESRGAN_x2plus": {
             "url": ["https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth"],
             "name": "RealESRGAN_x2plus",
@@ -55,18 +58,56 @@ def initialize(model_name="RealESRGAN_x2plus", device="cpu"):
             "netscale": 4
         }
     }
-    
-    if model_name not in models:
-        raise ValueError(f"Model name {model_name} not found")
 
-    model = models[model_name]
 
+def get_model_path(model, model_name):
     model_path = os.path.join('weights', model_name + '.pth')
     if not os.path.isfile(model_path):
-        ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
         # model_path will be updated
         model_path = load_file_from_url(
             url=model["url"][0], model_dir=os.path.join(ROOT_DIR, 'weights'), progress=True, file_name=None)
+    return model_path
+
+
+def get_openvino_path(model_name, tile=64, tile_pad=10, batch_size=16, compress=False):
+    suffix = "_int8" if compress else ""
+    return os.path.join(ROOT_DIR, 'weights', 'openvino', f"{model_name}_t{tile}_p{tile_pad}_b{batch_size}{suffix}.xml")
+
+
+def to_openvino_device(device):
+    """Map a torch device string (cpu, xpu:0) to the OpenVINO device name (CPU, GPU.0)."""
+    if device.lower().startswith("cpu"):
+        return "CPU"
+    if device.lower().startswith("xpu"):
+        return "GPU." + device.split(":")[1] if ":" in device else "GPU"
+    return device.upper()
+
+
+def initialize(model_name="RealESRGAN_x2plus", device="cpu", backend="torch", compress=False):
+    """Create the upsampler of a model.
+
+    Args:
+        backend (str): ``torch`` runs the PyTorch weights, ``openvino`` runs an
+            IR with static tile shapes and exports it on first use.
+        compress (bool): Use the NNCF int8 weight compressed IR of the ``openvino`` backend.
+    """
+    models = get_models()
+    if model_name not in models:
+        raise ValueError(f"Model name {model_name} not found")
+    if backend not in ENHANCER_BACKENDS:
+        raise ValueError(f"Unsupported enhancer backend: {backend}. Expected one of {ENHANCER_BACKENDS}")
+
+    model = models[model_name]
+
+    if backend == "openvino":
+        ir_path = get_openvino_path(model_name, compress=compress)
+        if not os.path.isfile(ir_path):
+            from RealESRGan.export_openvino import export_model
+            export_model(model_name, ir_path, compress=compress)
+        return OVRealESRGANer(scale=model["netscale"], model_path=ir_path, tile_pad=10, pre_pad=0,
+                              device=to_openvino_device(device))
+
+    model_path = get_model_path(model, model_name)
 
     # use dni to control the denoise strength
     dni_weight = None
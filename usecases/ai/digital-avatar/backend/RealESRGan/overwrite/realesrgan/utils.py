@@ -1,6 +1,7 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
+import contextlib
 import cv2
 import math
 import numpy as np
@@ -27,6 +28,8 @@ class RealESRGANer():
         tile_pad (int): The pad size for each tile, to remove border artifacts. Default: 10.
         pre_pad (int): Pad the input images to avoid border artifacts. Default: 10.
         half (float): Whether to use half precision during inference. Default: False.
+        batch_tile (int): Tile size used by ``enhance_batch``. Default: 64.
+        tile_batch_size (int): Number of tiles per forward pass in ``enhance_batch``. Default: 16.
     """
 
     def __init__(self,
@@ -39,8 +42,12 @@ class RealESRGANer():
                  pre_pad=10,
                  half=False,
                  device=None,
-                 gpu_id=None):
+                 gpu_id=None,
+                 batch_tile=64,
+                 tile_batch_size=16):
         self.scale = scale
+        self.batch_tile = batch_tile
+        self.tile_batch_size = tile_batch_size
         self.tile_size = tile
         self.tile_pad = tile_pad
         self.pre_pad = pre_pad
@@ -269,29 +276,241 @@ class RealESRGANer():
         return output, img_mode
 
 
+    @torch.no_grad()
+    def _run_model(self, tiles):
+        """Upscale a batch of RGB tiles, NCHW float32 in [0, 1], and return them as numpy."""
+        tiles = torch.from_numpy(tiles).to(self.device)
+        if self.half:
+            tiles = tiles.half()
+        return self.model(tiles).float().cpu().numpy()
+
+    def upscale_tiles(self, imgs):
+        """Upscale RGB float32 HWC images in [0, 1] through fixed-size tiles.
+
+        Every image is reflect-padded by ``tile_pad`` and cut into tiles of
+        ``batch_tile`` pixels plus the padding, so the tiles of all images share
+        one shape and go through the model ``tile_batch_size`` at a time
+        instead of one forward pass per tile.
+        """
+        tile, pad = self.batch_tile, self.tile_pad
+        shapes, tiles, origins = [], [], []
+        for img in imgs:
+            h, w = img.shape[:2]
+            rows, cols = math.ceil(h / tile), math.ceil(w / tile)
+            img = np.pad(img, ((pad, rows * tile - h + pad), (pad, cols * tile - w + pad), (0, 0)), mode='reflect')
+            shapes.append((h, w, rows, cols))
+            for y in range(rows):
+                for x in range(cols):
+                    tiles.append(img[y * tile:(y + 1) * tile + 2 * pad, x * tile:(x + 1) * tile + 2 * pad])
+                    origins.append((len(shapes) - 1, y, x))
+
+        outputs = [np.zeros((rows * tile * self.scale, cols * tile * self.scale, 3), dtype=np.float32)
+                   for _, _, rows, cols in shapes]
+        out_tile, out_pad = tile * self.scale, pad * self.scale
+        for start in range(0, len(tiles), self.tile_batch_size):
+            batch = np.ascontiguousarray(np.stack(tiles[start:start + self.tile_batch_size]).transpose(0, 3, 1, 2))
+            upscaled = self._run_model(batch).transpose(0, 2, 3, 1)
+            for (index, y, x), output_tile in zip(origins[start:start + self.tile_batch_size], upscaled):
+                outputs[index][y * out_tile:(y + 1) * out_tile, x * out_tile:(x + 1) * out_tile] = \
+                    output_tile[out_pad:out_pad + out_tile, out_pad:out_pad + out_tile]
+
+        return [output[:h * self.scale, :w * self.scale] for (h, w, _, _), output in zip(shapes, outputs)]
+
+    def enhance_batch(self, imgs, outscale=None):
+        """Upscale several BGR uint8 images with batched forward passes over their tiles.
+
+        Args:
+            imgs (list[np.ndarray]): BGR uint8 images of any size.
+            outscale (float): Final scale of the outputs. Default: the network scale.
+
+        Returns:
+            list[np.ndarray]: The upscaled BGR uint8 images.
+        """
+        rgb = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB).astype(np.float32) / 255. for img in imgs]
+        results = []
+        for img, output in zip(imgs, self.upscale_tiles(rgb)):
+            h, w = img.shape[:2]
+            output = (np.clip(output, 0, 1) * 255.0).round().astype(np.uint8)
+            output = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
+            if outscale is not None and outscale != float(self.scale):
+                output = cv2.resize(output, (int(w * outscale), int(h * outscale)), interpolation=cv2.INTER_LANCZOS4)
+            results.append(output)
+        return results
+
+    def enhance_video(self, frames, write=None, save_paths=None, batch_size=4, outscale=None,
+                      num_prefetch_queue=16, num_writers=1, lock=None):
+        """Upscale a stream of frames with decoding, batched inference and writing overlapped.
+
+        A ``PrefetchReader`` pulls the frames ahead of the model, every
+        ``batch_size`` frames go through one ``enhance_batch`` call and the
+        results are handed to ``IOConsumer`` threads.
+
+        Args:
+            frames (Iterable[np.ndarray | str]): BGR uint8 frames, e.g. a generator, or image paths.
+            write (callable): Called with every upscaled frame. The frames arrive in order
+                only with a single writer, which is what a video encoder needs.
+            save_paths (Iterable[str]): Alternatively, the image path of every frame, written
+                by ``num_writers`` consumers in parallel.
+            batch_size (int): Frames per model call.
+            outscale (float): Final scale of the outputs. Default: the network scale.
+            num_prefetch_queue (int): Frames read ahead and results waiting for a writer.
+            num_writers (int): Number of writer threads.
+            lock (threading.Lock): Held around every model call when the upsampler is shared.
+
+        Returns:
+            int: The number of frames written.
+        """
+        if (write is None) == (save_paths is None):
+            raise ValueError("Expected exactly one of write and save_paths")
+        if save_paths is not None:
+            save_paths = iter(save_paths)
+
+        reader = PrefetchReader(frames, num_prefetch_queue)
+        que = queue.Queue(num_prefetch_queue)
+        writers = [IOConsumer(None, que, qid) for qid in range(num_writers)]
+        reader.start()
+        for writer in writers:
+            writer.start()
+
+        count = 0
+        try:
+            batch = []
+            for img in reader:
+                batch.append(img)
+                if len(batch) < batch_size:
+                    continue
+                count += self._enhance_and_queue(batch, outscale, que, write, save_paths, lock)
+                batch = []
+                if any(writer.error is not None for writer in writers):
+                    break
+            if batch:
+                count += self._enhance_and_queue(batch, outscale, que, write, save_paths, lock)
+        finally:
+            reader.close()
+            for _ in writers:
+                que.put('quit')
+            for writer in writers:
+                writer.join()
+
+        for writer in writers:
+            if writer.error is not None:
+                raise writer.error
+        return count
+
+    def _enhance_and_queue(self, batch, outscale, que, write, save_paths, lock):
+        with lock or contextlib.nullcontext():
+            outputs = self.enhance_batch(batch, outscale)
+        for output in outputs:
+            if write is not None:
+                que.put({'output': output, 'write': write})
+            else:
+                que.put({'output': output, 'save_path': next(save_paths)})
+        return len(outputs)
+
+
+class OVRealESRGANer(RealESRGANer):
+    """RealESRGANer running an OpenVINO IR exported by ``export_openvino.py``.
+
+    The IR has a static ``(tile_batch_size, 3, batch_tile + 2 * tile_pad, ...)``
+    input, so it compiles once. ``enhance()`` and ``enhance_batch()`` keep their
+    API and always go through fixed-size tiles; a partial last batch is padded
+    with empty tiles.
+
+    Args:
+        scale (int): Upsampling scale factor of the network.
+        model_path (str): Path to the OpenVINO IR ``.xml``.
+        tile_pad (int): The pad size the IR was exported with. Default: 10.
+        pre_pad (int): Pad the input images to avoid border artifacts. Default: 0.
+        device (str): OpenVINO device. Default: CPU.
+    """
+
+    def __init__(self, scale, model_path, tile_pad=10, pre_pad=0, device="CPU"):
+        import openvino as ov
+        import openvino.properties as props
+        import openvino.properties.hint as hints
+
+        self.scale = scale
+        self.tile_pad = tile_pad
+        self.pre_pad = pre_pad
+        self.mod_scale = None
+        self.half = False
+        self.device = torch.device('cpu')
+
+        core = ov.Core()
+        core.set_property({props.cache_dir: os.path.join(ROOT_DIR, 'cache', device)})
+        model = core.read_model(model_path)
+        self.tile_batch_size, _, input_size, _ = model.input(0).get_shape()
+        self.batch_tile = input_size - 2 * tile_pad
+        # enhance() takes the tile path, which is the only one with static shapes
+        self.tile_size = self.batch_tile
+        # a single synchronous request runs the tiles, the throughput hint would only add idle streams
+        self.compiled_model = core.compile_model(
+            model, device, {hints.performance_mode: hints.PerformanceMode.LATENCY})
+        self.infer_request = self.compiled_model.create_infer_request()
+
+    def _run_model(self, tiles):
+        count = len(tiles)
+        if count < self.tile_batch_size:
+            tiles = np.concatenate((tiles, np.zeros((self.tile_batch_size - count, *tiles.shape[1:]), tiles.dtype)))
+        self.infer_request.infer({0: tiles})
+        return self.infer_request.get_output_tensor(0).data[:count].copy()
+
+    def process(self):
+        self.tile_process()
+
+    def tile_process(self):
+        img = self.img[0].float().cpu().numpy().transpose(1, 2, 0)
+        output = self.upscale_tiles([img])[0]
+        self.output = torch.from_numpy(np.ascontiguousarray(output.transpose(2, 0, 1)))[None]
+
+
 class PrefetchReader(threading.Thread):
     """Prefetch images.
 
     Args:
-        img_list (list[str]): A image list of image paths to be read.
+        img_list (Iterable[str | np.ndarray]): Image paths to be read, or already decoded
+            images such as the frames of a generator.
         num_prefetch_queue (int): Number of prefetch queue.
     """
 
     def __init__(self, img_list, num_prefetch_queue):
-        super().__init__()
+        super().__init__(daemon=True)
         self.que = queue.Queue(num_prefetch_queue)
         self.img_list = img_list
+        self.stopped = threading.Event()
+        self.error = None
 
     def run(self):
-        for img_path in self.img_list:
-            img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
-            self.que.put(img)
+        try:
+            for img in self.img_list:
+                if self.stopped.is_set():
+                    break
+                if isinstance(img, str):
+                    img = cv2.imread(img, cv2.IMREAD_UNCHANGED)
+                self.que.put(img)
+        except Exception as error:
+            self.error = error
+        finally:
+            # Let a generator release its resources in the thread that ran it
+            if hasattr(self.img_list, 'close'):
+                self.img_list.close()
 
         self.que.put(None)
 
+    def close(self):
+        """Stop reading and wait for the thread, dropping the prefetched images."""
+        self.stopped.set()
+        while self.is_alive():
+            try:
+                self.que.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
     def __next__(self):
         next_item = self.que.get()
         if next_item is None:
+            if self.error is not None:
+                raise self.error
             raise StopIteration
         return next_item
 
@@ -306,14 +525,23 @@ class IOConsumer(threading.Thread):
         self._queue = que
         self.qid = qid
         self.opt = opt
+        self.error = None
 
     def run(self):
         while True:
             msg = self._queue.get()
             if isinstance(msg, str) and msg == 'quit':
                 break
+            # Keep draining after a failure so the producer never blocks
+            if self.error is not None:
+                continue
 
             output = msg['output']
-            save_path = msg['save_path']
-            cv2.imwrite(save_path, output)
+            try:
+                if 'write' in msg:
+                    msg['write'](output)
+                else:
+                    cv2.imwrite(msg['save_path'], output)
+            except Exception as error:
+                self.error = error
         print(f'IO worker {self.qid} is done.')
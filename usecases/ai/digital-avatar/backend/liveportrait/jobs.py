@@ -0,0 +1,203 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger('uvicorn.error')
+
+ACTIVE_STATUSES = ["QUEUED", "IN_PROGRESS"]
+FINISHED_STATUSES = ["COMPLETED", "FAILED", "CANCELLED"]
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """A skin generation job and its progress.
+
+    Args:
+        job_type (str): Job type, e.g. ``inference``.
+        params (dict): Arguments of the job handler.
+    """
+
+    def __init__(self, job_type, params):
+        self.id = uuid.uuid4().hex
+        self.type = job_type
+        self.params = params
+        self.status = "QUEUED"
+        self.message = "Waiting for a worker..."
+        self.url = None
+        self.stage = None
+        self.frames_done = 0
+        self.total_frames = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    def report_progress(self, stage, done, total):
+        """Progress callback of the pipeline, raises JobCancelled once the job is cancelled."""
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        self.stage = stage
+        self.frames_done = done
+        self.total_frames = total
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "type": self.type,
+            "skin_name": self.params.get("skin_name"),
+            "url": self.url,
+            "status": self.status,
+            "message": self.message,
+            "stage": self.stage,
+            "frames_done": self.frames_done,
+            "total_frames": self.total_frames,
+            "progress": round(self.frames_done / self.total_frames, 4) if self.total_frames else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Run jobs in submission order on a pool of worker threads.
+
+    Args:
+        handler (callable): Runs a job as ``handler(job, worker_id)``. It reports
+            progress with ``job.report_progress`` and sets ``job.url`` and
+            ``job.message``; an exception it raises fails the job.
+        cleanup (callable): Called as ``cleanup(job)`` for a job cancelled before
+            it started, e.g. to remove its upload, as the handler never runs.
+        discard (callable): Called as ``discard(job)`` for a job cancelled once
+            its handler returned, to remove the output the handler produced.
+        num_workers (int): Jobs run concurrently.
+        max_finished (int): Finished jobs kept for polling, the oldest are dropped first.
+    """
+
+    def __init__(self, handler, cleanup=None, discard=None, num_workers=1, max_finished=100):
+        self.handler = handler
+        self.cleanup = cleanup
+        self.discard = discard
+        self.num_workers = num_workers
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.workers = []
+
+    def start(self):
+        for worker_id in range(self.num_workers):
+            worker = threading.Thread(target=self._run, args=(worker_id,), name=f"skin-worker-{worker_id}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for job in self.active():
+            self.cancel(job.id)
+        for _ in self.workers:
+            self.queue.put(None)
+
+    def submit(self, job_type, **params):
+        job = Job(job_type, params)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def active(self):
+        return [job for job in self.list() if job.status in ACTIVE_STATUSES]
+
+    def position(self, job):
+        """Number of queued jobs ahead of the job."""
+        with self.lock:
+            ahead = 0
+            for other in self.jobs.values():
+                if other is job:
+                    return ahead
+                ahead += other.status == "QUEUED"
+            return ahead
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or stop a running one at its next progress report.
+        A finished job is returned unchanged, its ``cancel_event`` is not set."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATUSES:
+                return job
+            job.cancel_event.set()
+            skipped = job.status == "QUEUED"
+            if skipped:
+                self._finish(job, "CANCELLED", "Cancelled before it started.")
+            else:
+                job.message = "Cancelling..."
+        # Right away rather than when a worker skips the job, as a new job may reuse its files by then
+        if skipped and self.cleanup is not None:
+            try:
+                self.cleanup(job)
+            except Exception as e:
+                logger.error(f"Cleanup of job {job.id} failed: {e}")
+        return job
+
+    def _finish(self, job, status, message):
+        job.status = status
+        job.message = message
+        job.finished_at = time.time()
+        self._prune()
+
+    def _discard(self, job):
+        try:
+            if self.discard is not None:
+                self.discard(job)
+        except Exception as e:
+            logger.error(f"Removing the output of job {job.id} failed: {e}")
+        job.url = None
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED_STATUSES]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job_id]
+
+    def _run(self, worker_id):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            with self.lock:
+                if job.status != "QUEUED":
+                    # cancelled while it was queued
+                    continue
+                job.status = "IN_PROGRESS"
+                job.started_at = time.time()
+            try:
+                self.handler(job, worker_id)
+                # under the lock of cancel(), so a job is either cancelled with its output removed or completed
+                with self.lock:
+                    if job.cancel_event.is_set():
+                        # cancelled after its last progress report
+                        self._discard(job)
+                        self._finish(job, "CANCELLED", "Cancelled.")
+                    else:
+                        self._finish(job, "COMPLETED", job.message)
+            except JobCancelled:
+                with self.lock:
+                    self._finish(job, "CANCELLED", "Cancelled.")
+            except Exception as e:
+                logger.error(f"Job {job.id} of {job.params.get('skin_name')} failed: {e}")
+                with self.lock:
+                    self._finish(job, "FAILED", str(e))
@@ -11,7 +11,6 @@ import os
 import logging
 import re
 import shutil
-import asyncio
 
 import tyro
 from liveportrait.src.config.argument_config import ArgumentConfig
@@ -19,24 +18,96 @@ from liveportrait.src.config.inference_config import InferenceConfig
 from liveportrait.src.config.crop_config import CropConfig
 from liveportrait.src.live_portrait_pipeline import LivePortraitPipeline
 from pydantic import BaseModel
+from jobs import ACTIVE_STATUSES, FINISHED_STATUSES, JobQueue
 
 import torch
 import json
 import ffmpeg
+import numpy as np
 
 logger = logging.getLogger('uvicorn.error')
 
-TASK = None # Placeholder for task, can be set later if needed
-def set_task(task):
-    global TASK
-    TASK = task
+# Skins generated concurrently, every worker loads its own pipeline
+SKIN_WORKERS = int(os.getenv("SKIN_WORKERS", "1"))
+# Loaded once at startup, one per worker
+PIPELINES = []
+JOBS = None
+# Driving frames per motion extractor call when making motion templates
+MOTION_BATCH_SIZE = int(os.getenv("MOTION_BATCH_SIZE", "16"))
+# Frames per warping module and SPADE generator call when animating
+ANIMATE_BATCH_SIZE = int(os.getenv("ANIMATE_BATCH_SIZE", "4"))
+# torch, or openvino to run the modules exported by liveportrait/export_openvino.py
+LIVEPORTRAIT_BACKEND = os.getenv("LIVEPORTRAIT_BACKEND", "torch")
+LIVEPORTRAIT_DEVICE = os.getenv("LIVEPORTRAIT_DEVICE", "CPU")
 
 def partial_fields(target_class, kwargs):
     return target_class(**{k: v for k, v in kwargs.items() if hasattr(target_class, k)})
 
+def get_default_args():
+    # Defaults only, the service arguments are not LivePortrait arguments
+    return tyro.cli(ArgumentConfig, args=[])
+
+def initialize_pipeline():
+    args = get_default_args()
+    inference_cfg = partial_fields(InferenceConfig, args.__dict__)
+    if LIVEPORTRAIT_BACKEND == "openvino":
+        from liveportrait.export_openvino import export_models
+        from liveportrait.src.live_portrait_wrapper_ov import openvino_models_exist
+        if not openvino_models_exist():
+            logger.info("Exporting the LivePortrait models to OpenVINO IR...")
+            export_models()
+        # The tensors between the OpenVINO models stay on the host
+        inference_cfg.flag_force_cpu = True
+        inference_cfg.flag_use_half_precision = False
+    else:
+        configure_torch_device(inference_cfg)
+    crop_cfg = partial_fields(CropConfig, args.__dict__)
+    return LivePortraitPipeline(
+        inference_cfg=inference_cfg,
+        crop_cfg=crop_cfg,
+        motion_batch_size=MOTION_BATCH_SIZE,
+        animate_batch_size=ANIMATE_BATCH_SIZE,
+        backend=LIVEPORTRAIT_BACKEND,
+        openvino_device=LIVEPORTRAIT_DEVICE
+    )
+
+def configure_torch_device(inference_cfg):
+    try:
+        if not torch.xpu.is_available():
+            inference_cfg.flag_force_cpu = True
+            inference_cfg.flag_use_half_precision = False
+        else:
+            from liveportrait.intel_xpu.xpu_override import xpu_override
+            xpu_override()
+            inference_cfg.flag_force_cpu = False
+    except:
+        inference_cfg.flag_force_cpu = True
+        inference_cfg.flag_use_half_precision = False
+
+def warmup(pipeline):
+    # Run every model once so the first skin does not pay for allocations and kernel compilation
+    wrapper = pipeline.live_portrait_wrapper
+    pipeline.cropper.crop_source_image(np.zeros((512, 512, 3), dtype=np.uint8), pipeline.cropper.crop_cfg)
+    I_s = wrapper.prepare_source(np.zeros((256, 256, 3), dtype=np.uint8))
+    x_s_info = wrapper.get_kp_info(I_s)
+    f_s = wrapper.extract_feature_3d(I_s)
+    x_s = wrapper.transform_keypoint(x_s_info)
+    if wrapper.inference_cfg.flag_stitching:
+        wrapper.stitching(x_s, x_s)
+    wrapper.warp_decode(f_s, x_s, x_s)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global JOBS
+    for _ in range(SKIN_WORKERS):
+        pipeline = initialize_pipeline()
+        warmup(pipeline)
+        PIPELINES.append(pipeline)
+    logger.info(f"LivePortrait pipeline loaded for {SKIN_WORKERS} workers")
+    JOBS = JobQueue(run_skin_job, cleanup=remove_upload, discard=remove_skin, num_workers=SKIN_WORKERS)
+    JOBS.start()
     yield
+    JOBS.stop()
 
 
 allowed_cors =  json.loads(os.getenv("ALLOWED_CORS", '["http://localhost"]'))
@@ -64,129 +135,126 @@ def sanitize_filename(name: str) -> str:
 router = APIRouter(prefix="/v1",
                    responses={404: {"description": "Unable to find route"}})
 
-def process_inference_task(sanitized_skin_name, ext, temp_path):
-    # Check if the uploaded file is a symbolic link
-    if os.path.islink(temp_path):
-        os.remove(temp_path)
-        set_task({
-            "type": "inference",
-            "skin_name": sanitized_skin_name,
-            "url": None,
-            "status": "FAILED",
-            "message": "Symbolic links are not allowed as source files.",
-        })
-        return
-        
-    set_task({
-        "type": "inference",
-        "skin_name": sanitized_skin_name,
-        "url": f"_upload_{sanitized_skin_name}{ext}",
-        "status": "IN_PROGRESS",
-        "message": "File processed, creating skin...",
-    })
-    if ext in ['.png', '.jpg', '.jpeg', '.bmp', '.gif']:
-        args = tyro.cli(ArgumentConfig)
-        args.source = temp_path
-        args.driving = "assets/idle.mp4"
-        args.output_dir = "assets/avatar-skins"
-        args.output_name = sanitized_skin_name
-        inference_cfg = partial_fields(InferenceConfig, args.__dict__)
-        try:
-            if not torch.xpu.is_available():
-                inference_cfg.flag_force_cpu = True
-                inference_cfg.flag_use_half_precision = False
-            else:
-                from liveportrait.intel_xpu.xpu_override import xpu_override
-                xpu_override()
-                inference_cfg.flag_force_cpu = False
-        except:
-            inference_cfg.flag_force_cpu = True
-            inference_cfg.flag_use_half_precision = False
-        crop_cfg = partial_fields(CropConfig, args.__dict__)
-        liveportrait = LivePortraitPipeline(
-            inference_cfg=inference_cfg,
-            crop_cfg=crop_cfg
-        )
-        liveportrait.execute(args)
-        os.remove(temp_path)
-        set_task({
-            "type": "inference",
-            "skin_name": sanitized_skin_name,
-            "url": sanitized_skin_name + ".mp4",
-            "status": "COMPLETED",
-            "message": "Avatar skin created successfully.",
-        })
-    elif ext in ['.mp4', '.avi', '.mov', '.mkv']:
-        dest_path = f"assets/avatar-skins/{sanitized_skin_name}.mp4"
-        if temp_path != dest_path:
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.bmp', '.gif']
+VIDEO_EXTENSIONS = ['.mp4', '.avi', '.mov', '.mkv']
+
+def run_skin_job(job, worker_id):
+    sanitized_skin_name = job.params["skin_name"]
+    ext = job.params["ext"]
+    temp_path = job.params["temp_path"]
+    try:
+        # Check if the uploaded file is a symbolic link
+        if os.path.islink(temp_path):
+            raise ValueError("Symbolic links are not allowed as source files.")
+
+        job.message = "File processed, creating skin..."
+        if ext in IMAGE_EXTENSIONS:
+            args = get_default_args()
+            args.source = temp_path
+            args.driving = "assets/idle.mp4"
+            args.output_dir = "assets/avatar-skins"
+            args.output_name = sanitized_skin_name
+            PIPELINES[worker_id].execute(args, progress_callback=job.report_progress)
+        elif ext in VIDEO_EXTENSIONS:
+            dest_path = f"assets/avatar-skins/{sanitized_skin_name}.mp4"
             shutil.move(temp_path, dest_path)
+            try:
+                probe = ffmpeg.probe(dest_path)
+                duration = float(probe['format']['duration'])
+                if duration > 5:
+                    trimmed_path = dest_path + '.trimmed.mp4'
+                    (
+                        ffmpeg
+                        .input(dest_path)
+                        .output(trimmed_path, t=5, codec='copy')
+                        .run(overwrite_output=True)
+                    )
+                    os.replace(trimmed_path, dest_path)
+            except Exception as e:
+                logger.error(f"Video trimming with ffmpeg-python failed: {e}")
         else:
-            dest_path = temp_path
-        try:
-            probe = ffmpeg.probe(dest_path)
-            duration = float(probe['format']['duration'])
-            if duration > 5:
-                trimmed_path = dest_path + '.trimmed.mp4'
-                (
-                    ffmpeg
-                    .input(dest_path)
-                    .output(trimmed_path, t=5, codec='copy')
-                    .run(overwrite_output=True)
-                )
-                os.replace(trimmed_path, dest_path)
-        except Exception as e:
-            logger.error(f"Video trimming with ffmpeg-python failed: {e}")
-        set_task({
-            "type": "inference",
-            "skin_name": sanitized_skin_name,
-            "url": sanitized_skin_name + ".mp4",
-            "status": "COMPLETED",
-            "message": "Avatar skin created successfully.",
-        })
-    else:
+            raise ValueError("Unsupported file type for source.")
+        job.url = sanitized_skin_name + ".mp4"
+        job.message = "Avatar skin created successfully."
+    finally:
+        remove_upload(job)
+
+def remove_upload(job):
+    temp_path = job.params["temp_path"]
+    if os.path.lexists(temp_path):
         os.remove(temp_path)
-        set_task({
-            "type": "inference",
-            "skin_name": sanitized_skin_name,
-            "url": None,
-            "status": "FAILED",
-            "message": "Unsupported file type for source.",
-        })
+
+def remove_skin(job):
+    # The skin of a job cancelled after its last progress report, or of a video upload which reports none
+    output_path = f"assets/avatar-skins/{job.params['skin_name']}.mp4"
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+def get_legacy_task():
+    # The single task view of /v1/get-task: the oldest unfinished job, else the last finished one
+    jobs = JOBS.list() if JOBS is not None else []
+    if not jobs:
+        return {"status": "IDLE"}
+    active = JOBS.active()
+    job = active[0] if active else max(jobs, key=lambda job: job.finished_at or 0)
+    task = job.to_dict()
+    if job.status in ACTIVE_STATUSES:
+        # The uploaded source is served as the preview until the skin is ready
+        task["status"] = "IN_PROGRESS"
+        task["url"] = os.path.basename(job.params["temp_path"])
+    elif job.status == "CANCELLED":
+        task["status"] = "FAILED"
+    return task
+
+def job_response(job):
+    data = job.to_dict()
+    if job.status == "QUEUED":
+        data["queue_position"] = JOBS.position(job)
+    return data
 
 @router.post("/inference")
 async def inference(skin_name: str = Form(...), source: UploadFile = File(...)):
     try:
-        set_task({
-            "type": "inference",
-            "skin_name": skin_name,
-            "url": None,
-            "status": "IN_PROGRESS",
-            "message": "Processing skin upload...",
-        })
         sanitized_skin_name = sanitize_filename(skin_name)
+        content = await source.read()
+        # No await from the check to the submission, so two uploads of a skin cannot both pass it
+        if any(job.params["skin_name"] == sanitized_skin_name for job in JOBS.active()):
+            return JSONResponse(content=jsonable_encoder({"message": f"A job for avatar skin {sanitized_skin_name} is already queued"}), status_code=409)
         ext = os.path.splitext(source.filename)[1].lower()
         temp_path = f"assets/avatar-skins/tmp/_upload_{sanitized_skin_name}{ext}"
         with open(temp_path, "wb") as f:
-            f.write(await source.read())
-        # Start the heavy task in a background thread so event loop is not blocked
-        asyncio.create_task(asyncio.to_thread(process_inference_task, sanitized_skin_name, ext, temp_path))
-        return JSONResponse(content=jsonable_encoder({"message": "Create avatar skin task started"}), status_code=200)
+            f.write(content)
+        # The job runs on a worker thread so the event loop is not blocked
+        job = JOBS.submit("inference", skin_name=sanitized_skin_name, ext=ext, temp_path=temp_path)
+        return JSONResponse(content=jsonable_encoder({"message": "Create avatar skin task started", "job_id": job.id, "data": job_response(job)}), status_code=200)
     
     except Exception as e:
         logger.error(f"Error during inference: {e}")
-        set_task({
-            "type": "inference",
-            "skin_name": skin_name,
-            "url": None,
-            "status": "FAILED",
-            "message": str(e),
-        })
         return JSONResponse(content=jsonable_encoder({"message": f"Failed to create avatar skin. Error: {e}"}), status_code=500)        
 
 @router.get("/get-task")
 async def get_task():
-    global TASK
-    return JSONResponse(content=jsonable_encoder({"status": True, "data": TASK if TASK is not None else {"status": "IDLE"}}))
+    return JSONResponse(content=jsonable_encoder({"status": True, "data": get_legacy_task()}))
+
+@router.get("/jobs")
+async def list_jobs():
+    return JSONResponse(content=jsonable_encoder({"status": True, "data": [job_response(job) for job in JOBS.list()]}))
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        return JSONResponse(content=jsonable_encoder({"status": False, "message": "job does not exist"}), status_code=404)
+    return JSONResponse(content=jsonable_encoder({"status": True, "data": job_response(job)}))
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = JOBS.cancel(job_id)
+    if job is None:
+        return JSONResponse(content=jsonable_encoder({"status": False, "message": "job does not exist"}), status_code=404)
+    if job.status in FINISHED_STATUSES and not job.cancel_event.is_set():
+        return JSONResponse(content=jsonable_encoder({"status": False, "message": f"job already {job.status.lower()}", "data": job_response(job)}), status_code=409)
+    return JSONResponse(content=jsonable_encoder({"status": True, "data": job_response(job)}))
 
 @router.get("/skin/{name}")
 async def get_video(name: str):
@@ -0,0 +1,209 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Export the LivePortrait modules to OpenVINO IR and check them against torch.
+
+The appearance feature extractor, motion extractor, warping module, SPADE
+generator and the stitching and retargeting MLPs are traced on a batch of two
+and exported with a dynamic batch dimension, so the batched motion template and
+animate paths of the pipeline compile them once:
+
+    python3 liveportrait/export_openvino.py
+
+``--check`` runs the torch modules and the IRs on the same fixed random inputs,
+of another batch size than the traced one, and fails when an output drifts more
+than ``--rtol`` of the torch output range or the decoded frames differ by more
+than ``--pixel_tol`` on average:
+
+    python3 liveportrait/export_openvino.py --check --device CPU
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+
+import numpy as np
+import openvino as ov
+import torch
+
+from liveportrait.src.config.inference_config import InferenceConfig
+from liveportrait.src.live_portrait_wrapper import LivePortraitWrapper
+from liveportrait.src.live_portrait_wrapper_ov import (MOTION_KEYS, OPENVINO_DIR, STITCHING_MODELS,
+                                                       OVLivePortraitWrapper, OVModule, get_openvino_path)
+
+
+class MotionExtractorOutputs(torch.nn.Module):
+    """The motion extractor with its dict outputs as a tuple in ``MOTION_KEYS`` order."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x):
+        kp_info = self.model(x)
+        return tuple(kp_info[key] for key in MOTION_KEYS)
+
+
+class WarpingModuleOutput(torch.nn.Module):
+    """The warping module with the warped feature as its only output, the one the decoder takes."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, feature_3d, kp_source, kp_driving):
+        return self.model(feature_3d, kp_source=kp_source, kp_driving=kp_driving)['out']
+
+
+def load_torch_wrapper():
+    inference_cfg = InferenceConfig()
+    inference_cfg.flag_force_cpu = True
+    inference_cfg.flag_use_half_precision = False
+    return LivePortraitWrapper(inference_cfg=inference_cfg)
+
+
+def get_torch_modules(wrapper):
+    modules = {
+        'appearance_feature_extractor': wrapper.appearance_feature_extractor,
+        'motion_extractor': MotionExtractorOutputs(wrapper.motion_extractor),
+        'warping_module': WarpingModuleOutput(wrapper.warping_module),
+        'spade_generator': wrapper.spade_generator,
+    }
+    if wrapper.stitching_retargeting_module is not None:
+        modules.update({name: wrapper.stitching_retargeting_module[name] for name in STITCHING_MODELS})
+    return modules
+
+
+def get_example_inputs(wrapper, batch_size=2, seed=0):
+    """Fixed random inputs of every module, the keypoints and the warped feature
+    come from the torch modules so they are in the range the next module expects."""
+    generator = torch.Generator().manual_seed(seed)
+    source = torch.rand(batch_size, 3, 256, 256, generator=generator)
+    with torch.no_grad():
+        feature_3d = wrapper.appearance_feature_extractor(source)
+        kp_source = wrapper.transform_keypoint(wrapper.get_kp_info(source))
+        kp_driving = kp_source + 0.02 * torch.randn(kp_source.shape, generator=generator)
+        warped = wrapper.warping_module(feature_3d, kp_source=kp_source, kp_driving=kp_driving)['out']
+
+    inputs = {
+        'appearance_feature_extractor': (source,),
+        'motion_extractor': (source,),
+        'warping_module': (feature_3d, kp_source, kp_driving),
+        'spade_generator': (warped,),
+    }
+    if wrapper.stitching_retargeting_module is not None:
+        for name in STITCHING_MODELS:
+            mlp = wrapper.stitching_retargeting_module[name]
+            in_features = next(m for m in mlp.modules() if isinstance(m, torch.nn.Linear)).in_features
+            inputs[name] = (torch.randn(batch_size, in_features, generator=generator) * 0.1,)
+    return inputs
+
+
+def export_models(model_dir=OPENVINO_DIR, compress=False):
+    """Convert the modules of the torch LivePortraitWrapper to IRs with a dynamic batch dimension.
+
+    Args:
+        compress (bool): Compress the weights to int8 with NNCF.
+    """
+    wrapper = load_torch_wrapper()
+    modules = get_torch_modules(wrapper)
+    # traced on a batch, so no batch of one is baked into the reshapes of the graph
+    example_inputs = get_example_inputs(wrapper, batch_size=2)
+
+    if compress:
+        try:
+            import nncf
+        except ImportError as error:
+            raise ImportError("int8 weight compression requires NNCF: pip install nncf") from error
+
+    os.makedirs(model_dir, exist_ok=True)
+    for name, module in modules.items():
+        inputs = example_inputs[name]
+        input_shapes = [[-1, *x.shape[1:]] for x in inputs]
+        print(f"Converting {name} with input shapes {input_shapes}...")
+        with torch.no_grad():
+            ov_model = ov.convert_model(module, example_input=inputs, input=input_shapes)
+        if compress:
+            print(f"Compressing the weights of {name} to int8...")
+            ov_model = nncf.compress_weights(ov_model)
+        output_path = get_openvino_path(name, model_dir)
+        ov.save_model(ov_model, output_path)
+        print(f"Model saved to {output_path}")
+    return model_dir
+
+
+def max_error(expected, actual):
+    expected = expected.detach().float().numpy()
+    actual = actual.detach().float().numpy()
+    error = float(np.max(np.abs(expected - actual)))
+    return error, error / max(float(np.max(np.abs(expected))), 1e-6)
+
+
+def check_models(model_dir=OPENVINO_DIR, device='CPU', batch_size=4, seed=0, rtol=1e-2, pixel_tol=1.0):
+    """Compare the IRs with the torch modules on fixed random inputs, return True when all match.
+
+    Args:
+        batch_size (int): Batch size of the inputs, the animate batch by default.
+        rtol (float): Largest error of a module output relative to the torch output range.
+        pixel_tol (float): Largest mean absolute difference of the frames decoded by warp_decode.
+    """
+    wrapper = load_torch_wrapper()
+    ov_wrapper = OVLivePortraitWrapper(wrapper.inference_cfg, device=device, model_dir=model_dir)
+    modules = get_torch_modules(wrapper)
+    ov_modules = {
+        'appearance_feature_extractor': ov_wrapper.appearance_feature_extractor,
+        'motion_extractor': ov_wrapper.motion_extractor,
+        'warping_module': OVModule(ov_wrapper.warping_module.compiled_model),
+        'spade_generator': ov_wrapper.spade_generator,
+    }
+    if ov_wrapper.stitching_retargeting_module is not None:
+        ov_modules.update(ov_wrapper.stitching_retargeting_module)
+
+    passed = True
+    inputs = get_example_inputs(wrapper, batch_size, seed)
+    for name, module in modules.items():
+        with torch.no_grad():
+            expected = module(*inputs[name])
+        actual = ov_modules[name](*inputs[name])
+        if name == 'motion_extractor':
+            expected = dict(zip(MOTION_KEYS, expected))
+        else:
+            expected, actual = {'out': expected}, {'out': actual}
+        for key in expected:
+            error, relative = max_error(expected[key], actual[key])
+            passed &= relative <= rtol
+            print(f"{name:>28} {key:>6}: max abs error {error:.2e}, {relative:.2e} of the output range"
+                  f"{'' if relative <= rtol else '  FAILED'}")
+
+    # the animate path end to end: warping, decoding and conversion to pixels
+    feature_3d, kp_source, kp_driving = inputs['warping_module']
+    expected = wrapper.parse_output(wrapper.warp_decode(feature_3d, kp_source, kp_driving)['out'])
+    actual = ov_wrapper.parse_output(ov_wrapper.warp_decode(feature_3d, kp_source, kp_driving)['out'])
+    pixel_error = np.abs(expected.astype(np.int16) - actual.astype(np.int16))
+    passed &= pixel_error.mean() <= pixel_tol
+    print(f"{'warp_decode':>28} pixels: max {pixel_error.max()}, mean {pixel_error.mean():.3f}"
+          f"{'' if pixel_error.mean() <= pixel_tol else '  FAILED'}")
+    return bool(passed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output_dir', default=OPENVINO_DIR)
+    parser.add_argument('--int8', action='store_true', help='Compress the weights to int8 with NNCF')
+    parser.add_argument('--check', action='store_true', help='Compare the exported models with torch instead of exporting')
+    parser.add_argument('--device', default='CPU', help='OpenVINO device of the check')
+    parser.add_argument('--batch_size', type=int, default=4, help='Batch size of the check inputs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rtol', type=float, default=1e-2,
+                        help='Largest error of the check relative to the torch output range')
+    parser.add_argument('--pixel_tol', type=float, default=1.0,
+                        help='Largest mean absolute pixel difference of the frames decoded by warp_decode')
+    args = parser.parse_args()
+
+    if args.check:
+        passed = check_models(args.output_dir, args.device, args.batch_size, args.seed, args.rtol, args.pixel_tol)
+        sys.exit(0 if passed else 1)
+    export_models(args.output_dir, compress=args.int8)
@@ -12,6 +12,8 @@ torch.backends.cudnn.benchmark = True # disable CUDNN_BACKEND_EXECUTION_PLAN_DES
 
 import cv2; cv2.setNumThreads(0); cv2.ocl.setUseOpenCL(False)
 import numpy as np
+import hashlib
+import json
 import os
 import os.path as osp
 from rich.progress import track
@@ -22,6 +24,7 @@ from .config.crop_config import CropConfig
 from .utils.cropper import Cropper
 from .utils.camera import get_rotation_matrix
 from .utils.video import images2video, get_fps, add_audio_to_video, has_audio_stream
+from .utils.video_writer import VideoStreamWriter
 from .utils.crop import prepare_paste_back, paste_back
 from .utils.io import load_image_rgb, load_video, resize_to_limit, dump, load
 from .utils.helper import mkdir, basename, dct2device, is_video, is_template, remove_suffix, is_image, is_square_video, calc_motion_multiplier
@@ -31,18 +34,46 @@ from .utils.rprint import rlog as log
 from .live_portrait_wrapper import LivePortraitWrapper
 
 
+PIPELINE_BACKENDS = ['torch', 'openvino']
+# Bump when the content of the motion templates changes, so cached templates are rebuilt
+MOTION_TEMPLATE_VERSION = 1
+
+
 def make_abs_path(fn):
     return osp.join(osp.dirname(osp.realpath(__file__)), fn)
 
 
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class LivePortraitPipeline(object):
 
-    def __init__(self, inference_cfg: InferenceConfig, crop_cfg: CropConfig):
-        self.live_portrait_wrapper: LivePortraitWrapper = LivePortraitWrapper(inference_cfg=inference_cfg)
+    def __init__(self, inference_cfg: InferenceConfig, crop_cfg: CropConfig, motion_batch_size: int = 16, animate_batch_size: int = 4,
+                 backend: str = 'torch', openvino_device: str = 'CPU'):
+        if backend == 'openvino':
+            # the modules exported by export_openvino.py
+            from .live_portrait_wrapper_ov import OVLivePortraitWrapper
+            self.live_portrait_wrapper: LivePortraitWrapper = OVLivePortraitWrapper(inference_cfg=inference_cfg, device=openvino_device)
+        elif backend == 'torch':
+            self.live_portrait_wrapper: LivePortraitWrapper = LivePortraitWrapper(inference_cfg=inference_cfg)
+        else:
+            raise ValueError(f"Unsupported LivePortrait backend: {backend}. Expected one of {PIPELINE_BACKENDS}")
+        self.backend = backend
         self.cropper: Cropper = Cropper(crop_cfg=crop_cfg)
+        # driving frames per motion extractor call when making motion templates
+        self.motion_batch_size = motion_batch_size
+        # frames per warping module and SPADE generator call when animating
+        self.animate_batch_size = animate_batch_size
 
     def make_motion_template(self, I_lst, c_eyes_lst, c_lip_lst, **kwargs):
         n_frames = I_lst.shape[0]
+        batch_size = max(1, kwargs.get('batch_size', self.motion_batch_size))
+        progress_callback = kwargs.get('progress_callback')
         template_dct = {
             'n_frames': n_frames,
             'output_fps': kwargs.get('output_fps', 25),
@@ -51,24 +82,29 @@ class LivePortraitPipeline(object):
             'c_lip_lst': [],
         }
 
-        for i in track(range(n_frames), description='Making motion templates...', total=n_frames):
-            # collect s, R, δ and t for inference
-            I_i = I_lst[i]
-            x_i_info = self.live_portrait_wrapper.get_kp_info(I_i)
-            x_s = self.live_portrait_wrapper.transform_keypoint(x_i_info)
-            R_i = get_rotation_matrix(x_i_info['pitch'], x_i_info['yaw'], x_i_info['roll'])
-
-            item_dct = {
-                'scale': x_i_info['scale'].cpu().numpy().astype(np.float32),
-                'R': R_i.cpu().numpy().astype(np.float32),
-                'exp': x_i_info['exp'].cpu().numpy().astype(np.float32),
-                't': x_i_info['t'].cpu().numpy().astype(np.float32),
-                'kp': x_i_info['kp'].cpu().numpy().astype(np.float32),
-                'x_s': x_s.cpu().numpy().astype(np.float32),
+        for start in track(range(0, n_frames, batch_size), description='Making motion templates...', total=(n_frames + batch_size - 1) // batch_size):
+            # collect s, R, δ and t for inference, the keypoint and rotation math is batched like the motion extractor
+            I_batch = I_lst[start:start + batch_size, 0]  # Bx1x3xHxW -> Bx3xHxW
+            x_info = self.live_portrait_wrapper.get_kp_info(I_batch)
+            x_s = self.live_portrait_wrapper.transform_keypoint(x_info)
+            R = get_rotation_matrix(x_info['pitch'], x_info['yaw'], x_info['roll'])
+
+            batch_dct = {
+                'scale': x_info['scale'],
+                'R': R,
+                'exp': x_info['exp'],
+                't': x_info['t'],
+                'kp': x_info['kp'],
+                'x_s': x_s,
             }
-
-            template_dct['motion'].append(item_dct)
-
+            # a single device to host copy per batch
+            batch_dct = {k: v.cpu().numpy().astype(np.float32) for k, v in batch_dct.items()}
+            for j in range(I_batch.shape[0]):
+                template_dct['motion'].append({k: v[j:j + 1] for k, v in batch_dct.items()})
+            if progress_callback is not None:
+                progress_callback(kwargs.get('stage', 'motion'), len(template_dct['motion']), n_frames)
+
+        for i in range(n_frames):
             c_eyes = c_eyes_lst[i].astype(np.float32)
             template_dct['c_eyes_lst'].append(c_eyes)
 
@@ -77,7 +113,37 @@ class LivePortraitPipeline(object):
 
         return template_dct
 
-    def execute(self, args: ArgumentConfig):
+    def motion_template_key(self, driving_path, frame_limit=None):
+        """Key of the motion template of a driving input: the content hash of the
+        file and the settings the template depends on, so a cached template is
+        reused whatever the name of the driving file is.
+
+        Args:
+            frame_limit (int): Number of driving frames the template is made of, None for all.
+        """
+        inf_cfg = self.live_portrait_wrapper.inference_cfg
+        settings = {
+            'version': MOTION_TEMPLATE_VERSION,
+            'backend': self.backend,
+            'frame_limit': frame_limit,
+            'flag_crop_driving_video': inf_cfg.flag_crop_driving_video,
+            'flag_use_half_precision': inf_cfg.flag_use_half_precision,
+            'checkpoint_M': osp.basename(inf_cfg.checkpoint_M),
+            'motion_model': getattr(self.live_portrait_wrapper, 'motion_model_id', None),
+            'crop_cfg': {k: v for k, v in vars(self.cropper.crop_cfg).items() if isinstance(v, (bool, int, float, str))},
+        }
+        digest = hashlib.sha256(file_sha256(driving_path).encode())
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def execute(self, args: ArgumentConfig, progress_callback=None):
+        """Animate args.source with args.driving and write the video to args.output_dir.
+
+        Args:
+            progress_callback (callable): Called as ``progress_callback(stage, done, total)``
+                with the frames done of the ``motion``, ``source_motion`` and
+                ``animate`` stages. An exception it raises aborts the execution.
+        """
         # for convenience
         inf_cfg = self.live_portrait_wrapper.inference_cfg
         device = self.live_portrait_wrapper.device
@@ -105,11 +171,21 @@ class LivePortraitPipeline(object):
         flag_load_from_template = is_template(args.driving)
         driving_rgb_crop_256x256_lst = None
         wfp_template = None
+        template_path = args.driving
+
+        if not flag_load_from_template and osp.exists(args.driving) and (is_video(args.driving) or is_image(args.driving)):
+            # a video source truncates the driving video to its length before making the template
+            frame_limit = len(source_rgb_lst) if flag_is_source_video and is_video(args.driving) else None
+            wfp_template = osp.join(args.template_dir, self.motion_template_key(args.driving, frame_limit) + '.pkl')
+            if osp.exists(wfp_template):
+                log(f"Reuse the cached motion template {wfp_template} of {args.driving}")
+                flag_load_from_template = True
+                template_path = wfp_template
 
         if flag_load_from_template:
             # NOTE: load from template, it is fast, but the cropping video is None
-            log(f"Load from template: {args.driving}, NOT the video, so the cropping video and audio are both NULL.", style='bold green')
-            driving_template_dct = load(args.driving)
+            log(f"Load from template: {template_path}, NOT the video, so the cropping video and audio are both NULL.", style='bold green')
+            driving_template_dct = load(template_path)
             c_d_eyes_lst = driving_template_dct['c_eyes_lst'] if 'c_eyes_lst' in driving_template_dct.keys() else driving_template_dct['c_d_eyes_lst'] # compatible with previous keys
             c_d_lip_lst = driving_template_dct['c_lip_lst'] if 'c_lip_lst' in driving_template_dct.keys() else driving_template_dct['c_d_lip_lst']
             driving_n_frames = driving_template_dct['n_frames']
@@ -125,7 +201,7 @@ class LivePortraitPipeline(object):
             output_fps = driving_template_dct.get('output_fps', inf_cfg.output_fps)
             log(f'The FPS of template: {output_fps}')
 
-            if args.flag_crop_driving_video:
+            if args.flag_crop_driving_video and template_path == args.driving:
                 log("Warning: flag_crop_driving_video is True, but the driving info is a template, so it is ignored.")
 
         elif osp.exists(args.driving):
@@ -168,12 +244,17 @@ class LivePortraitPipeline(object):
             c_d_eyes_lst, c_d_lip_lst = self.live_portrait_wrapper.calc_ratio(driving_lmk_crop_lst)
             # save the motion template
             I_d_lst = self.live_portrait_wrapper.prepare_videos(driving_rgb_crop_256x256_lst)
-            driving_template_dct = self.make_motion_template(I_d_lst, c_d_eyes_lst, c_d_lip_lst, output_fps=output_fps)
+            driving_template_dct = self.make_motion_template(I_d_lst, c_d_eyes_lst, c_d_lip_lst, output_fps=output_fps, progress_callback=progress_callback)
 
             mkdir(args.template_dir)
-            wfp_template = osp.join(args.template_dir, remove_suffix(os.path.basename(args.driving)) + '.pkl')
-
-            dump(wfp_template, driving_template_dct)
+            # write then rename, so a concurrent execute never loads a partial template
+            wfp_template_tmp = f'{remove_suffix(wfp_template)}.{os.getpid()}.{id(driving_template_dct)}.tmp.pkl'
+            try:
+                dump(wfp_template_tmp, driving_template_dct)
+                os.replace(wfp_template_tmp, wfp_template)
+            finally:
+                if osp.exists(wfp_template_tmp):
+                    os.remove(wfp_template_tmp)
             log(f"Dump motion template to {wfp_template}")
         else:
             raise Exception(f"{args.driving} does not exist!")
@@ -182,12 +263,10 @@ class LivePortraitPipeline(object):
             c_d_lip_lst = c_d_lip_lst*n_frames
 
         ######## prepare for pasteback ########
-        I_p_pstbk_lst = None
-        if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-            I_p_pstbk_lst = []
+        flag_pasteback = inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching
+        if flag_pasteback:
             log("Prepared pasteback mask done.")
 
-        I_p_lst = []
         R_d_0, x_d_0_info = None, None
         flag_normalize_lip = inf_cfg.flag_normalize_lip  # not overwrite
         flag_source_video_eye_retargeting = inf_cfg.flag_source_video_eye_retargeting  # not overwrite
@@ -211,7 +290,7 @@ class LivePortraitPipeline(object):
             c_s_eyes_lst, c_s_lip_lst = self.live_portrait_wrapper.calc_ratio(source_lmk_crop_lst)
             # save the motion template
             I_s_lst = self.live_portrait_wrapper.prepare_videos(img_crop_256x256_lst)
-            source_template_dct = self.make_motion_template(I_s_lst, c_s_eyes_lst, c_s_lip_lst, output_fps=source_fps)
+            source_template_dct = self.make_motion_template(I_s_lst, c_s_eyes_lst, c_s_lip_lst, output_fps=source_fps, progress_callback=progress_callback, stage='source_motion')
 
             key_r = 'R' if 'R' in driving_template_dct['motion'][0].keys() else 'R_d'  # compatible with previous keys
             if inf_cfg.flag_relative_motion:
@@ -275,196 +354,203 @@ class LivePortraitPipeline(object):
             log(f"The animated video consists of {n_frames} frames.")
         else:
             log(f"The output of image-driven portrait animation is an image.")
-        for i in track(range(n_frames), description='🚀Animating...', total=n_frames):
-            if flag_is_source_video:  # source video
-                x_s_info = source_template_dct['motion'][i]
-                x_s_info = dct2device(x_s_info, device)
-
-                source_lmk = source_lmk_crop_lst[i]
-                img_crop_256x256 = img_crop_256x256_lst[i]
-                I_s = I_s_lst[i]
-                f_s = self.live_portrait_wrapper.extract_feature_3d(I_s)
-
-                x_c_s = x_s_info['kp']
-                R_s = x_s_info['R']
-                x_s =x_s_info['x_s']
-
-                # let lip-open scalar to be 0 at first if the input is a video
-                if flag_normalize_lip and inf_cfg.flag_relative_motion and source_lmk is not None:
-                    c_d_lip_before_animation = [0.]
-                    combined_lip_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_before_animation, source_lmk)
-                    if combined_lip_ratio_tensor_before_animation[0][0] >= inf_cfg.lip_normalize_threshold:
-                        lip_delta_before_animation = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor_before_animation)
+        def render(batch):
+            # warp and decode the pending frames in a single batch, then paste back and encode them in order
+            f_s_batch = torch.cat([item['f_s'] for item in batch]) if flag_is_source_video else f_s.expand(len(batch), *f_s.shape[1:])
+            x_s_batch = torch.cat([item['x_s'] for item in batch])
+            x_d_batch = torch.cat([item['x_d'] for item in batch])
+            out = self.live_portrait_wrapper.warp_decode(f_s_batch, x_s_batch, x_d_batch)
+            I_p_batch = self.live_portrait_wrapper.parse_output(out['out'])
+            for item, I_p_i in zip(batch, I_p_batch):
+                if flag_pasteback:
+                    # TODO: the paste back procedure is slow, considering optimize it using multi-threading or GPU
+                    if flag_is_source_video:
+                        I_p_i = paste_back(I_p_i, source_M_c2o_lst[item['i']], source_rgb_lst[item['i']], item['mask'])
                     else:
-                        lip_delta_before_animation = None
+                        I_p_i = paste_back(I_p_i, crop_info['M_c2o'], source_rgb_lst[0], item['mask'])
+                writer.append(I_p_i)
 
-                # let eye-open scalar to be the same as the first frame if the latter is eye-open state
-                if flag_source_video_eye_retargeting and source_lmk is not None:
-                    if i == 0:
-                        combined_eye_ratio_tensor_frame_zero = c_s_eyes_lst[0]
-                        c_d_eye_before_animation_frame_zero = [[combined_eye_ratio_tensor_frame_zero[0][:2].mean()]]
-                        if c_d_eye_before_animation_frame_zero[0][0] < inf_cfg.source_video_eye_retargeting_threshold:
-                            c_d_eye_before_animation_frame_zero = [[0.39]]
-                    combined_eye_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eye_before_animation_frame_zero, source_lmk)
-                    eye_delta_before_animation = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor_before_animation)
-
-                if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:  # prepare for paste back
-                    mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, source_M_c2o_lst[i], dsize=(source_rgb_lst[i].shape[1], source_rgb_lst[i].shape[0]))
-            if flag_is_source_video and not flag_is_driving_video:
-                x_d_i_info = driving_template_dct['motion'][0]
-            else:
-                x_d_i_info = driving_template_dct['motion'][i]
-            x_d_i_info = dct2device(x_d_i_info, device)
-            R_d_i = x_d_i_info['R'] if 'R' in x_d_i_info.keys() else x_d_i_info['R_d']  # compatible with previous keys
-
-            if i == 0:  # cache the first frame
-                R_d_0 = R_d_i
-                x_d_0_info = x_d_i_info.copy()
-
-            delta_new = x_s_info['exp'].clone()
-            if inf_cfg.flag_relative_motion:
-                if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
-                    R_new = x_d_r_lst_smooth[i] if flag_is_source_video else (R_d_i @ R_d_0.permute(0, 2, 1)) @ R_s
+        mkdir(args.output_dir)
+        wfp = osp.join(args.output_dir, f'{args.output_name}.mp4')
+        animate_batch_size = max(1, self.animate_batch_size)
+        pending = []
+        writer = VideoStreamWriter(wfp, fps=output_fps)
+        with writer:
+            for i in track(range(n_frames), description='🚀Animating...', total=n_frames):
+                if flag_is_source_video:  # source video
+                    x_s_info = source_template_dct['motion'][i]
+                    x_s_info = dct2device(x_s_info, device)
+
+                    source_lmk = source_lmk_crop_lst[i]
+                    img_crop_256x256 = img_crop_256x256_lst[i]
+                    I_s = I_s_lst[i]
+                    f_s = self.live_portrait_wrapper.extract_feature_3d(I_s)
+
+                    x_c_s = x_s_info['kp']
+                    R_s = x_s_info['R']
+                    x_s =x_s_info['x_s']
+
+                    # let lip-open scalar to be 0 at first if the input is a video
+                    if flag_normalize_lip and inf_cfg.flag_relative_motion and source_lmk is not None:
+                        c_d_lip_before_animation = [0.]
+                        combined_lip_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_before_animation, source_lmk)
+                        if combined_lip_ratio_tensor_before_animation[0][0] >= inf_cfg.lip_normalize_threshold:
+                            lip_delta_before_animation = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor_before_animation)
+                        else:
+                            lip_delta_before_animation = None
+
+                    # let eye-open scalar to be the same as the first frame if the latter is eye-open state
+                    if flag_source_video_eye_retargeting and source_lmk is not None:
+                        if i == 0:
+                            combined_eye_ratio_tensor_frame_zero = c_s_eyes_lst[0]
+                            c_d_eye_before_animation_frame_zero = [[combined_eye_ratio_tensor_frame_zero[0][:2].mean()]]
+                            if c_d_eye_before_animation_frame_zero[0][0] < inf_cfg.source_video_eye_retargeting_threshold:
+                                c_d_eye_before_animation_frame_zero = [[0.39]]
+                        combined_eye_ratio_tensor_before_animation = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eye_before_animation_frame_zero, source_lmk)
+                        eye_delta_before_animation = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor_before_animation)
+
+                    if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:  # prepare for paste back
+                        mask_ori_float = prepare_paste_back(inf_cfg.mask_crop, source_M_c2o_lst[i], dsize=(source_rgb_lst[i].shape[1], source_rgb_lst[i].shape[0]))
+                if flag_is_source_video and not flag_is_driving_video:
+                    x_d_i_info = driving_template_dct['motion'][0]
                 else:
-                    R_new = R_s
-                if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "exp":
-                    if flag_is_source_video:
-                        for idx in [1,2,6,11,12,13,14,15,16,17,18,19,20]:
-                            delta_new[:, idx, :] = x_d_exp_lst_smooth[i][idx, :]
-                        delta_new[:, 3:5, 1] = x_d_exp_lst_smooth[i][3:5, 1]
-                        delta_new[:, 5, 2] = x_d_exp_lst_smooth[i][5, 2]
-                        delta_new[:, 8, 2] = x_d_exp_lst_smooth[i][8, 2]
-                        delta_new[:, 9, 1:] = x_d_exp_lst_smooth[i][9, 1:]
+                    x_d_i_info = driving_template_dct['motion'][i]
+                x_d_i_info = dct2device(x_d_i_info, device)
+                R_d_i = x_d_i_info['R'] if 'R' in x_d_i_info.keys() else x_d_i_info['R_d']  # compatible with previous keys
+
+                if i == 0:  # cache the first frame
+                    R_d_0 = R_d_i
+                    x_d_0_info = x_d_i_info.copy()
+
+                delta_new = x_s_info['exp'].clone()
+                if inf_cfg.flag_relative_motion:
+                    if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
+                        R_new = x_d_r_lst_smooth[i] if flag_is_source_video else (R_d_i @ R_d_0.permute(0, 2, 1)) @ R_s
                     else:
-                        if flag_is_driving_video:
-                            delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
-                        else:
-                            delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - torch.from_numpy(inf_cfg.lip_array).to(dtype=torch.float32, device=device))
-                elif inf_cfg.animation_region == "lip":
-                    for lip_idx in [6, 12, 14, 17, 19, 20]:
+                        R_new = R_s
+                    if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "exp":
                         if flag_is_source_video:
-                            delta_new[:, lip_idx, :] = x_d_exp_lst_smooth[i][lip_idx, :]
-                        elif flag_is_driving_video:
-                            delta_new[:, lip_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp']))[:, lip_idx, :]
+                            for idx in [1,2,6,11,12,13,14,15,16,17,18,19,20]:
+                                delta_new[:, idx, :] = x_d_exp_lst_smooth[i][idx, :]
+                            delta_new[:, 3:5, 1] = x_d_exp_lst_smooth[i][3:5, 1]
+                            delta_new[:, 5, 2] = x_d_exp_lst_smooth[i][5, 2]
+                            delta_new[:, 8, 2] = x_d_exp_lst_smooth[i][8, 2]
+                            delta_new[:, 9, 1:] = x_d_exp_lst_smooth[i][9, 1:]
                         else:
-                            delta_new[:, lip_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - torch.from_numpy(inf_cfg.lip_array).to(dtype=torch.float32, device=device)))[:, lip_idx, :]
-                elif inf_cfg.animation_region == "eyes":
-                    for eyes_idx in [11, 13, 15, 16, 18]:
-                        if flag_is_source_video:
-                            delta_new[:, eyes_idx, :] = x_d_exp_lst_smooth[i][eyes_idx, :]
-                        elif flag_is_driving_video:
-                            delta_new[:, eyes_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp']))[:, eyes_idx, :]
-                        else:
-                            delta_new[:, eyes_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - 0))[:, eyes_idx, :]
-                if inf_cfg.animation_region == "all":
-                    scale_new = x_s_info['scale'] if flag_is_source_video else x_s_info['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
+                            if flag_is_driving_video:
+                                delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp'])
+                            else:
+                                delta_new = x_s_info['exp'] + (x_d_i_info['exp'] - torch.from_numpy(inf_cfg.lip_array).to(dtype=torch.float32, device=device))
+                    elif inf_cfg.animation_region == "lip":
+                        for lip_idx in [6, 12, 14, 17, 19, 20]:
+                            if flag_is_source_video:
+                                delta_new[:, lip_idx, :] = x_d_exp_lst_smooth[i][lip_idx, :]
+                            elif flag_is_driving_video:
+                                delta_new[:, lip_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp']))[:, lip_idx, :]
+                            else:
+                                delta_new[:, lip_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - torch.from_numpy(inf_cfg.lip_array).to(dtype=torch.float32, device=device)))[:, lip_idx, :]
+                    elif inf_cfg.animation_region == "eyes":
+                        for eyes_idx in [11, 13, 15, 16, 18]:
+                            if flag_is_source_video:
+                                delta_new[:, eyes_idx, :] = x_d_exp_lst_smooth[i][eyes_idx, :]
+                            elif flag_is_driving_video:
+                                delta_new[:, eyes_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - x_d_0_info['exp']))[:, eyes_idx, :]
+                            else:
+                                delta_new[:, eyes_idx, :] = (x_s_info['exp'] + (x_d_i_info['exp'] - 0))[:, eyes_idx, :]
+                    if inf_cfg.animation_region == "all":
+                        scale_new = x_s_info['scale'] if flag_is_source_video else x_s_info['scale'] * (x_d_i_info['scale'] / x_d_0_info['scale'])
+                    else:
+                        scale_new = x_s_info['scale']
+                    if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
+                        t_new = x_s_info['t'] if flag_is_source_video else x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
+                    else:
+                        t_new = x_s_info['t']
                 else:
+                    if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
+                        R_new = x_d_r_lst_smooth[i] if flag_is_source_video else R_d_i
+                    else:
+                        R_new = R_s
+                    if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "exp":
+                        for idx in [1,2,6,11,12,13,14,15,16,17,18,19,20]:
+                            delta_new[:, idx, :] = x_d_exp_lst_smooth[i][idx, :] if flag_is_source_video else x_d_i_info['exp'][:, idx, :]
+                        delta_new[:, 3:5, 1] = x_d_exp_lst_smooth[i][3:5, 1] if flag_is_source_video else x_d_i_info['exp'][:, 3:5, 1]
+                        delta_new[:, 5, 2] = x_d_exp_lst_smooth[i][5, 2] if flag_is_source_video else x_d_i_info['exp'][:, 5, 2]
+                        delta_new[:, 8, 2] = x_d_exp_lst_smooth[i][8, 2] if flag_is_source_video else x_d_i_info['exp'][:, 8, 2]
+                        delta_new[:, 9, 1:] = x_d_exp_lst_smooth[i][9, 1:] if flag_is_source_video else x_d_i_info['exp'][:, 9, 1:]
+                    elif inf_cfg.animation_region == "lip":
+                        for lip_idx in [6, 12, 14, 17, 19, 20]:
+                            delta_new[:, lip_idx, :] = x_d_exp_lst_smooth[i][lip_idx, :] if flag_is_source_video else x_d_i_info['exp'][:, lip_idx, :]
+                    elif inf_cfg.animation_region == "eyes":
+                        for eyes_idx in [11, 13, 15, 16, 18]:
+                            delta_new[:, eyes_idx, :] = x_d_exp_lst_smooth[i][eyes_idx, :] if flag_is_source_video else x_d_i_info['exp'][:, eyes_idx, :]
                     scale_new = x_s_info['scale']
-                if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
-                    t_new = x_s_info['t'] if flag_is_source_video else x_s_info['t'] + (x_d_i_info['t'] - x_d_0_info['t'])
-                else:
-                    t_new = x_s_info['t']
-            else:
-                if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
-                    R_new = x_d_r_lst_smooth[i] if flag_is_source_video else R_d_i
-                else:
-                    R_new = R_s
-                if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "exp":
-                    for idx in [1,2,6,11,12,13,14,15,16,17,18,19,20]:
-                        delta_new[:, idx, :] = x_d_exp_lst_smooth[i][idx, :] if flag_is_source_video else x_d_i_info['exp'][:, idx, :]
-                    delta_new[:, 3:5, 1] = x_d_exp_lst_smooth[i][3:5, 1] if flag_is_source_video else x_d_i_info['exp'][:, 3:5, 1]
-                    delta_new[:, 5, 2] = x_d_exp_lst_smooth[i][5, 2] if flag_is_source_video else x_d_i_info['exp'][:, 5, 2]
-                    delta_new[:, 8, 2] = x_d_exp_lst_smooth[i][8, 2] if flag_is_source_video else x_d_i_info['exp'][:, 8, 2]
-                    delta_new[:, 9, 1:] = x_d_exp_lst_smooth[i][9, 1:] if flag_is_source_video else x_d_i_info['exp'][:, 9, 1:]
-                elif inf_cfg.animation_region == "lip":
-                    for lip_idx in [6, 12, 14, 17, 19, 20]:
-                        delta_new[:, lip_idx, :] = x_d_exp_lst_smooth[i][lip_idx, :] if flag_is_source_video else x_d_i_info['exp'][:, lip_idx, :]
-                elif inf_cfg.animation_region == "eyes":
-                    for eyes_idx in [11, 13, 15, 16, 18]:
-                        delta_new[:, eyes_idx, :] = x_d_exp_lst_smooth[i][eyes_idx, :] if flag_is_source_video else x_d_i_info['exp'][:, eyes_idx, :]
-                scale_new = x_s_info['scale']
-                if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
-                    t_new = x_d_i_info['t']
-                else:
-                    t_new = x_s_info['t']
-
-            t_new[..., 2].fill_(0)  # zero tz
-            x_d_i_new = scale_new * (x_c_s @ R_new + delta_new) + t_new
-
-            if inf_cfg.flag_relative_motion and inf_cfg.driving_option == "expression-friendly" and not flag_is_source_video and flag_is_driving_video:
-                if i == 0:
-                    x_d_0_new = x_d_i_new
-                    motion_multiplier = calc_motion_multiplier(x_s, x_d_0_new)
-                    # motion_multiplier *= inf_cfg.driving_multiplier
-                x_d_diff = (x_d_i_new - x_d_0_new) * motion_multiplier
-                x_d_i_new = x_d_diff + x_s
-
-            # Algorithm 1:
-            if not inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
-                # without stitching or retargeting
-                if flag_normalize_lip and lip_delta_before_animation is not None:
-                    x_d_i_new += lip_delta_before_animation
-                if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
-                    x_d_i_new += eye_delta_before_animation
-                else:
-                    pass
-            elif inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
-                # with stitching and without retargeting
-                if flag_normalize_lip and lip_delta_before_animation is not None:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new) + lip_delta_before_animation
-                else:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
-                if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
-                    x_d_i_new += eye_delta_before_animation
-            else:
-                eyes_delta, lip_delta = None, None
-                if inf_cfg.flag_eye_retargeting and source_lmk is not None:
-                    c_d_eyes_i = c_d_eyes_lst[i]
-                    combined_eye_ratio_tensor = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eyes_i, source_lmk)
-                    # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
-                    eyes_delta = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor)
-                if inf_cfg.flag_lip_retargeting and source_lmk is not None:
-                    c_d_lip_i = c_d_lip_lst[i]
-                    combined_lip_ratio_tensor = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_i, source_lmk)
-                    # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
-                    lip_delta = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor)
-
-                if inf_cfg.flag_relative_motion:  # use x_s
-                    x_d_i_new = x_s + \
-                        (eyes_delta if eyes_delta is not None else 0) + \
-                        (lip_delta if lip_delta is not None else 0)
-                else:  # use x_d,i
-                    x_d_i_new = x_d_i_new + \
-                        (eyes_delta if eyes_delta is not None else 0) + \
-                        (lip_delta if lip_delta is not None else 0)
-
-                if inf_cfg.flag_stitching:
-                    x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
-
-            x_d_i_new = x_s + (x_d_i_new - x_s) * inf_cfg.driving_multiplier
-            out = self.live_portrait_wrapper.warp_decode(f_s, x_s, x_d_i_new)
-            I_p_i = self.live_portrait_wrapper.parse_output(out['out'])[0]
-            I_p_lst.append(I_p_i)
+                    if inf_cfg.animation_region == "all" or inf_cfg.animation_region == "pose":
+                        t_new = x_d_i_info['t']
+                    else:
+                        t_new = x_s_info['t']
 
-            if inf_cfg.flag_pasteback and inf_cfg.flag_do_crop and inf_cfg.flag_stitching:
-                # TODO: the paste back procedure is slow, considering optimize it using multi-threading or GPU
-                if flag_is_source_video:
-                    I_p_pstbk = paste_back(I_p_i, source_M_c2o_lst[i], source_rgb_lst[i], mask_ori_float)
+                t_new[..., 2].fill_(0)  # zero tz
+                x_d_i_new = scale_new * (x_c_s @ R_new + delta_new) + t_new
+
+                if inf_cfg.flag_relative_motion and inf_cfg.driving_option == "expression-friendly" and not flag_is_source_video and flag_is_driving_video:
+                    if i == 0:
+                        x_d_0_new = x_d_i_new
+                        motion_multiplier = calc_motion_multiplier(x_s, x_d_0_new)
+                        # motion_multiplier *= inf_cfg.driving_multiplier
+                    x_d_diff = (x_d_i_new - x_d_0_new) * motion_multiplier
+                    x_d_i_new = x_d_diff + x_s
+
+                # Algorithm 1:
+                if not inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
+                    # without stitching or retargeting
+                    if flag_normalize_lip and lip_delta_before_animation is not None:
+                        x_d_i_new += lip_delta_before_animation
+                    if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
+                        x_d_i_new += eye_delta_before_animation
+                    else:
+                        pass
+                elif inf_cfg.flag_stitching and not inf_cfg.flag_eye_retargeting and not inf_cfg.flag_lip_retargeting:
+                    # with stitching and without retargeting
+                    if flag_normalize_lip and lip_delta_before_animation is not None:
+                        x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new) + lip_delta_before_animation
+                    else:
+                        x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
+                    if flag_source_video_eye_retargeting and eye_delta_before_animation is not None:
+                        x_d_i_new += eye_delta_before_animation
                 else:
-                    I_p_pstbk = paste_back(I_p_i, crop_info['M_c2o'], source_rgb_lst[0], mask_ori_float)
-                I_p_pstbk_lst.append(I_p_pstbk)
+                    eyes_delta, lip_delta = None, None
+                    if inf_cfg.flag_eye_retargeting and source_lmk is not None:
+                        c_d_eyes_i = c_d_eyes_lst[i]
+                        combined_eye_ratio_tensor = self.live_portrait_wrapper.calc_combined_eye_ratio(c_d_eyes_i, source_lmk)
+                        # ∆_eyes,i = R_eyes(x_s; c_s,eyes, c_d,eyes,i)
+                        eyes_delta = self.live_portrait_wrapper.retarget_eye(x_s, combined_eye_ratio_tensor)
+                    if inf_cfg.flag_lip_retargeting and source_lmk is not None:
+                        c_d_lip_i = c_d_lip_lst[i]
+                        combined_lip_ratio_tensor = self.live_portrait_wrapper.calc_combined_lip_ratio(c_d_lip_i, source_lmk)
+                        # ∆_lip,i = R_lip(x_s; c_s,lip, c_d,lip,i)
+                        lip_delta = self.live_portrait_wrapper.retarget_lip(x_s, combined_lip_ratio_tensor)
+
+                    if inf_cfg.flag_relative_motion:  # use x_s
+                        x_d_i_new = x_s + \
+                            (eyes_delta if eyes_delta is not None else 0) + \
+                            (lip_delta if lip_delta is not None else 0)
+                    else:  # use x_d,i
+                        x_d_i_new = x_d_i_new + \
+                            (eyes_delta if eyes_delta is not None else 0) + \
+                            (lip_delta if lip_delta is not None else 0)
+
+                    if inf_cfg.flag_stitching:
+                        x_d_i_new = self.live_portrait_wrapper.stitching(x_s, x_d_i_new)
+
+                x_d_i_new = x_s + (x_d_i_new - x_s) * inf_cfg.driving_multiplier
+                pending.append({'i': i, 'f_s': f_s, 'x_s': x_s, 'x_d': x_d_i_new, 'mask': mask_ori_float if flag_pasteback else None})
+                if len(pending) == animate_batch_size or i == n_frames - 1:
+                    render(pending)
+                    pending = []
+                    if progress_callback is not None:
+                        progress_callback('animate', writer.n_frames, n_frames)
 
-        mkdir(args.output_dir)
         wfp_concat = None
-        ######### build the final concatenation result #########
-        # driving frame | source frame | generation
-
-        # save the animated result
-        wfp = osp.join(args.output_dir, f'{args.output_name}.mp4')
-        if I_p_pstbk_lst is not None and len(I_p_pstbk_lst) > 0:
-            images2video(I_p_pstbk_lst, wfp=wfp, fps=output_fps)
-        else:
-            images2video(I_p_lst, wfp=wfp, fps=output_fps)
 
         # final log
         if wfp_template not in (None, ''):
@@ -0,0 +1,123 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+# coding: utf-8
+
+"""
+Wrapper of the LivePortrait modules exported to OpenVINO IR by export_openvino.py
+"""
+
+import contextlib
+import hashlib
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+from .config.inference_config import InferenceConfig
+from .live_portrait_wrapper import LivePortraitWrapper
+from .utils.timer import Timer
+from .utils.rprint import rlog as log
+
+OPENVINO_DIR = osp.join(osp.dirname(osp.realpath(__file__)), '../pretrained_weights/liveportrait/openvino')
+# Output order of the exported motion extractor, which returns a dict in torch
+MOTION_KEYS = ['pitch', 'yaw', 'roll', 't', 'exp', 'scale', 'kp']
+BASE_MODELS = ['appearance_feature_extractor', 'motion_extractor', 'warping_module', 'spade_generator']
+STITCHING_MODELS = ['stitching', 'eye', 'lip']
+
+
+def get_openvino_path(name, model_dir=OPENVINO_DIR):
+    return osp.join(model_dir, f'{name}.xml')
+
+
+def openvino_models_exist(model_dir=OPENVINO_DIR):
+    return all(osp.exists(get_openvino_path(name, model_dir)) for name in BASE_MODELS + STITCHING_MODELS)
+
+
+def get_model_id(name, model_dir=OPENVINO_DIR):
+    """Identify an exported IR: the hash of its graph, which records the weight
+    precision, and the size and modification time of its weights, which change
+    on every export."""
+    xml_path = get_openvino_path(name, model_dir)
+    bin_path = osp.splitext(xml_path)[0] + '.bin'
+    with open(xml_path, 'rb') as f:
+        digest = hashlib.sha256(f.read())
+    if osp.exists(bin_path):
+        stat = os.stat(bin_path)
+        digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+
+class OVModule(object):
+    """Call a compiled model like the torch module it was exported from.
+
+    Args:
+        compiled_model: OpenVINO compiled model.
+        output_keys (list[str]): Return a dict of the outputs under these keys
+            instead of the single output tensor.
+    """
+
+    def __init__(self, compiled_model, output_keys=None):
+        self.compiled_model = compiled_model
+        self.output_keys = output_keys
+
+    def __call__(self, *args, **kwargs):
+        # keyword arguments are passed in the order of the exported forward()
+        inputs = [np.ascontiguousarray(x.detach().float().cpu().numpy()) for x in list(args) + list(kwargs.values())]
+        # a request per call, so concurrent pipelines can share the compiled model
+        results = self.compiled_model.create_infer_request().infer(inputs)
+        outputs = [torch.from_numpy(np.array(results[output])) for output in self.compiled_model.outputs]
+        if self.output_keys is None:
+            return outputs[0]
+        return dict(zip(self.output_keys, outputs))
+
+
+class OVLivePortraitWrapper(LivePortraitWrapper):
+    """LivePortraitWrapper running the appearance feature extractor, motion
+    extractor, warping module, SPADE generator and stitching MLPs on an
+    OpenVINO device. Tensors stay on the host, the keypoint math between the
+    modules is done by torch on the CPU.
+
+    Args:
+        inference_cfg (InferenceConfig): Inference settings, half precision is ignored.
+        device (str): OpenVINO device. Default: CPU.
+        model_dir (str): Folder of the IRs written by export_openvino.py.
+    """
+
+    def __init__(self, inference_cfg: InferenceConfig, device='CPU', model_dir=OPENVINO_DIR):
+        import openvino as ov
+        import openvino.properties as props
+        import openvino.properties.hint as hints
+
+        self.inference_cfg = inference_cfg
+        self.device_id = inference_cfg.device_id
+        self.compile = False
+        self.device = 'cpu'
+        self.ov_device = device
+
+        core = ov.Core()
+        core.set_property({props.cache_dir: f'./cache/{device}'})
+        config = {hints.performance_mode: hints.PerformanceMode.LATENCY}
+
+        def compile_model(name):
+            model_path = get_openvino_path(name, model_dir)
+            compiled_model = core.compile_model(model_path, device, config)
+            log(f'Load {name} from {osp.realpath(model_path)} on {device} done.')
+            return compiled_model
+
+        self.appearance_feature_extractor = OVModule(compile_model('appearance_feature_extractor'))
+        self.motion_extractor = OVModule(compile_model('motion_extractor'), output_keys=MOTION_KEYS)
+        # the motion templates depend on the exported motion extractor, e.g. FP32 or int8
+        self.motion_model_id = get_model_id('motion_extractor', model_dir)
+        self.warping_module = OVModule(compile_model('warping_module'), output_keys=['out'])
+        self.spade_generator = OVModule(compile_model('spade_generator'))
+        if all(osp.exists(get_openvino_path(name, model_dir)) for name in STITCHING_MODELS):
+            self.stitching_retargeting_module = {name: OVModule(compile_model(name)) for name in STITCHING_MODELS}
+        else:
+            self.stitching_retargeting_module = None
+        self.timer = Timer()
+
+    def inference_ctx(self):
+        # the precision is the one of the OpenVINO device, not of torch autocast
+        return contextlib.nullcontext()
@@ -0,0 +1,51 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+# coding: utf-8
+
+"""
+Streaming counterpart of images2video: frames are encoded as they are produced
+instead of being collected in a list first
+"""
+
+import os
+import os.path as osp
+
+import imageio
+
+
+class VideoStreamWriter(object):
+    """Encode RGB frames to a video file one at a time, with the settings of ``images2video``."""
+
+    def __init__(self, wfp, fps=30, format='mp4', codec='libx264', quality=None, crf=18,
+                 pixelformat='yuv420p', image_mode='rgb', macro_block_size=2):
+        wd = osp.split(wfp)[0]
+        if wd != '' and not osp.exists(wd):
+            os.makedirs(wd, exist_ok=True)
+        self.wfp = wfp
+        self.image_mode = image_mode
+        self.n_frames = 0
+        self.writer = imageio.get_writer(
+            wfp, fps=fps, format=format, codec=codec, quality=quality, ffmpeg_params=['-crf', str(crf)],
+            pixelformat=pixelformat, macro_block_size=macro_block_size
+        )
+
+    def append(self, image):
+        if self.image_mode.lower() == 'bgr':
+            image = image[..., ::-1]
+        self.writer.append_data(image)
+        self.n_frames += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        if exc_type is not None and osp.exists(self.wfp):
+            # do not leave a truncated video behind
+            os.remove(self.wfp)
@@ -0,0 +1,46 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Parity of the OpenVINO IRs with the torch LivePortrait modules.
+
+Runs after setup.sh has prepared ``liveportrait`` and the checkpoints are
+downloaded, skipped otherwise:
+
+    python3 -m pytest tests/test_export_openvino.py
+"""
+
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(BACKEND_DIR)
+
+pytest.importorskip("torch")
+pytest.importorskip("openvino")
+if not os.path.exists(os.path.join(BACKEND_DIR, 'liveportrait', 'export_openvino.py')):
+    pytest.skip("liveportrait is not set up, run setup.sh", allow_module_level=True)
+
+from liveportrait.export_openvino import check_models, export_models
+from liveportrait.src.config.inference_config import InferenceConfig
+from liveportrait.src.live_portrait_wrapper_ov import OPENVINO_DIR, openvino_models_exist
+
+
+def checkpoints_exist():
+    cfg = InferenceConfig()
+    return all(os.path.exists(path) for path in [cfg.checkpoint_F, cfg.checkpoint_M, cfg.checkpoint_W, cfg.checkpoint_G])
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    if not checkpoints_exist():
+        pytest.skip("LivePortrait checkpoints are not downloaded")
+    if openvino_models_exist(OPENVINO_DIR):
+        return OPENVINO_DIR
+    return export_models(str(tmp_path_factory.mktemp("openvino")))
+
+
+@pytest.mark.parametrize("batch_size", [1, 4])
+def test_openvino_models_match_torch(model_dir, batch_size):
+    assert check_models(model_dir, device="CPU", batch_size=batch_size)
@@ -0,0 +1,98 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Compare full resolution skin face detection with the downscaled detection pyramid.
+
+For every skin the S3FD boxes of all frames are detected at full resolution and
+at ``--scale``, and the report shows the speedup, the frames that needed a full
+resolution refinement and the IoU drift of the boxes:
+
+    python3 benchmarks/face_detection_pyramid.py --scale 0.25 assets/avatar-skins/*.mp4
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import glob
+import time
+
+import cv2
+import numpy as np
+import openvino as ov
+import openvino.properties.hint as hints
+
+from wav2lip.ov_wav2lip import LandmarksType, OVFaceAlignment
+
+
+def read_frames(skin_path, max_frames):
+    video_stream = cv2.VideoCapture(skin_path)
+    frames = []
+    while max_frames is None or len(frames) < max_frames:
+        still_reading, frame = video_stream.read()
+        if not still_reading:
+            break
+        frames.append(frame)
+    video_stream.release()
+    if not frames:
+        raise ValueError(f"Unable to read frames from {skin_path}")
+    return np.array(frames)
+
+
+def box_iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    intersection = max(x2 - x1, 0) * max(y2 - y1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.
+
+
+def detect(detector, frames, batch_size):
+    # The first batch pays for memory allocation and kernel compilation
+    detector.get_detections_for_batch(frames[:batch_size])
+    detector.refined = 0
+    start = time.perf_counter()
+    boxes = []
+    for i in range(0, len(frames), batch_size):
+        boxes += detector.get_detections_for_batch(frames[i:i + batch_size])
+    return boxes, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('skins', nargs='*', help='Skin videos. Default: the bundled skins')
+    parser.add_argument('--scale', type=float, default=0.25)
+    parser.add_argument('--refine_threshold', type=float, default=0.9)
+    parser.add_argument('--model', default='wav2lip/checkpoints/face_detection.xml', help='OpenVINO face detection model')
+    parser.add_argument('--device', default='CPU')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_frames', type=int, default=None)
+    args = parser.parse_args()
+
+    skins = args.skins or sorted(glob.glob('assets/avatar-skins/*.mp4'))
+    if not skins:
+        parser.error("No skins given and none found in assets/avatar-skins")
+
+    face_detector = ov.Core().compile_model(args.model, args.device,
+                                            {hints.performance_mode: hints.PerformanceMode.LATENCY})
+    full = OVFaceAlignment(LandmarksType._2D, face_detector=face_detector, device=args.device)
+    pyramid = OVFaceAlignment(LandmarksType._2D, face_detector=face_detector, device=args.device,
+                              detection_scale=args.scale, refine_threshold=args.refine_threshold)
+
+    for skin in skins:
+        frames = read_frames(skin, args.max_frames)
+        full_boxes, full_time = detect(full, frames, args.batch_size)
+        pyramid_boxes, pyramid_time = detect(pyramid, frames, args.batch_size)
+
+        ious = [box_iou(a, b) for a, b in zip(full_boxes, pyramid_boxes) if a is not None and b is not None]
+        missed = sum((a is None) != (b is None) for a, b in zip(full_boxes, pyramid_boxes))
+        print(f"{os.path.basename(skin)}: {len(frames)} frames {frames.shape[2]}x{frames.shape[1]}, "
+              f"full {full_time:.2f}s, scale {args.scale} {pyramid_time:.2f}s ({full_time / pyramid_time:.1f}x), "
+              f"refined {pyramid.refined}, IoU mean {np.mean(ious):.4f} min {np.min(ious):.4f}, "
+              f"detection mismatches {missed}")
+
+
+if __name__ == "__main__":
+    main()
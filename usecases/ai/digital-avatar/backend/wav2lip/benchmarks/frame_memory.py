@@ -0,0 +1,126 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Compare the peak RSS of the list-copying frame handling with the indexed frame store.
+
+Every mode runs in its own subprocess on a synthetic 1080p skin and pushes the
+frames of a clip through datagen and the blend, holding as many prepared
+batches as the inference pipeline keeps in flight:
+
+    python3 benchmarks/frame_memory.py --skin_frames 125 --clip_frames 500
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import json
+import resource
+import subprocess
+from collections import deque
+from types import SimpleNamespace
+
+import numpy as np
+
+from wav2lip.ov_wav2lip import OVWav2Lip
+from wav2lip.blending import blend_batch, get_blend_executor
+
+FACE_BOX = (400, 700, 810, 1110)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def legacy_get_full_frames_and_face_det_results(full_frames, face_det_results, reverse=False, double=False):
+    """Frame list handling of OVWav2Lip before the indexed frame store."""
+    if reverse:
+        full_frames = full_frames.copy()[::-1]
+        face_det_results = face_det_results.copy()[::-1]
+    else:
+        full_frames = full_frames.copy()
+        face_det_results = face_det_results.copy()
+
+    if double:
+        full_frames = full_frames + full_frames[::-1]
+        face_det_results = face_det_results + face_det_results[::-1]
+
+    return full_frames, face_det_results
+
+
+def legacy_datagen(frames, mels, face_det_results, face_tensor, batch_size, start_index=0):
+    """Frame side of the datagen that copied the full frame for every mel chunk."""
+    num_frames = len(frames)
+    for batch_start in range(0, len(mels), batch_size):
+        indices = (start_index + batch_start + np.arange(len(mels[batch_start:batch_start + batch_size]))) % num_frames
+        img_batch = face_tensor[indices % len(face_tensor)]
+        mel_batch = np.asarray(mels[batch_start:batch_start + batch_size], dtype=np.float32)[:, np.newaxis]
+        frame_batch = [frames[idx].copy() for idx in indices]
+        coords_batch = [face_det_results[idx][1] for idx in indices]
+        yield img_batch, mel_batch, frame_batch, coords_batch, np.arange(len(indices))
+
+
+def run_mode(mode, args):
+    rng = np.random.default_rng(0)
+    face_tensor = np.zeros((args.skin_frames, 6, 96, 96), dtype=np.float32)
+    mels = np.zeros((args.clip_frames, 80, 16), dtype=np.float32)
+
+    if mode == "legacy":
+        full_frames = [rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8) for _ in range(args.skin_frames)]
+        face_det_results = [[None, FACE_BOX] for _ in range(args.skin_frames)]
+        skin_rss = peak_rss_mb()
+        frames, face_det_results = legacy_get_full_frames_and_face_det_results(
+            full_frames, face_det_results, reverse=False, double=True)
+        gen = legacy_datagen(frames.copy(), mels, face_det_results, face_tensor, args.batch_size)
+    else:
+        frame_store = rng.integers(0, 256, (args.skin_frames, 1080, 1920, 3), dtype=np.uint8)
+        frame_store.setflags(write=False)
+        skin_rss = peak_rss_mb()
+        wav2lip = SimpleNamespace(
+            frame_store=frame_store, face_tensor=face_tensor, wav2lip_batch_size=args.batch_size,
+            face_boxes=np.tile(np.array(FACE_BOX), (args.skin_frames, 1)))
+        gen = OVWav2Lip.datagen(wav2lip, mels, OVWav2Lip.get_frame_order(wav2lip, double=True))
+
+    executor = get_blend_executor("thread")
+    pred = rng.uniform(0, 255, (args.batch_size, 96, 96, 3)).astype(np.float32)
+    in_flight = deque()
+    frames_generated = 0
+    for batch in gen:
+        in_flight.append(batch)
+        if len(in_flight) > args.infer_requests:
+            _, _, frames, coords, _ = in_flight.popleft()
+            frames_generated += len(blend_batch(executor, args.blend_mode, pred[:len(frames)], frames, coords))
+    while in_flight:
+        _, _, frames, coords, _ = in_flight.popleft()
+        frames_generated += len(blend_batch(executor, args.blend_mode, pred[:len(frames)], frames, coords))
+
+    return {"mode": mode, "frames": frames_generated, "skin_rss_mb": round(skin_rss, 1), "peak_rss_mb": round(peak_rss_mb(), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--skin_frames', type=int, default=125)
+    parser.add_argument('--clip_frames', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--infer_requests', type=int, default=2)
+    parser.add_argument('--blend_mode', default='seamless', choices=['seamless', 'alpha'])
+    parser.add_argument('--mode', choices=['legacy', 'indexed'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args)))
+        return
+
+    for mode in ["legacy", "indexed"]:
+        output = subprocess.run([sys.executable, __file__, '--mode', mode] + sys.argv[1:],
+                                check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{mode:>8}: skin {result['skin_rss_mb']:.0f} MB, peak {result['peak_rss_mb']:.0f} MB, "
+              f"pipeline overhead {result['peak_rss_mb'] - result['skin_rss_mb']:.0f} MB "
+              f"({result['frames']} frames)")
+
+
+if __name__ == "__main__":
+    main()
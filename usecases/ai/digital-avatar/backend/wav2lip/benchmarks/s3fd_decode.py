@@ -0,0 +1,159 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Compare the per-anchor S3FD box decoding with the vectorized decoding.
+
+Both implementations run on the same tensor dump of the 12 raw S3FD outputs.
+Record a dump from a real skin with:
+
+    python3 benchmarks/s3fd_decode.py --record assets/avatar-skins/default.mp4
+
+Without a dump a deterministic synthetic one is generated.
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from wav2lip.ov_wav2lip import OVSFDDetector
+
+DEFAULT_DUMP = os.path.join(os.path.dirname(__file__), 's3fd_outputs.npz')
+
+
+def legacy_batch_decode(olist):
+    """The per-anchor decoding loop OVSFDDetector.batch_detect used before vectorization."""
+    olist = [torch.Tensor(o) for o in olist]
+    BB = olist[0].size(0)
+    bboxlist = []
+    for i in range(len(olist) // 2):
+        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
+    for i in range(len(olist) // 2):
+        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
+        stride = 2**(i + 2)    # 4,8,16,32,64,128
+        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
+        for Iindex, hindex, windex in poss:
+            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
+            score = ocls[:, 1, hindex, windex]
+            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
+            priors = torch.Tensor(
+                [[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
+            variances = [0.1, 0.2]
+            box = torch.cat((
+                priors[:, :, :2] + loc[:, :, :2] * variances[0] * priors[:, :, 2:],
+                priors[:, :, 2:] * torch.exp(loc[:, :, 2:] * variances[1])), 2)
+            box[:, :, :2] -= box[:, :, 2:] / 2
+            box[:, :, 2:] += box[:, :, :2]
+            bboxlist.append(
+                torch.cat([box[:, 0], score.unsqueeze(1)], 1).cpu().numpy())
+    bboxlist = np.array(bboxlist)
+    if 0 == len(bboxlist):
+        bboxlist = np.zeros((1, BB, 5))
+
+    return bboxlist
+
+
+def legacy_detect(detector, olist):
+    bboxlists = legacy_batch_decode(olist)
+    keeps = [detector.nms(bboxlists[:, i, :], 0.3)
+             for i in range(bboxlists.shape[1])]
+    bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
+    return [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
+
+
+def vectorized_detect(detector, olist):
+    bboxlists = detector.decode_outputs(olist)
+    bboxlists = [bboxlist[bboxlist[:, 4] > 0.5] for bboxlist in bboxlists]
+    return detector.batch_nms(bboxlists, 0.3)
+
+
+def record_dump(skin_path, dump_path, batch_size, model_path):
+    import openvino as ov
+
+    video_stream = cv2.VideoCapture(skin_path)
+    frames = []
+    while len(frames) < batch_size:
+        still_reading, frame = video_stream.read()
+        if not still_reading:
+            break
+        frames.append(frame)
+    video_stream.release()
+    if not frames:
+        raise ValueError(f"Unable to read frames from {skin_path}")
+
+    net = ov.Core().compile_model(model_path, "CPU")
+    imgs = np.array(frames)[..., ::-1] - np.array([104, 117, 123])
+    results = net({"x": imgs.transpose(0, 3, 1, 2).astype(np.float32)})
+    np.savez(dump_path, *[results[i] for i in range(12)])
+    print(f"Recorded S3FD outputs of {len(frames)} frames to {dump_path}")
+
+
+def synthetic_outputs(batch_size, height=768, width=576, seed=0):
+    rng = np.random.default_rng(seed)
+    olist = []
+    for i in range(6):
+        stride = 2**(i + 2)
+        feature_h, feature_w = height // stride, width // stride
+        ocls = np.zeros((batch_size, 2, feature_h, feature_w), dtype=np.float32)
+        ocls[:, 1] = rng.normal(-6, 1.5, (batch_size, feature_h, feature_w))
+        # a confident face in the middle of every level
+        cy, cx = feature_h // 2, feature_w // 2
+        ocls[:, 1, max(cy - 2, 0):cy + 3, max(cx - 2, 0):cx + 3] += 9
+        oreg = rng.normal(0, 0.5, (batch_size, 4, feature_h, feature_w)).astype(np.float32)
+        olist += [ocls, oreg]
+    return olist
+
+
+def benchmark(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, np.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dump', default=DEFAULT_DUMP, help='Path of the S3FD output dump')
+    parser.add_argument('--record', metavar='SKIN', help='Record the dump from the frames of this skin first')
+    parser.add_argument('--model', default='wav2lip/checkpoints/face_detection.xml', help='OpenVINO face detection model')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.record:
+        record_dump(args.record, args.dump, args.batch_size, args.model)
+
+    if os.path.isfile(args.dump):
+        with np.load(args.dump) as data:
+            olist = [data[f'arr_{i}'] for i in range(12)]
+        print(f"Using S3FD output dump {args.dump}")
+    else:
+        olist = synthetic_outputs(args.batch_size)
+        print("Using synthetic S3FD outputs")
+
+    detector = OVSFDDetector(device="CPU", face_detector=None)
+    legacy, legacy_time = benchmark(lambda: legacy_detect(detector, olist), args.repeat)
+    vectorized, vectorized_time = benchmark(lambda: vectorized_detect(detector, olist), args.repeat)
+
+    for i, (expected, actual) in enumerate(zip(legacy, vectorized)):
+        expected = np.array(expected).reshape(-1, 5)
+        if expected.shape != actual.shape or not np.allclose(expected, actual, atol=1e-3):
+            raise AssertionError(f"Detections of image {i} differ between implementations")
+
+    print(f"Images: {olist[0].shape[0]}, anchors per image: {sum(o.shape[2] * o.shape[3] for o in olist[::2])}")
+    print(f"Per-anchor loop:  {legacy_time * 1000:.2f} ms")
+    print(f"Vectorized:       {vectorized_time * 1000:.2f} ms ({legacy_time / vectorized_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
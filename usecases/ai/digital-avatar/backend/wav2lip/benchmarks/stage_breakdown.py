@@ -0,0 +1,85 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+"""Print the per-stage time breakdown of wav2lip inference on this host.
+
+Runs a skin with a synthetic speech-like audio clip, so every run of a host
+processes the same input, and reports the busy seconds of every stage (mel
+extraction, datagen, model inference, blending, frame encoding, ffmpeg mux).
+Run it from the application folder:
+
+    python3 benchmarks/stage_breakdown.py --skin assets/avatar-skins/default.mp4 --device CPU --duration 10
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from wav2lip.audio import save_pcm16_wav
+from wav2lip.ov_wav2lip import INFERENCE_STAGES, OVWav2Lip
+
+
+def synthetic_speech(duration, sr=16000, seed=0):
+    """Voiced syllables of varying pitch at about 4 per second, separated by short pauses."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+    pitch = 140 + 40 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sr
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) ** 0.5
+    wav = 0.3 * voiced * envelope + 0.01 * rng.standard_normal(len(t))
+    return (wav / np.max(np.abs(wav)) * 0.8).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--skin', default='assets/avatar-skins/default.mp4')
+    parser.add_argument('--device', default='CPU')
+    parser.add_argument('--model', default='wav2lip', choices=['wav2lip', 'wav2lip_gan'])
+    parser.add_argument('--duration', type=float, default=10., help='Seconds of synthetic audio')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--blend_mode', default='seamless', choices=['seamless', 'alpha'])
+    parser.add_argument('--video_encoder', default='ffmpeg', choices=['ffmpeg', 'opencv'])
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    wav2lip = OVWav2Lip(avatar_path=args.skin, device=args.device, model=args.model,
+                        blend_mode=args.blend_mode, video_encoder=args.video_encoder)
+    print(f"Initialized in {time.perf_counter() - start:.2f}s: batch size {wav2lip.wav2lip_batch_size}, "
+          f"{len(wav2lip.frame_store)} skin frames")
+
+    with tempfile.NamedTemporaryFile(suffix=".wav") as audio:
+        save_pcm16_wav(synthetic_speech(args.duration), audio.name, 16000)
+        # The first run pays for allocations and kernel compilation
+        file_id, _, _ = wav2lip.inference(audio.name)
+        os.remove(f"wav2lip/results/{file_id}.mp4")
+
+        stage_seconds = {stage: [] for stage in INFERENCE_STAGES}
+        totals, frames = [], 0
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            file_id, frames, stats = wav2lip.inference(audio.name)
+            totals.append(time.perf_counter() - start)
+            os.remove(f"wav2lip/results/{file_id}.mp4")
+            for stage in INFERENCE_STAGES:
+                stage_seconds[stage].append(stats["stage_seconds"].get(stage, 0.))
+    wav2lip.close()
+
+    total = float(np.median(totals))
+    print(f"\n{frames} frames, median of {args.runs} runs: {total:.2f}s, {frames / total:.1f} frames/s")
+    print(f"{'stage':>8} {'seconds':>9} {'of wall':>8}")
+    for stage, seconds in stage_seconds.items():
+        seconds = float(np.median(seconds))
+        print(f"{stage:>8} {seconds:>9.3f} {seconds / total:>8.1%}")
+    print("Stages overlap, the one closest to 100% of the wall time is the bottleneck")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,17 +11,23 @@ sys.path.append(parent_dir)
 from RealESRGan.inference import initialize
 
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, ExitStack
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi import FastAPI, UploadFile, File, APIRouter
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi import FastAPI, UploadFile, File, APIRouter, WebSocket, WebSocketDisconnect
 import tempfile
 import uvicorn
 import shutil
 import logging
-from starlette.background import BackgroundTasks
+from starlette.background import BackgroundTask, BackgroundTasks
 from wav2lip.ov_wav2lip import OVWav2Lip
+from wav2lip.realtime import RealtimeLipsync, encode_jpeg
+from wav2lip.calibration import get_calibration, load_calibration, calibration_key
+from wav2lip.metrics import METRICS
+import asyncio
+import threading
 import wave
+import weakref
 import numpy as np
 import json
 import time
@@ -33,6 +39,8 @@ import openvino as ov
 
 logger = logging.getLogger('uvicorn.error')
 WAV2LIP=None
+# Serializes configuration updates, requests never wait for it
+CONFIG_LOCK = asyncio.Lock()
 DATA_DIRECTORY="data"
 
 WAV2LIP_MODELS = ["wav2lip", "wav2lip_gan"]
@@ -53,6 +61,33 @@ CONFIG = {
     "enhancer_model": os.environ.get('ENHANCER_MODEL', "RealESRGAN_x4plus_anime_6B"),
     "avatar_skin": os.environ.get('AVATAR_SKIN', "default")
 }
+# Wav2lip batches inferring concurrently while earlier batches are blended
+INFER_REQUESTS = int(os.environ.get('INFER_REQUESTS', 2))
+# "seamless" (Poisson clone) or "alpha" (feathered mask composite, much cheaper on CPU)
+BLEND_MODE = os.environ.get('BLEND_MODE', "seamless")
+# "thread" or "process" worker pool for blending, kept for the life of the process
+BLEND_EXECUTOR = os.environ.get('BLEND_EXECUTOR', "thread")
+# "ffmpeg" pipes frames into a single encode + audio mux pass, "opencv" uses the legacy AVI + remux
+VIDEO_ENCODER = os.environ.get('VIDEO_ENCODER', "ffmpeg")
+ENCODER_PRESET = os.environ.get('ENCODER_PRESET', "veryfast")
+# Frames per model call of realtime sessions, smaller batches lower the latency
+REALTIME_BATCH_SIZE = int(os.environ.get('REALTIME_BATCH_SIZE', 4))
+# Seconds of generated frames a realtime session buffers before it stops reading audio
+REALTIME_MAX_BUFFER = float(os.environ.get('REALTIME_MAX_BUFFER', 2.0))
+# Normalized mel level (-4 is digital silence, 4 full scale) below which frames skip the model, "none" disables it
+SILENCE_THRESHOLD = os.environ.get('SILENCE_THRESHOLD', "-3.0")
+SILENCE_THRESHOLD = None if SILENCE_THRESHOLD.lower() == "none" else float(SILENCE_THRESHOLD)
+MIN_SILENCE_FRAMES = int(os.environ.get('MIN_SILENCE_FRAMES', 5))
+# "auto" benchmarks batch sizes and streams once per device and reuses the result, "force" always does, "off" keeps the defaults
+CALIBRATE = os.environ.get('CALIBRATE', "auto")
+# "mouth" enhances only the generated lower face, "frame" the whole frame
+ENHANCE_REGION = os.environ.get('ENHANCE_REGION', "mouth")
+# Skin face detection runs on frames downscaled by this factor (e.g. 0.25), 1 detects at full resolution
+FACE_DETECTION_SCALE = float(os.environ.get('FACE_DETECTION_SCALE', 1.0))
+# "torch" runs the RealESRGAN weights, "openvino" a static tile shape IR exported on first use
+ENHANCER_BACKEND = os.environ.get('ENHANCER_BACKEND', "torch")
+# Use the NNCF int8 weight compressed IR of the openvino enhancer backend
+ENHANCER_INT8 = os.environ.get('ENHANCER_INT8', "false").lower() in ("1", "true", "yes")
 
 class Configurations(BaseModel):
     lipsync_device: str
@@ -62,6 +97,21 @@ class Configurations(BaseModel):
     enhancer_model: Optional[Literal[tuple(ENHANCER_MODELS)]] = 'RealESRGAN_x4plus_anime_6B'
     avatar_skin: Optional[str] = 'default.mp4'
     
+def stream_with(usage, stream):
+    """Release the instance held by ``usage`` once the streamed response is done."""
+    with usage:
+        yield from stream
+
+def hold_for_stream(wav2lip, create_stream):
+    """Mark the instance in use before the response is returned, as /update_config may
+    swap and close it before Starlette starts iterating the stream."""
+    usage = ExitStack()
+    usage.enter_context(wav2lip.use())
+    response_stream = stream_with(usage, create_stream(wav2lip))
+    # A response that is never iterated releases the instance when it is collected
+    weakref.finalize(response_stream, usage.close)
+    return response_stream
+
 async def remove_file(file_name):
     if os.path.exists(file_name):
         try:
@@ -69,28 +119,46 @@ async def remove_file(file_name):
         except:
             logger.error(f"File: {file_name} not available")
 
-def initialize_wav2lip():
-    global CONFIG
+def initialize_wav2lip(config):
     enhancer=None
-    if CONFIG["use_enhancer"] is not False:
-        enhancer = initialize(CONFIG["enhancer_model"], device=CONFIG["enhancer_device"])
-
-    wav2lip = OVWav2Lip(device=CONFIG["lipsync_device"], avatar_path=f"assets/avatar-skins/{CONFIG['avatar_skin']}.mp4", enhancer=enhancer, model=CONFIG["lipsync_model"])
+    if config["use_enhancer"] is not False:
+        enhancer = initialize(config["enhancer_model"], device=config["enhancer_device"],
+                              backend=ENHANCER_BACKEND, compress=ENHANCER_INT8)
+
+    calibration = get_calibration(config["lipsync_device"], f"wav2lip/checkpoints/{config['lipsync_model']}.xml",
+                                  "wav2lip/checkpoints/face_detection.xml", mode=CALIBRATE, infer_requests=INFER_REQUESTS)
+    wav2lip = OVWav2Lip(device=config["lipsync_device"], avatar_path=f"assets/avatar-skins/{config['avatar_skin']}.mp4", enhancer=enhancer, model=config["lipsync_model"], infer_requests=INFER_REQUESTS,
+                        blend_mode=BLEND_MODE, blend_executor=BLEND_EXECUTOR,
+                        video_encoder=VIDEO_ENCODER, encoder_preset=ENCODER_PRESET,
+                        silence_threshold=SILENCE_THRESHOLD, min_silence_frames=MIN_SILENCE_FRAMES,
+                        calibration=calibration, enhance_region=ENHANCE_REGION,
+                        detection_scale=FACE_DETECTION_SCALE)
     return wav2lip    
 
-def warmup():
+def warmup(wav2lip, enhance):
     # Warm up the model by running a dummy inference
-    global WAV2LIP
     temp_filename = "empty.wav"
     with wave.open(temp_filename, "w") as wf:
         wf.setnchannels(1)  # mono
         wf.setsampwidth(2)  # 2 bytes per sample
         wf.setframerate(16000)  # 16 kHz
-        wf.writeframes(np.zeros(16000 * 2, dtype=np.int16).tobytes())  # 1 second of silence
+        # 2 seconds of a quiet tone, pure silence would skip the model
+        tone = 1000 * np.sin(2 * np.pi * 220 * np.arange(16000 * 2) / 16000)
+        wf.writeframes(tone.astype(np.int16).tobytes())
 
-    result, _ = WAV2LIP.inference(temp_filename, enhance=CONFIG["use_enhancer"])
+    result, _, _ = wav2lip.inference(temp_filename, enhance=enhance)
     result_path = os.path.join("wav2lip/results", result + ".mp4")
     os.remove(temp_filename)
+
+def build_wav2lip(config):
+    """Initialize and warm up an instance of the config, off the instance that is serving."""
+    wav2lip = initialize_wav2lip(config)
+    try:
+        warmup(wav2lip, config["use_enhancer"])
+    except Exception:
+        wav2lip.close()
+        raise
+    return wav2lip
     
 def get_devices():
     devices = {
@@ -126,9 +194,7 @@ async def lifespan(_: FastAPI):
     setup()
     global WAV2LIP, DEVICES
     DEVICES = get_devices()
-    WAV2LIP = initialize_wav2lip()
-
-    warmup()
+    WAV2LIP = build_wav2lip(CONFIG)
     yield
 
 
@@ -163,15 +229,99 @@ async def inference(bg_task: BackgroundTasks, starting_frame: int, reversed: str
         if os.path.islink(temp_audio_path):
             return JSONResponse(content=jsonable_encoder({"message": "symbolic links are not allowed"}), status_code=403)
             
-        result, _ = WAV2LIP.inference(temp_audio_path, reversed=True if reversed == "1" else False, starting_frame=starting_frame, enhance=CONFIG["use_enhancer"])
+        # Run off the event loop so concurrent requests share model batches
+        with WAV2LIP.use() as wav2lip:
+            result, _, _ = await asyncio.to_thread(wav2lip.inference, temp_audio_path, reversed=True if reversed == "1" else False, starting_frame=starting_frame, enhance=CONFIG["use_enhancer"])
     print(result, flush=True)
     result = f"wav2lip/results/{result}.mp4"
     return FileResponse(result, media_type="video/mp4", background=bg_task.add_task(remove_file,result ))
 
+@router.post("/inference_stream")
+async def inference_stream(starting_frame: int, reversed: str, file: UploadFile = File(...)):
+    if not file.filename.endswith(".wav"):
+        return "Only .wav files are allowed"
+
+    # The audio has to outlive this handler as it is muxed while the response is streamed
+    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_audio:
+        temp_audio_path = temp_audio.name
+        shutil.copyfileobj(file.file, temp_audio)
+
+    # Check if the temporary file is a symbolic link
+    if os.path.islink(temp_audio_path):
+        os.remove(temp_audio_path)
+        return JSONResponse(content=jsonable_encoder({"message": "symbolic links are not allowed"}), status_code=403)
+
+    try:
+        stream = hold_for_stream(WAV2LIP, lambda wav2lip: wav2lip.inference_stream(temp_audio_path, reversed=True if reversed == "1" else False, starting_frame=starting_frame, enhance=CONFIG["use_enhancer"]))
+    except Exception:
+        os.remove(temp_audio_path)
+        raise
+    return StreamingResponse(stream, media_type="video/mp4", background=BackgroundTask(remove_file, temp_audio_path))
+
+@router.websocket("/inference_realtime")
+async def inference_realtime(websocket: WebSocket, starting_frame: int = 0, reversed: str = "0"):
+    """Lipsync audio while it is being produced.
+
+    The client sends binary messages of little-endian PCM16 mono 16 kHz audio and
+    a text message ``{"type": "end"}`` after the last chunk. The server sends
+    every frame as a binary JPEG message paced at the skin fps, followed by
+    ``{"type": "end", "frames_generated": n}``.
+    """
+    await websocket.accept()
+    with WAV2LIP.use() as wav2lip:
+        await run_realtime_session(websocket, wav2lip, starting_frame, reversed)
+
+async def run_realtime_session(websocket, wav2lip, starting_frame, reversed):
+    session = RealtimeLipsync(wav2lip, batch_size=REALTIME_BATCH_SIZE,
+                              reversed=True if reversed == "1" else False, starting_frame=starting_frame)
+    frame_interval = 1. / wav2lip.fps
+    frames = asyncio.Queue(maxsize=max(int(REALTIME_MAX_BUFFER * wav2lip.fps), 1))
+
+    async def send_frames():
+        loop = asyncio.get_running_loop()
+        next_time = None
+        while True:
+            frame = await frames.get()
+            if frame is None:
+                break
+            now = loop.time()
+            if next_time is None or next_time < now:
+                # Start or resume pacing from now instead of bursting frames that are late
+                next_time = now
+            await asyncio.sleep(next_time - now)
+            await websocket.send_bytes(frame)
+            next_time += frame_interval
+
+    async def queue_frames(generated):
+        jpegs = await asyncio.to_thread(lambda: [encode_jpeg(f) for f in generated])
+        for jpeg in jpegs:
+            await frames.put(jpeg)
+
+    sender = asyncio.create_task(send_frames())
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes"):
+                await queue_frames(await asyncio.to_thread(session.push, message["bytes"]))
+            elif message.get("text") and json.loads(message["text"]).get("type") == "end":
+                await queue_frames(await asyncio.to_thread(session.finish))
+                break
+        await frames.put(None)
+        await sender
+        await websocket.send_json({"type": "end", "frames_generated": session.frames_generated})
+        await websocket.close()
+    except WebSocketDisconnect:
+        logger.info("Realtime lipsync client disconnected")
+    finally:
+        sender.cancel()
+
 @router.get("/test")
 async def test(enhance: bool = False):
     start_time = time.time()
-    result, _ = WAV2LIP.inference("data/audio.wav", reversed=True if reversed == "1" else False, starting_frame=0, enhance=enhance)
+    with WAV2LIP.use() as wav2lip:
+        result, _, _ = await asyncio.to_thread(wav2lip.inference, "data/audio.wav", reversed=True if reversed == "1" else False, starting_frame=0, enhance=enhance)
     end_time = time.time()
     print(f"Inference took {end_time - start_time} seconds", flush=True)
     print(result, flush=True)
@@ -210,7 +360,8 @@ async def inference(data: dict, starting_frame: int, reversed: str, bg_task: Bac
     with tempfile.NamedTemporaryFile(suffix=".wav") as temp_file:
         temp_file_path = temp_file.name
         shutil.copyfile(file_path, temp_file_path)
-        result, frames_generated = WAV2LIP.inference(temp_file_path, reversed=True if reversed == "1" else False, starting_frame=starting_frame, enhance=CONFIG["use_enhancer"])
+        with WAV2LIP.use() as wav2lip:
+            result, frames_generated, stats = await asyncio.to_thread(wav2lip.inference, temp_file_path, reversed=True if reversed == "1" else False, starting_frame=starting_frame, enhance=CONFIG["use_enhancer"])
     end_time = time.time()
     inference_latency = end_time - start_time
     
@@ -220,7 +371,7 @@ async def inference(data: dict, starting_frame: int, reversed: str, bg_task: Bac
     print(result, flush=True)
     print(f"Inference took {inference_latency} seconds", flush=True)
     return JSONResponse(
-        content=jsonable_encoder({"url": result, "inference_latency": inference_latency, "frames_generated": frames_generated}),
+        content=jsonable_encoder({"url": result, "inference_latency": inference_latency, "frames_generated": frames_generated, **stats}),
         background=bg_task
     )
 
@@ -239,7 +390,7 @@ async def update_config(data: Configurations):
         return JSONResponse(content=jsonable_encoder({"message": f"Invalid enhancer_device: {enhancer_device}"}), status_code=400)
 
     # Initialize WAV2LIP with the validated values
-    CONFIG = {
+    config = {
         "lipsync_model": data.lipsync_model,
         "lipsync_device": device,
         "use_enhancer": data.use_enhancer,
@@ -247,14 +398,42 @@ async def update_config(data: Configurations):
         "enhancer_model": data.enhancer_model,
         "avatar_skin": data.avatar_skin
     }
-    try:
-        WAV2LIP = initialize_wav2lip()
-        warmup()
-    except Exception as error:
-        logger.error(f"Error in updating device: {str(error)}")
-        return JSONResponse(content=jsonable_encoder({"message": f"Failed to update device. Error: {error}"}), status_code=500)
+    async with CONFIG_LOCK:
+        try:
+            # The current instance keeps serving while the new one compiles, detects faces and warms up
+            wav2lip = await asyncio.to_thread(build_wav2lip, config)
+        except Exception as error:
+            logger.error(f"Error in updating device: {str(error)}")
+            return JSONResponse(content=jsonable_encoder({"message": f"Failed to update device. Error: {error}"}), status_code=500)
+        previous = WAV2LIP
+        WAV2LIP, CONFIG = wav2lip, config
+
+    if previous is not None:
+        # Requests already running finish on the previous instance, which is closed after them
+        threading.Thread(target=previous.close, daemon=True).start()
     return JSONResponse(content=jsonable_encoder({"message": f"device updated to {device} and enhancer_device updated to {enhancer_device}"}), status_code=200)
 
+@router.get("/metrics")
+async def metrics():
+    """Rolling histograms of the per-stage busy seconds and throughput of the recent requests."""
+    return JSONResponse(content=jsonable_encoder(METRICS.snapshot()))
+
+@router.get("/calibration")
+async def calibration():
+    """Stored calibration results, with the entry of the current device and model marked as active."""
+    stored = load_calibration()
+    active = calibration_key(CONFIG["lipsync_device"], f"wav2lip/checkpoints/{CONFIG['lipsync_model']}.xml", INFER_REQUESTS)
+    return JSONResponse(content=jsonable_encoder({
+        "active": stored.get(active),
+        "applied": {
+            "wav2lip_batch_size": WAV2LIP.wav2lip_batch_size,
+            "face_det_batch_size": WAV2LIP.face_det_batch_size,
+            "num_streams": WAV2LIP.num_streams,
+            "infer_requests": WAV2LIP.infer_requests,
+        },
+        "results": stored,
+    }))
+
 @router.get("/video/{id}")
 async def get_video(id: str, bg_task: BackgroundTasks):
     video_path = f"wav2lip/results/{id}.mp4"
@@ -1,6 +1,8 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: Apache-2.0
 
+import os
+
 import librosa
 import librosa.filters
 import numpy as np
@@ -14,6 +16,20 @@ def load_wav(path, sr):
     duration = librosa.get_duration(y=wav, sr=sr)
     return wav, round(duration, 2)
 
+def load_audio(audio, sr):
+    """Waveform of a file path, or of an in-memory float array already sampled at ``sr``."""
+    if isinstance(audio, (str, os.PathLike)):
+        return load_wav(audio, sr)[0]
+    return np.asarray(audio, dtype=np.float32)
+
+def pcm16_to_float(pcm):
+    """Little-endian PCM16 bytes to a float32 waveform in [-1, 1)."""
+    return np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768.
+
+def save_pcm16_wav(wav, path, sr):
+    """Write a float waveform in [-1, 1] as PCM16 without normalizing it."""
+    wavfile.write(path, sr, (np.clip(wav, -1, 1) * 32767).astype(np.int16))
+
 def save_wav(wav, path, sr):
     wav *= 32767 / max(0.01, np.max(np.abs(wav)))
     #proposed by @dsmiller
@@ -55,6 +71,57 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+class MelSpectrogramStream:
+    """Mel spectrogram of audio that arrives in chunks.
+
+    The pre-emphasis filter state and the samples of the STFT windows that are
+    not complete yet are kept between chunks, so every sample is filtered and
+    transformed once and the frames match ``melspectrogram`` over the whole
+    signal (librosa ``center=True`` with zero padding).
+    """
+
+    def __init__(self):
+        assert not hp.use_lws, "Streaming mel spectrograms are computed with the librosa STFT"
+        self.hop = get_hop_size()
+        self.n_fft = hp.n_fft
+        self.window = librosa.filters.get_window('hann', hp.win_size, fftbins=True)
+        self.window = librosa.util.pad_center(self.window, size=self.n_fft)
+        # State of the pre-emphasis filter
+        self.zi = np.zeros(1)
+        # Filtered samples from the start of the first incomplete window, starting
+        # with the centering pad
+        self.samples = np.zeros(self.n_fft // 2, dtype=np.float32)
+        self.finished = False
+
+    def append(self, wav):
+        """Add samples and return the mel frames ``(num_mels, n)`` whose window is now complete."""
+        if self.finished:
+            raise RuntimeError("Cannot append to a finished mel spectrogram stream")
+        wav = np.asarray(wav, dtype=np.float32)
+        if hp.preemphasize:
+            wav, self.zi = signal.lfilter([1, -hp.preemphasis], [1], wav, zi=self.zi)
+        self.samples = np.concatenate((self.samples, wav.astype(np.float32)))
+        return self._frames()
+
+    def finish(self):
+        """Pad the end of the signal and return the remaining mel frames."""
+        self.finished = True
+        self.samples = np.concatenate((self.samples, np.zeros(self.n_fft // 2, dtype=np.float32)))
+        return self._frames()
+
+    def _frames(self):
+        count = (len(self.samples) - self.n_fft) // self.hop + 1
+        if count <= 0:
+            return np.zeros((hp.num_mels, 0), dtype=np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(self.samples, self.n_fft)[::self.hop][:count]
+        D = np.fft.rfft(frames * self.window, axis=1).T
+        self.samples = self.samples[count * self.hop:]
+
+        S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+        if hp.signal_normalization:
+            S = _normalize(S)
+        return S.astype(np.float32)
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
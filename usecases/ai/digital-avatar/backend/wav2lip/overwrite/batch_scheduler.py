@@ -0,0 +1,135 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+import openvino as ov
+
+
+class _Job:
+    def __init__(self, mel_batch, img_batch):
+        self.mel_batch = mel_batch
+        self.img_batch = img_batch
+        self.future = Future()
+        # Rows handed to the model so far and rows still waiting for their output
+        self.scheduled = 0
+        self.remaining = len(mel_batch)
+        self.outputs = []
+
+
+class BatchScheduler:
+    """Share wav2lip model batches between concurrent requests.
+
+    Every request submits micro-batches under its own client key. A scheduler
+    thread waits for an idle infer request, then fills one model batch of up
+    to ``max_batch_size`` rows by taking rows from the clients round robin, and
+    routes the output rows back to the future of the micro-batch they belong
+    to. A long clip therefore delays a concurrent request by a few batches
+    instead of by the whole clip.
+
+    Args:
+        compiled_model (ov.CompiledModel): Compiled wav2lip model with a dynamic batch.
+        max_batch_size (int): Maximum rows per model call.
+        infer_requests (int): Model batches in flight at the same time.
+    """
+
+    def __init__(self, compiled_model, max_batch_size, infer_requests=2):
+        self.max_batch_size = max_batch_size
+        self.condition = threading.Condition()
+        self.output_lock = threading.Lock()
+        self.queues = OrderedDict()
+        self.closed = False
+        self.infer_queue = ov.AsyncInferQueue(compiled_model, infer_requests)
+        self.infer_queue.set_callback(self._on_infer_done)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, client, mel_batch, img_batch):
+        """Queue a micro-batch and return a future of its model output rows."""
+        if not len(mel_batch):
+            raise ValueError("Cannot schedule an empty micro-batch")
+        job = _Job(mel_batch, img_batch)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Batch scheduler is closed")
+            self.queues.setdefault(client, deque()).append(job)
+            self.condition.notify()
+        return job.future
+
+    def cancel(self, client):
+        """Drop the micro-batches of a client that have not been scheduled yet."""
+        with self.condition:
+            jobs = self.queues.pop(client, ())
+        for job in jobs:
+            job.future.cancel()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.infer_queue.wait_all()
+
+    def _next_batch(self):
+        parts = []
+        rows = 0
+        while rows < self.max_batch_size and self.queues:
+            # One slice per client and round, so small requests are not starved by long clips
+            for client in list(self.queues):
+                jobs = self.queues[client]
+                job = jobs[0]
+                count = min(len(job.mel_batch) - job.scheduled, self.max_batch_size - rows)
+                parts.append((job, job.scheduled, count))
+                job.scheduled += count
+                rows += count
+                if job.scheduled == len(job.mel_batch):
+                    jobs.popleft()
+                    if not jobs:
+                        del self.queues[client]
+                if rows == self.max_batch_size:
+                    break
+        if self.queues:
+            # The next batch starts with a different client
+            self.queues.move_to_end(next(iter(self.queues)))
+        return parts
+
+    def _run(self):
+        while True:
+            # Take rows only once a request is idle so waiting clients get merged
+            self.infer_queue.get_idle_request_id()
+            with self.condition:
+                while not self.queues and not self.closed:
+                    self.condition.wait()
+                if not self.queues:
+                    return
+                parts = self._next_batch()
+
+            try:
+                mel_batch = np.concatenate([job.mel_batch[start:start + count] for job, start, count in parts])
+                img_batch = np.concatenate([job.img_batch[start:start + count] for job, start, count in parts])
+                self.infer_queue.start_async(
+                    {"audio_sequences": mel_batch, "face_sequences": img_batch}, userdata=parts)
+            except Exception as error:
+                for job, _, _ in parts:
+                    if not job.future.done():
+                        job.future.set_exception(error)
+
+    def _on_infer_done(self, request, parts):
+        try:
+            output = request.get_output_tensor(0).data
+            row = 0
+            with self.output_lock:
+                for job, start, count in parts:
+                    job.outputs.append((start, output[row:row + count].copy()))
+                    job.remaining -= count
+                    row += count
+                    if job.remaining == 0 and job.future.set_running_or_notify_cancel():
+                        job.outputs.sort(key=lambda part: part[0])
+                        job.future.set_result(np.concatenate([part for _, part in job.outputs]))
+        except Exception as error:
+            for job, _, _ in parts:
+                if not job.future.done():
+                    job.future.set_exception(error)
@@ -0,0 +1,99 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+BLEND_MODES = ["seamless", "alpha"]
+BLEND_EXECUTORS = ["thread", "process"]
+
+
+@lru_cache(maxsize=None)
+def get_blend_executor(kind="thread", max_workers=None):
+    """Return the blend worker pool of the given kind, shared for the life of the process."""
+    if max_workers is None:
+        max_workers = min(os.cpu_count(), 8)
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=max_workers)
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="blend")
+    raise ValueError(f"Unsupported blend executor: {kind}. Expected one of {BLEND_EXECUTORS}")
+
+
+@lru_cache(maxsize=256)
+def feather_mask(height, width, feather=0.15):
+    """Alpha mask of a face box that is 1 inside and fades linearly to 0 at the border.
+
+    Args:
+        height (int): Height of the face box.
+        width (int): Width of the face box.
+        feather (float): Width of the fade as a fraction of the box size.
+
+    Returns:
+        np.ndarray: Read-only ``(height, width, 1)`` float32 mask.
+    """
+    def ramp(size):
+        distance = np.minimum(np.arange(size), np.arange(size)[::-1]) + 1
+        return np.clip(distance / max(feather * size, 1.0), 0.0, 1.0).astype(np.float32)
+
+    mask = np.minimum.outer(ramp(height), ramp(width))[..., None]
+    mask.setflags(write=False)
+    return mask
+
+
+def seamless_blend(pred, frame, coords):
+    """Poisson blend the predicted face into the frame."""
+    y1, y2, x1, x2 = coords
+    p = cv2.resize(pred.astype(np.uint8), (x2 - x1, y2 - y1))
+    # Create a mask for seamless cloning
+    mask = 255 * np.ones(p.shape, p.dtype)
+
+    # Calculate the center of the region where the image will be cloned
+    center = (x1 + (x2 - x1) // 2, y1 + (y2 - y1) // 2)
+
+    return cv2.seamlessClone(p, frame, mask, center, cv2.NORMAL_CLONE)
+
+
+def alpha_blend(pred, frame, coords):
+    """Composite the predicted face over a copy of the frame with a feathered alpha mask."""
+    y1, y2, x1, x2 = coords
+    p = cv2.resize(pred.astype(np.uint8), (x2 - x1, y2 - y1))
+    alpha = feather_mask(y2 - y1, x2 - x1)
+    frame = frame.copy()
+    region = frame[y1:y2, x1:x2].astype(np.float32)
+    region += alpha * (p.astype(np.float32) - region)
+    frame[y1:y2, x1:x2] = np.rint(region)
+    return frame
+
+
+def get_blend_function(mode):
+    if mode == "seamless":
+        return seamless_blend
+    if mode == "alpha":
+        return alpha_blend
+    raise ValueError(f"Unsupported blend mode: {mode}. Expected one of {BLEND_MODES}")
+
+
+def blend_batch(executor, mode, preds, frames, coords):
+    """Blend every predicted face of a batch into its frame on the worker pool.
+
+    Args:
+        executor (concurrent.futures.Executor): Pool from :func:`get_blend_executor`.
+        mode (str): One of ``BLEND_MODES``.
+        preds (np.ndarray): ``(B, H, W, 3)`` predicted faces in the 0-255 range.
+        frames (list[np.ndarray]): Full frames the faces are pasted into. They are
+            never modified, every blended frame is a new array.
+        coords (list[tuple]): ``(y1, y2, x1, x2)`` face box of every frame.
+
+    Returns:
+        list[np.ndarray]: The blended frames in batch order.
+    """
+    blend = get_blend_function(mode)
+    # Process pools ship several frames per task to amortize the pickling round
+    # trip, thread pools ignore the chunk size
+    chunksize = max(len(frames) // 16, 1)
+    return list(executor.map(blend, preds, frames, coords, chunksize=chunksize))
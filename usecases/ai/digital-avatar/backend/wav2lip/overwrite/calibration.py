@@ -0,0 +1,175 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import openvino as ov
+import openvino.properties as props
+import openvino.properties.hint as hints
+
+logger = logging.getLogger('uvicorn.error')
+
+CALIBRATION_PATH = "wav2lip/checkpoints/calibration.json"
+WAV2LIP_BATCH_SIZES = [16, 32, 64, 128]
+FACE_DET_BATCH_SIZES = [1, 4, 8, 16]
+STREAM_COUNTS = [1, 2, 4]
+# Frame size of the synthetic face detection input
+FACE_DET_FRAME_SIZE = (720, 1280)
+
+
+def wav2lip_compile_config(num_streams=None):
+    """Compile properties of the wav2lip model, shared by OVWav2Lip and the calibration."""
+    config = {hints.performance_mode: hints.PerformanceMode.LATENCY}
+    if num_streams:
+        config[props.streams.num] = num_streams
+    return config
+
+
+def deployed_infer_requests(infer_requests, num_streams):
+    """Infer requests OVWav2Lip runs for a stream count, so every stream has one."""
+    return max(infer_requests, num_streams or 0)
+
+
+def calibration_key(device, model_path, infer_requests=2):
+    """Identify the hardware, runtime, model and serving settings a calibration result is valid for."""
+    core = ov.Core()
+    return "|".join([
+        device,
+        core.get_property(device, "FULL_DEVICE_NAME"),
+        str(os.cpu_count()),
+        ov.get_version(),
+        os.path.basename(model_path),
+        f"latency-requests{infer_requests}",
+    ])
+
+
+def measure_throughput(compiled_model, inputs, batch_size, infer_requests, min_duration=1.0, min_batches=4):
+    """Run batches of the synthetic inputs and return ``(frames_per_second, seconds_per_batch)``."""
+    infer_queue = ov.AsyncInferQueue(compiled_model, infer_requests)
+    latencies = []
+    infer_queue.set_callback(lambda _, start: latencies.append(time.perf_counter() - start))
+
+    # The first batch pays for memory allocation and kernel compilation
+    compiled_model(inputs)
+    start = time.perf_counter()
+    batches = 0
+    while batches < min_batches or time.perf_counter() - start < min_duration:
+        infer_queue.start_async(inputs, userdata=time.perf_counter())
+        batches += 1
+    infer_queue.wait_all()
+    elapsed = time.perf_counter() - start
+    return batches * batch_size / elapsed, float(np.median(latencies))
+
+
+def compile_for_calibration(core, model, device, num_streams):
+    # The properties OVWav2Lip compiles the model with, so the measured configuration is the deployed one
+    return core.compile_model(model, device, wav2lip_compile_config(num_streams))
+
+
+def calibrate(device, wav2lip_path, face_detection_path, batch_sizes=WAV2LIP_BATCH_SIZES,
+              face_det_batch_sizes=FACE_DET_BATCH_SIZES, stream_counts=STREAM_COUNTS, tolerance=0.05,
+              infer_requests=2):
+    """Benchmark wav2lip batch sizes and stream counts on the device with synthetic inputs.
+
+    The smallest batch within ``tolerance`` of the best throughput wins, which
+    avoids large transient allocations for a marginal gain.
+
+    Args:
+        infer_requests (int): Infer requests of the service, every stream count is
+            measured with the requests OVWav2Lip runs it with.
+    """
+    core = ov.Core()
+    core.set_property({props.cache_dir: f'./cache/{device}'})
+    wav2lip_model = core.read_model(wav2lip_path)
+
+    results = []
+    for num_streams in stream_counts:
+        compiled_model = compile_for_calibration(core, wav2lip_model, device, num_streams)
+        for batch_size in batch_sizes:
+            inputs = {
+                "audio_sequences": np.random.uniform(-4, 4, (batch_size, 1, 80, 16)).astype(np.float32),
+                "face_sequences": np.random.rand(batch_size, 6, 96, 96).astype(np.float32),
+            }
+            requests = deployed_infer_requests(infer_requests, num_streams)
+            fps, latency = measure_throughput(compiled_model, inputs, batch_size, requests)
+            results.append({"num_streams": num_streams, "infer_requests": requests, "batch_size": batch_size,
+                            "frames_per_second": round(fps, 1), "batch_latency": round(latency, 4)})
+            logger.info(f"Calibration {device}: streams={num_streams} batch={batch_size} "
+                        f"{fps:.1f} frames/s, {latency * 1000:.1f} ms/batch")
+        del compiled_model
+
+    best_fps = max(result["frames_per_second"] for result in results)
+    best = min((result for result in results if result["frames_per_second"] >= best_fps * (1 - tolerance)),
+               key=lambda result: (result["batch_size"], result["num_streams"]))
+
+    face_det_results = []
+    face_detector = core.compile_model(face_detection_path, device,
+                                       {hints.performance_mode: hints.PerformanceMode.LATENCY})
+    height, width = FACE_DET_FRAME_SIZE
+    for batch_size in face_det_batch_sizes:
+        inputs = {"x": np.random.uniform(-128, 128, (batch_size, 3, height, width)).astype(np.float32)}
+        fps, latency = measure_throughput(face_detector, inputs, batch_size, 1, min_duration=0.5, min_batches=2)
+        face_det_results.append({"batch_size": batch_size, "frames_per_second": round(fps, 1),
+                                 "batch_latency": round(latency, 4)})
+    best_face_det_fps = max(result["frames_per_second"] for result in face_det_results)
+    best_face_det = min(result["batch_size"] for result in face_det_results
+                        if result["frames_per_second"] >= best_face_det_fps * (1 - tolerance))
+
+    return {
+        "device": device,
+        "performance_mode": "LATENCY",
+        "infer_requests": deployed_infer_requests(infer_requests, best["num_streams"]),
+        "calibrated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wav2lip_batch_size": best["batch_size"],
+        "num_streams": best["num_streams"],
+        "face_det_batch_size": best_face_det,
+        "wav2lip": results,
+        "face_detection": face_det_results,
+    }
+
+
+def load_calibration(path=CALIBRATION_PATH):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as error:
+        logger.warning(f"Ignoring unreadable calibration file {path}: {error}")
+        return {}
+
+
+def get_calibration(device, wav2lip_path, face_detection_path, mode="auto", path=CALIBRATION_PATH,
+                    infer_requests=2):
+    """Return the calibration of the device, running it when needed.
+
+    Args:
+        infer_requests (int): Infer requests of the service, see ``calibrate()``.
+        mode (str): ``auto`` reuses a stored result of the same hardware, runtime
+            and model, ``force`` always recalibrates and ``off`` returns None.
+    """
+    if mode == "off":
+        return None
+
+    key = calibration_key(device, wav2lip_path, infer_requests)
+    stored = load_calibration(path)
+    if mode == "auto" and key in stored:
+        return stored[key]
+
+    logger.info(f"Calibrating wav2lip batch size and streams on {device}...")
+    result = calibrate(device, wav2lip_path, face_detection_path, infer_requests=infer_requests)
+    stored[key] = result
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(stored, f, indent=2)
+        os.replace(temp_path, path)
+    except OSError as error:
+        logger.warning(f"Failed to write calibration file {path}: {error}")
+    logger.info(f"Calibration {device}: batch size {result['wav2lip_batch_size']}, "
+                f"{result['num_streams']} streams, face detection batch size {result['face_det_batch_size']}")
+    return result
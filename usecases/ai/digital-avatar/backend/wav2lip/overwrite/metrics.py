@@ -0,0 +1,111 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import bisect
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+# Upper bounds in seconds of the stage time buckets
+SECONDS_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# Upper bounds of the request throughput buckets, in frames per second
+FPS_BUCKETS = [5, 10, 15, 20, 25, 30, 50, 75, 100, 150, 250]
+
+
+class RollingHistogram:
+    """Distribution of the last ``window`` observations.
+
+    Args:
+        buckets (list[float]): Sorted bucket upper bounds, a ``+Inf`` bucket is added.
+        window (int): Number of most recent observations kept.
+    """
+
+    def __init__(self, buckets, window=256):
+        self.buckets = list(buckets)
+        self.values = deque(maxlen=window)
+        self.total_count = 0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.total_count += 1
+
+    def snapshot(self):
+        values = np.array(self.values, dtype=np.float64)
+        if not len(values):
+            return {"count": 0, "total_count": self.total_count}
+
+        counts = np.bincount([bisect.bisect_left(self.buckets, value) for value in values],
+                             minlength=len(self.buckets) + 1)
+        # Cumulative like Prometheus histograms: observations <= the bound
+        cumulative = np.cumsum(counts)
+        p50, p90, p99 = np.percentile(values, [50, 90, 99])
+        return {
+            "count": len(values),
+            "total_count": self.total_count,
+            "mean": round(float(values.mean()), 4),
+            "p50": round(float(p50), 4),
+            "p90": round(float(p90), 4),
+            "p99": round(float(p99), 4),
+            "max": round(float(values.max()), 4),
+            "buckets": {str(bound): int(count) for bound, count in zip(self.buckets + ["+Inf"], cumulative)},
+        }
+
+
+class MetricsRegistry:
+    """Per-request stage timings of the lipsync service with rolling histograms.
+
+    Args:
+        window (int): Requests the histograms are computed over.
+        recent (int): Number of per-request records kept.
+    """
+
+    def __init__(self, window=256, recent=20):
+        self.lock = threading.Lock()
+        self.window = window
+        self.stages = {}
+        self.total = RollingHistogram(SECONDS_BUCKETS, window)
+        self.frames_per_second = RollingHistogram(FPS_BUCKETS, window)
+        self.requests = Counter()
+        self.recent = deque(maxlen=recent)
+
+    def record(self, kind, stage_seconds, frames, total_seconds):
+        """Record a finished request.
+
+        Args:
+            kind (str): Request type, e.g. ``inference`` or ``inference_stream``.
+            stage_seconds (dict): Busy seconds of every stage.
+            frames (int): Frames generated.
+            total_seconds (float): Wall time of the request.
+        """
+        with self.lock:
+            self.requests[kind] += 1
+            for stage, seconds in stage_seconds.items():
+                if stage not in self.stages:
+                    self.stages[stage] = RollingHistogram(SECONDS_BUCKETS, self.window)
+                self.stages[stage].observe(seconds)
+            self.total.observe(total_seconds)
+            if total_seconds > 0:
+                self.frames_per_second.observe(frames / total_seconds)
+            self.recent.append({
+                "kind": kind,
+                "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "frames": frames,
+                "total_seconds": round(total_seconds, 4),
+                "stage_seconds": {stage: round(seconds, 4) for stage, seconds in stage_seconds.items()},
+            })
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "total_seconds": self.total.snapshot(),
+                "frames_per_second": self.frames_per_second.snapshot(),
+                "stage_seconds": {stage: histogram.snapshot() for stage, histogram in self.stages.items()},
+                "recent": list(self.recent),
+            }
+
+
+# Metrics of every OVWav2Lip instance of the process, so they survive configuration updates
+METRICS = MetricsRegistry()
@@ -9,7 +9,8 @@ sys.path.append(script_folder)
 
 import numpy as np
 import cv2
-from .audio import load_wav, melspectrogram
+from .audio import load_audio, melspectrogram, save_pcm16_wav
+from .hparams import hparams as hp
 from tqdm import tqdm
 from glob import glob
 import torch
@@ -18,17 +19,25 @@ import openvino as ov
 import torch
 from torch.utils.model_zoo import load_url
 from enum import Enum
-import torch.nn.functional as F
+from functools import lru_cache, partial
 import openvino.properties.hint as hints
 import openvino.properties as props
 # from face_parsing import init_parser, swap_regions
-from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
-from .inference_ov import combine_audio_with_generated_video
+import queue
+import threading
+from .video_encoder import VIDEO_ENCODERS, FragmentedMP4Stream, create_video_encoder
+from .skin_cache import SkinCache
+from .pipeline_stats import PipelineStats
+from .metrics import METRICS
+from .batch_scheduler import BatchScheduler
+from .calibration import deployed_infer_requests, wav2lip_compile_config
+from .blending import BLEND_MODES, blend_batch, feather_mask, get_blend_executor
 
 import time
 import logging
 import uuid
+from contextlib import contextmanager
 from pathlib import Path
 
 try:
@@ -36,6 +45,32 @@ try:
 except BaseException:
     import urllib as request_file
 
+logger = logging.getLogger('uvicorn.error')
+
+ENHANCE_REGIONS = ["mouth", "frame"]
+# Stages of an inference request; they overlap, so their busy times add up to more than the wall time
+INFERENCE_STAGES = ["mel", "datagen", "infer", "blend", "encode", "mux"]
+
+# Compiled models stay resident for the life of the process, so switching back
+# to a device or model does not compile again
+_COMPILED_MODELS = {}
+_COMPILED_MODELS_LOCK = Lock()
+
+
+def get_compiled_model(model_path, device, config):
+    """Compile a model for a device once and share it between OVWav2Lip instances.
+
+    Every instance creates its own infer requests, so the compiled model can be
+    used by the serving instance and by a new one being built at the same time.
+    """
+    key = (model_path, device, tuple(sorted((str(name), str(value)) for name, value in config.items())))
+    with _COMPILED_MODELS_LOCK:
+        if key not in _COMPILED_MODELS:
+            core = ov.Core()
+            core.set_property({props.cache_dir: f'./cache/{device}'})
+            _COMPILED_MODELS[key] = core.compile_model(model_path, device, config)
+        return _COMPILED_MODELS[key]
+
 
 class LandmarksType(Enum):
     """Enum class defining the type of landmarks to detect.
@@ -65,6 +100,23 @@ class NetworkSize(Enum):
         return self.value
 
 
+def softmax(x, axis):
+    x = np.exp(x - x.max(axis=axis, keepdims=True))
+    return x / x.sum(axis=axis, keepdims=True)
+
+
+@lru_cache(maxsize=None)
+def anchor_priors(feature_h, feature_w, stride):
+    """Prior boxes (cx, cy, w, h) of one S3FD detection level in row-major order."""
+    ys, xs = np.meshgrid(np.arange(feature_h), np.arange(feature_w), indexing='ij')
+    priors = np.empty((feature_h * feature_w, 4), dtype=np.float32)
+    priors[:, 0] = stride / 2 + xs.reshape(-1) * stride
+    priors[:, 1] = stride / 2 + ys.reshape(-1) * stride
+    priors[:, 2:] = stride * 4
+    priors.setflags(write=False)
+    return priors
+
+
 class OVFaceDetector(object):
     def __init__(self, device, verbose):
         self.device = device
@@ -156,13 +208,11 @@ class OVSFDDetector(OVFaceDetector):
 
     def detect_from_batch(self, images):
         bboxlists = self.batch_detect(self.face_detector, images, device="cpu")
-        keeps = [self.nms(bboxlists[:, i, :], 0.3)
-                 for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5]
-                     for bboxlist in bboxlists]
+        # Boxes scoring 0.5 or less are dropped after NMS anyway and can never suppress a
+        # higher scoring box, so filtering them first gives the same result on fewer boxes
+        bboxlists = [bboxlist[bboxlist[:, 4] > 0.5] for bboxlist in bboxlists]
 
-        return bboxlists
+        return self.batch_nms(bboxlists, 0.3)
 
     def nms(self, dets, thresh):
         if 0 == len(dets):
@@ -190,39 +240,29 @@ class OVSFDDetector(OVFaceDetector):
 
         return keep
 
-    def detect(self, net, img, device):
-        img = img - np.array([104, 117, 123])
-        img = img.transpose(2, 0, 1)
-        img = img.reshape((1,) + img.shape)
+    def batch_nms(self, dets_list, thresh):
+        """Run NMS over the detections of several images in one pass.
+
+        The boxes of every image are shifted so that boxes of different images never
+        overlap, which makes a single greedy NMS equivalent to one NMS per image.
+        Returns the kept detections of every image, sorted by descending score.
+        """
+        counts = [len(dets) for dets in dets_list]
+        if sum(counts) == 0:
+            return [np.zeros((0, 5), dtype=np.float32) for _ in dets_list]
 
-        img = torch.from_numpy(img).float().to(device)
-        BB, CC, HH, WW = img.size()
+        dets = np.concatenate(dets_list)
+        image_ids = np.repeat(np.arange(len(dets_list)), counts)
+        span = dets[:, :4].max() - dets[:, :4].min() + 1
+        shifted = dets.copy()
+        shifted[:, :4] += (image_ids * span)[:, None]
 
-        results = net({"x": img.numpy()})
-        olist = [torch.Tensor(results[i]) for i in range(12)]
+        keep = np.asarray(self.nms(shifted, thresh), dtype=np.int64)
+        kept_ids = image_ids[keep]
+        return [dets[keep[kept_ids == i]] for i in range(len(dets_list))]
 
-        bboxlist = []
-        for i in range(len(olist) // 2):
-            olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-        olist = [oelem.data.cpu() for oelem in olist]
-        for i in range(len(olist) // 2):
-            ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-            FB, FC, FH, FW = ocls.size()  # feature map size
-            stride = 2**(i + 2)    # 4,8,16,32,64,128
-            anchor = stride * 4
-            poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-            for Iindex, hindex, windex in poss:
-                axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-                score = ocls[0, 1, hindex, windex]
-                loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-                priors = torch.Tensor(
-                    [[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
-                variances = [0.1, 0.2]
-                box = self.decode(loc, priors, variances)
-                x1, y1, x2, y2 = box[0] * 1.0
-                # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-                bboxlist.append([x1, y1, x2, y2, score])
-        bboxlist = np.array(bboxlist)
+    def detect(self, net, img, device):
+        bboxlist = self.batch_detect(net, img[np.newaxis], device)[0]
         if 0 == len(bboxlist):
             bboxlist = np.zeros((1, 5))
 
@@ -232,80 +272,62 @@ class OVSFDDetector(OVFaceDetector):
         """Decode locations from predictions using priors to undo
         the encoding we did for offset regression at train time.
         Args:
-            loc (tensor): location predictions for loc layers,
-                Shape: [num_priors,4]
-            priors (tensor): Prior boxes in center-offset form.
-                Shape: [num_priors,4].
+            loc (ndarray): location predictions for loc layers,
+                Shape: [..., num_priors, 4]
+            priors (ndarray): Prior boxes in center-offset form.
+                Shape: [..., num_priors, 4].
             variances: (list[float]) Variances of priorboxes
         Return:
             decoded bounding box predictions
         """
 
-        boxes = torch.cat((
-            priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-            priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-        boxes[:, :2] -= boxes[:, 2:] / 2
-        boxes[:, 2:] += boxes[:, :2]
+        boxes = np.concatenate((
+            priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:],
+            priors[..., 2:] * np.exp(loc[..., 2:] * variances[1])), axis=-1)
+        boxes[..., :2] -= boxes[..., 2:] / 2
+        boxes[..., 2:] += boxes[..., :2]
         return boxes
 
     def batch_detect(self, net, imgs, device):
         imgs = imgs - np.array([104, 117, 123])
-        imgs = imgs.transpose(0, 3, 1, 2)
+        imgs = imgs.transpose(0, 3, 1, 2).astype(np.float32)
 
-        imgs = torch.from_numpy(imgs).float().to(device)
-        BB, CC, HH, WW = imgs.size()
+        results = net({"x": imgs})
 
-        results = net({"x": imgs.numpy()})
-        olist = [torch.Tensor(results[i]) for i in range(12)]
-        bboxlist = []
-        for i in range(len(olist) // 2):
-            olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-            # olist[i * 2] = (olist[i * 2], dim=1)
-        olist = [oelem.data.cpu() for oelem in olist]
-        # olist = [oelem for oelem in olist]
-        for i in range(len(olist) // 2):
-            ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-            FB, FC, FH, FW = ocls.size()  # feature map size
-            stride = 2**(i + 2)    # 4,8,16,32,64,128
-            anchor = stride * 4
-            poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-            for Iindex, hindex, windex in poss:
-                axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-                score = ocls[:, 1, hindex, windex]
-                loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-                priors = torch.Tensor(
-                    [[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-                variances = [0.1, 0.2]
-                box = self.batch_decode(loc, priors, variances)
-                box = box[:, 0] * 1.0
-                # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-                bboxlist.append(
-                    torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-        bboxlist = np.array(bboxlist)
-        if 0 == len(bboxlist):
-            bboxlist = np.zeros((1, BB, 5))
+        return self.decode_outputs([results[i] for i in range(12)])
 
-        return bboxlist
+    def decode_outputs(self, olist, threshold=0.05):
+        """Decode the raw S3FD outputs of a batch into per image detections.
 
-    def batch_decode(self, loc, priors, variances):
-        """Decode locations from predictions using priors to undo
-        the encoding we did for offset regression at train time.
         Args:
-            loc (tensor): location predictions for loc layers,
-                Shape: [num_priors,4]
-            priors (tensor): Prior boxes in center-offset form.
-                Shape: [num_priors,4].
-            variances: (list[float]) Variances of priorboxes
+            olist (list[ndarray]): Classification and regression maps of the six
+                detection levels, interleaved as ``[cls_0, reg_0, cls_1, reg_1, ...]``.
+            threshold (float): Minimum face score of a returned box.
         Return:
-            decoded bounding box predictions
+            list of ``[num_boxes, 5]`` arrays (x1, y1, x2, y2, score), one per image
         """
+        variances = [0.1, 0.2]
+        scores, locs, priors = [], [], []
+        for i in range(len(olist) // 2):
+            ocls = np.asarray(olist[i * 2], dtype=np.float32)
+            oreg = np.asarray(olist[i * 2 + 1], dtype=np.float32)
+            batch, _, feature_h, feature_w = ocls.shape  # feature map size
+            stride = 2**(i + 2)    # 4,8,16,32,64,128
 
-        boxes = torch.cat((
-            priors[:, :, :2] + loc[:, :, :2] * variances[0] * priors[:, :, 2:],
-            priors[:, :, 2:] * torch.exp(loc[:, :, 2:] * variances[1])), 2)
-        boxes[:, :, :2] -= boxes[:, :, 2:] / 2
-        boxes[:, :, 2:] += boxes[:, :, :2]
-        return boxes
+            scores.append(softmax(ocls, axis=1)[:, 1].reshape(batch, -1))
+            locs.append(oreg.reshape(batch, 4, -1).transpose(0, 2, 1))
+            priors.append(anchor_priors(feature_h, feature_w, stride))
+
+        scores = np.concatenate(scores, axis=1)
+        locs = np.concatenate(locs, axis=1)
+        priors = np.concatenate(priors, axis=0)
+
+        image_ids, anchor_ids = np.nonzero(scores > threshold)
+        boxes = self.decode(locs[image_ids, anchor_ids], priors[anchor_ids], variances)
+        bboxlist = np.concatenate((boxes, scores[image_ids, anchor_ids, None]), axis=1)
+
+        splits = np.cumsum(np.bincount(image_ids, minlength=len(scores)))[:-1]
+        return np.split(bboxlist, splits)
 
     @property
     def reference_scale(self):
@@ -336,38 +358,81 @@ class NetworkSize(Enum):
 
 
 class OVFaceAlignment:
+    """Face boxes of image batches.
+
+    With ``detection_scale`` below 1 S3FD runs on a downscaled copy of the batch
+    and the boxes are mapped back to full resolution. Images whose best face
+    scores below ``refine_threshold``, or that have no face at that scale, are
+    detected again at full resolution.
+    """
+
     def __init__(self, landmarks_type, face_detector, network_size=NetworkSize.LARGE,
-                 device='CPU', flip_input=False, verbose=False):
+                 device='CPU', flip_input=False, verbose=False, detection_scale=1.0, refine_threshold=0.9):
         self.device = device
         self.flip_input = flip_input
         self.landmarks_type = landmarks_type
         self.verbose = verbose
+        self.detection_scale = detection_scale
+        self.refine_threshold = refine_threshold
+        # Images detected again at full resolution
+        self.refined = 0
 
         network_size = int(network_size)
 
         self.face_detector = OVSFDDetector(
             device=device, face_detector=face_detector, verbose=verbose)
 
-    def get_detections_for_batch(self, images):
+    def detect_faces(self, images):
+        """Best ``(box, score)`` of every image, None where no face was found."""
         images = images[..., ::-1]
         detected_faces = self.face_detector.detect_from_batch(images.copy())
         results = []
 
-        for i, d in enumerate(detected_faces):
+        for d in detected_faces:
             if len(d) == 0:
                 results.append(None)
                 continue
-            d = d[0]
-            d = np.clip(d, 0, None)
+            d = np.clip(d[0], 0, None)
+            results.append((d[:4], d[4]))
+
+        return results
 
-            x1, y1, x2, y2 = map(int, d[:-1])
+    def detect_faces_downscaled(self, images):
+        height, width = images.shape[1:3]
+        size = (max(int(width * self.detection_scale), 1), max(int(height * self.detection_scale), 1))
+        small = np.stack([cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in images])
+        box_scale = np.array([width / size[0], height / size[1]] * 2)
+        detections = [None if d is None else (d[0] * box_scale, d[1]) for d in self.detect_faces(small)]
+
+        refine = [i for i, d in enumerate(detections) if d is None or d[1] < self.refine_threshold]
+        if refine:
+            for i, d in zip(refine, self.detect_faces(images[refine])):
+                detections[i] = d
+            self.refined += len(refine)
+        return detections
+
+    def get_detections_for_batch(self, images):
+        if self.detection_scale < 1:
+            detections = self.detect_faces_downscaled(images)
+        else:
+            detections = self.detect_faces(images)
+
+        results = []
+        for d in detections:
+            if d is None:
+                results.append(None)
+                continue
+            x1, y1, x2, y2 = map(int, d[0])
             results.append((x1, y1, x2, y2))
 
         return results
 
 
 class OVWav2Lip:
-    def __init__(self, avatar_path="assets/xy.png", device="GPU", enhancer = None, model="wav2lip"):
+    def __init__(self, avatar_path="assets/xy.png", device="GPU", enhancer = None, model="wav2lip", infer_requests=2,
+                 blend_mode="seamless", blend_executor="thread", video_encoder="ffmpeg", encoder_preset="veryfast",
+                 silence_threshold=-3.0, min_silence_frames=5, calibration=None, enhance_region="mouth",
+                 detection_scale=1.0, refine_threshold=0.9):
         # Paths to model checkpoints
         self.face_detection_path = "wav2lip/checkpoints/face_detection.xml"
         self.wav2lip_path = f"wav2lip/checkpoints/{model}.xml"
@@ -376,7 +441,14 @@ class OVWav2Lip:
         self.face_landmarks_detector_path = 'wav2lip/checkpoints/face_landmarker_v2_with_blendshapes.task'
 
         self.enhancer = enhancer
+        # "mouth" enhances the lower half of the face box, "frame" the whole frame
+        if enhance_region not in ENHANCE_REGIONS:
+            raise ValueError(f"Unsupported enhance region: {enhance_region}. Expected one of {ENHANCE_REGIONS}")
+        self.enhance_region = enhance_region
         self.lock = Lock()
+        # Requests using this instance, close() waits for them
+        self.active_requests = 0
+        self.active_condition = threading.Condition()
         # Device configuration
         self.inference_device = device
 
@@ -398,6 +470,33 @@ class OVWav2Lip:
         self.no_segmentation = False
         self.no_sr = False
         self.img_size = 96
+        # Face detection runs on frames downscaled by this factor, low scoring
+        # frames are detected again at full resolution
+        self.detection_scale = detection_scale
+        self.refine_threshold = refine_threshold
+        # Batches inferring concurrently while earlier batches are blended
+        self.infer_requests = infer_requests
+        # "seamless" Poisson blends every face, "alpha" composites it with a feathered mask
+        if blend_mode not in BLEND_MODES:
+            raise ValueError(f"Unsupported blend mode: {blend_mode}. Expected one of {BLEND_MODES}")
+        self.blend_mode = blend_mode
+        self.blend_executor = get_blend_executor(blend_executor)
+        # "ffmpeg" encodes and muxes the audio in one pass, "opencv" writes an AVI and muxes afterwards
+        if video_encoder not in VIDEO_ENCODERS:
+            raise ValueError(f"Unsupported video encoder: {video_encoder}. Expected one of {VIDEO_ENCODERS}")
+        self.video_encoder = video_encoder
+        self.encoder_preset = encoder_preset
+        # Mel chunks whose loudest bin stays below the threshold show the skin frame
+        # without running the model; None disables the check
+        self.silence_threshold = silence_threshold
+        self.min_silence_frames = min_silence_frames
+        # Batch sizes and OpenVINO streams measured on this device, see calibration.py
+        self.num_streams = None
+        if calibration:
+            self.wav2lip_batch_size = calibration["wav2lip_batch_size"]
+            self.face_det_batch_size = calibration["face_det_batch_size"]
+            self.num_streams = calibration["num_streams"]
+            self.infer_requests = deployed_infer_requests(self.infer_requests, self.num_streams)
 
         # Model URLs
         self.models_urls = {
@@ -408,19 +507,14 @@ class OVWav2Lip:
         self.run()
 
     def run(self):
-        core = ov.Core()
         config = {hints.performance_mode: hints.PerformanceMode.LATENCY}
 
         # FIXME: A770 don't work for face detection
-        self.face_detector = core.compile_model(
-            self.face_detection_path, self.inference_device, config)
+        self.face_detector = get_compiled_model(self.face_detection_path, self.inference_device, config)
 
-        # OV_WAV2LIP_MODEL_PATH = Path(args.wav2lip_path)
-        core.set_property(
-            {props.cache_dir: f'./cache/{self.inference_device}'})
-        wav2_lip_model = core.read_model(model=self.wav2lip_path)
-        self.compiled_wav2lip_model = core.compile_model(
-            model=wav2_lip_model, device_name=self.inference_device, config=config)
+        self.compiled_wav2lip_model = get_compiled_model(self.wav2lip_path, self.inference_device,
+                                                         wav2lip_compile_config(self.num_streams))
+        self.scheduler = BatchScheduler(self.compiled_wav2lip_model, self.wav2lip_batch_size, self.infer_requests)
 
         if os.path.isfile(self.face) and self.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
             self.static = True
@@ -478,6 +572,11 @@ class OVWav2Lip:
             
             self.full_frames=frames.copy()
 
+        # One read-only array holds every skin frame; requests only index into it
+        self.frame_store = np.stack(self.full_frames)
+        self.frame_store.setflags(write=False)
+        self.full_frames = list(self.frame_store)
+
         self.mel_step_size = 16
 
         self.batch_size = self.wav2lip_batch_size
@@ -488,16 +587,74 @@ class OVWav2Lip:
 
         if self.box[0] == -1:
             if not self.static:
-                self.face_det_results = self.face_detect_ov(
-                    frames_temp, self.inference_device)
+                frames_to_detect = frames_temp
+            else:
+                frames_to_detect = [frames_temp[0]]
+
+            skin_cache = SkinCache(self.face, self.get_preprocessing_settings())
+            cached = skin_cache.load_face_detections()
+            if cached is not None and len(cached[0]) == len(frames_to_detect):
+                boxes, faces = cached
+                self.face_det_results = [[face, tuple(int(v) for v in box)] for face, box in zip(faces, boxes)]
             else:
                 self.face_det_results = self.face_detect_ov(
-                    [frames_temp[0]], self.inference_device)
+                    frames_to_detect, self.inference_device)
+                skin_cache.save_face_detections(
+                    [coords for _, coords in self.face_det_results], [face for face, _ in self.face_det_results])
+
+            self.face_tensor = skin_cache.load_face_tensor()
+            if self.face_tensor is None or len(self.face_tensor) != len(self.face_det_results):
+                self.face_tensor = self.build_face_tensor(self.face_det_results)
+                skin_cache.save_face_tensor(self.face_tensor)
         else:
             print('Using the specified bounding box instead of face detection...')
             y1, y2, x1, x2 = self.box
             self.face_det_results = [
                 [f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames_temp]
+            self.face_tensor = self.build_face_tensor(self.face_det_results)
+
+        self.face_boxes = np.array([coords for _, coords in self.face_det_results], dtype=int)
+
+    def build_face_tensor(self, face_det_results):
+        """Model face input of every skin frame: masked and reference face, NCHW float32 in [0, 1]."""
+        faces = np.asarray([cv2.resize(face, (self.img_size, self.img_size)) for face, _ in face_det_results])
+        img_masked = faces.copy()
+        img_masked[:, self.img_size//2:] = 0
+        faces = np.concatenate((img_masked, faces), axis=3).transpose(0, 3, 1, 2)
+        return np.ascontiguousarray(faces, dtype=np.float32) / 255.
+
+    @contextmanager
+    def use(self):
+        """Mark a request in flight on this instance for the duration of the block."""
+        with self.active_condition:
+            self.active_requests += 1
+        try:
+            yield self
+        finally:
+            with self.active_condition:
+                self.active_requests -= 1
+                self.active_condition.notify_all()
+
+    def close(self):
+        """Wait for the requests using this instance, then stop the batch scheduler."""
+        with self.active_condition:
+            self.active_condition.wait_for(lambda: self.active_requests == 0)
+        self.scheduler.close()
+
+    def get_preprocessing_settings(self):
+        """Settings that change the face detection results of a skin."""
+        return {
+            "pads": self.pads,
+            "resize_factor": self.resize_factor,
+            "crop": self.crop,
+            "rotate": self.rotate,
+            "nosmooth": self.nosmooth,
+            "img_size": self.img_size,
+            "detection_scale": self.detection_scale,
+            "refine_threshold": self.refine_threshold,
+            # a new detector checkpoint changes the boxes and so the face tensor
+            "face_detector": SkinCache.model_file_id(self.face_detection_path),
+        }
 
     def process_images_with_detector(self, images, detector, initial_batch_size):
         batch_size = initial_batch_size
@@ -522,9 +679,13 @@ class OVWav2Lip:
 
     def face_detect_ov(self, images, device):
         detector = OVFaceAlignment(
-            LandmarksType._2D, face_detector=self.face_detector, flip_input=False, device=device)
+            LandmarksType._2D, face_detector=self.face_detector, flip_input=False, device=device,
+            detection_scale=self.detection_scale, refine_threshold=self.refine_threshold)
 
         predictions = self.process_images_with_detector(images, detector, self.face_det_batch_size)
+        if self.detection_scale < 1:
+            logger.info(f"Face detection at scale {self.detection_scale}: "
+                        f"{detector.refined}/{len(images)} frames refined at full resolution")
 
         results = []
         pady1, pady2, padx1, padx2 = self.pads
@@ -546,7 +707,7 @@ class OVWav2Lip:
         boxes = np.array(results)
         if not self.nosmooth:
             boxes = self.get_smoothened_boxes(boxes, T=5)
-        results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)]
+        results = [[cv2.resize(image[y1: y2, x1:x2], (self.img_size, self.img_size)), (int(y1), int(y2), int(x1), int(x2))]
                    for image, (x1, y1, x2, y2) in zip(images, boxes)]
 
         del detector
@@ -561,198 +722,335 @@ class OVWav2Lip:
             boxes[i] = np.mean(window, axis=0)
         return boxes
 
-    def get_full_frames_and_face_det_results(self, reverse=False, double=False):
+    def get_frame_order(self, reverse=False, double=False):
+        """Skin frame index of every output position before wrapping around.
+
+        ``reverse`` plays the skin backwards and ``double`` appends the reversed
+        order for a ping-pong loop. Frames and face data are looked up through
+        these indices, so no per-request frame lists are built.
+        """
+        order = np.arange(len(self.frame_store))
         if reverse:
-            full_frames = self.full_frames.copy()[::-1]
-            face_det_results = self.face_det_results.copy()[::-1]
-        else:
-            full_frames = self.full_frames.copy()
-            face_det_results = self.face_det_results.copy()
-        
+            order = order[::-1]
         if double:
-            full_frames = full_frames + full_frames[::-1]
-            face_det_results = face_det_results + face_det_results[::-1]
-        
-        return full_frames, face_det_results
-
-    def inference(self, audio_path, reversed=False, starting_frame=0, enhance=False):
-        def process_frame(index, p, f, c, enhancer, enhance):
-            y1, y2, x1, x2 = c
-            p = p.astype(np.uint8)
-
-            # # Adjust coords to only focus on mouth
-            # crop_coords = [0, 100, 60, 90] # x1, x2, x3, x4
-            
-            # width_c = x2 - x1
-            # height_c = y2 - y1
-            # scale_x = width_c / p.shape[1]
-            # scale_y = height_c / p.shape[0]
-            # p = p[crop_coords[2]: crop_coords[3], crop_coords[0]: crop_coords[1]]
-
-            # # Adjust the crop_coords relative to c
-            # adjusted_crop_coords = [
-            #     int(crop_coords[0] * scale_x),
-            #     int(crop_coords[1] * scale_x),
-            #     int(crop_coords[2] * scale_y),
-            #     int(crop_coords[3] * scale_y)
-            # ]
-            # x1 = x1 + adjusted_crop_coords[0]
-            # x2 = x1 + (adjusted_crop_coords[1] - adjusted_crop_coords[0])
-            # y1 = y1 + adjusted_crop_coords[2]
-            # y2 = y1 + (adjusted_crop_coords[3] - adjusted_crop_coords[2])
-
-            # if enhancer and enhance:
-            #     with self.lock:
-            #         p, _ = enhancer.enhance(p)
-            # p = cv2.resize(p, (int((crop_coords[1] - crop_coords[0]) * scale_x), int((crop_coords[3] - crop_coords[2]) * scale_y)))
-            p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-            # Create a mask for seamless cloning
-            mask = 255 * np.ones(p.shape, p.dtype)
-            
-            # Calculate the center of the region where the image will be cloned
-            center = (x1 + (x2 - x1) // 2, y1 + (y2 - y1) // 2)
-            
-            # Perform seamless cloning
-            f = cv2.seamlessClone(p, f, mask, center, cv2.NORMAL_CLONE)
-            
-            return index, f
+            order = np.concatenate((order, order[::-1]))
+        return order
 
-        file_id = str(uuid.uuid4())
-        output_path = Path(f'wav2lip/results/{file_id}.mp4')
-        output_path.parent.mkdir(parents=True, exist_ok=True)
+    def get_silent_chunks(self, mel_chunks):
+        """Mask of the mel chunks inside runs of at least ``self.min_silence_frames`` silent windows.
 
-        wav, _ = load_wav(audio_path, 16000)
-        mel = melspectrogram(wav)
+        Short pauses are not skipped so the mouth does not snap between the
+        generated and the original face within a word.
+        """
+        silent = np.zeros(len(mel_chunks), dtype=bool)
+        if self.silence_threshold is None or not len(mel_chunks):
+            return silent
+        quiet = np.array([chunk.max() < self.silence_threshold for chunk in mel_chunks])
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], quiet.astype(np.int8), [0]))))
+        for start, end in zip(edges[::2], edges[1::2]):
+            if end - start >= self.min_silence_frames:
+                silent[start:end] = True
+        return silent
+
+    def get_mel_chunks(self, audio):
+        """Mel window of every video frame.
+
+        Args:
+            audio (str | np.ndarray): Path of an audio file, or a float waveform sampled at 16 kHz.
 
-        mel_chunks = []
-        new_frames = []
-        gen = None
+        Returns:
+            np.ndarray: ``(frames, num_mels, mel_step_size)`` windows.
+        """
+        return self.get_mel_windows(melspectrogram(load_audio(audio, 16000)))
+
+    def get_mel_windows(self, mel):
+        """Cut the ``mel_step_size`` window of every video frame out of a mel spectrogram.
+
+        The last window ends with the spectrogram, clips shorter than one window
+        are padded with silence.
+        """
+        if mel.shape[1] < self.mel_step_size:
+            mel = np.pad(mel, ((0, 0), (self.mel_step_size - mel.shape[1], 0)), constant_values=-hp.max_abs_value)
+        last = mel.shape[1] - self.mel_step_size
         mel_idx_multiplier = 80./self.fps
-        i = 0
-        while 1:
-            start_idx = int(i * mel_idx_multiplier)
-            if start_idx + self.mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - self.mel_step_size:])
-                break
-            mel_chunks.append(
-                mel[:, start_idx: start_idx + self.mel_step_size])
-            i += 1
+        starts = (np.arange(int(last / mel_idx_multiplier) + 2) * mel_idx_multiplier).astype(int)
+        starts = np.append(starts[starts <= last], last)
+        windows = np.lib.stride_tricks.sliding_window_view(mel, self.mel_step_size, axis=1)
+        return np.ascontiguousarray(windows[:, starts].transpose(1, 0, 2), dtype=np.float32)
+
+    @contextmanager
+    def audio_file(self, audio):
+        """Path of the audio, written to a temporary WAV file when it is in memory."""
+        if isinstance(audio, (str, os.PathLike)):
+            yield str(audio)
+            return
+        temp_path = Path(f'wav2lip/temp/{uuid.uuid4()}.wav')
+        temp_path.parent.mkdir(parents=True, exist_ok=True)
+        save_pcm16_wav(audio, temp_path, 16000)
+        try:
+            yield str(temp_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def blend_batch(self, pred, frames, coords, enhance=False, active=None):
+        """Paste the predicted faces of a batch back into their frames.
+
+        ``active`` lists the frames ``pred`` was generated for; the other frames
+        are silent and returned unchanged.
+        """
+        if active is None:
+            active = np.arange(len(frames))
+        results = list(frames)
+        if len(active):
+            pred = pred.transpose(0, 2, 3, 1) * 255.
+            blended = blend_batch(self.blend_executor, self.blend_mode, pred,
+                                  [frames[i] for i in active], [coords[i] for i in active])
+            if enhance and self.enhancer:
+                blended = self.enhance_frames(blended, [coords[i] for i in active])
+            for i, frame in zip(active, blended):
+                results[i] = frame
+        return results
 
+    def enhance_frames(self, frames, coords):
+        """Enhance the generated region of the blended frames with one batched enhancer call.
+
+        In ``mouth`` mode only the lower half of every face box is upscaled,
+        scaled back to its size and feathered into the frame.
+        """
+        if self.enhance_region == "frame":
+            with self.lock:
+                return self.enhancer.enhance_batch(frames, outscale=1)
+
+        regions = [(y1 + (y2 - y1) // 2, y2, x1, x2) for y1, y2, x1, x2 in coords]
+        crops = [frame[y1:y2, x1:x2] for frame, (y1, y2, x1, x2) in zip(frames, regions)]
+        with self.lock:
+            enhanced = self.enhancer.enhance_batch(crops, outscale=1)
+        for frame, crop, (y1, y2, x1, x2) in zip(frames, enhanced, regions):
+            alpha = feather_mask(y2 - y1, x2 - x1)
+            region = frame[y1:y2, x1:x2].astype(np.float32)
+            region += alpha * (crop.astype(np.float32) - region)
+            frame[y1:y2, x1:x2] = np.rint(region)
+        return frames
+
+    def generate_frames(self, mel_chunks, reversed=False, starting_frame=0, enhance=False, stats=None):
+        """Run lipsync over the mel chunks and yield the blended frames of every batch.
+
+        The work runs as a pipeline: a producer thread prepares the model inputs
+        with ``datagen`` and submits them to the shared ``BatchScheduler``, which
+        merges them with the batches of concurrent requests, and this generator
+        blends the finished batches in order while the following ones are still
+        inferring. The instance is shared by concurrent requests, so the stage
+        timings and the silent frame count are kept in the request's ``stats``.
+
+        Args:
+            stats (PipelineStats): Stage timings of the whole request, with at least
+                the ``datagen``, ``infer``, ``blend`` and ``encode`` stages.
+        """
         if not self.static:
-            # if wav_duration > (self.duration):
-            full_frames, face_det_results = self.get_full_frames_and_face_det_results(reverse=reversed, double=True)
-            # else:
-            #     full_frames, face_det_results = self.get_full_frames_and_face_det_results(reverse=reversed)
+            frame_order = self.get_frame_order(reverse=reversed, double=True)
         else:
-            full_frames, face_det_results = self.get_full_frames_and_face_det_results()
-
-        gen = self.datagen(full_frames.copy(), mel_chunks, face_det_results, start_index=starting_frame)
-        new_frames = full_frames.copy()[:len(mel_chunks)]
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
-        frames_generated = 0
-        # count = 0
-        # temp_path = f'wav2lip/temp/{file_id}'
-        # temp_path2 = f'wav2lip/temp_2/{file_id}'
-        # os.mkdir(temp_path)
-        # os.mkdir(temp_path2)
+            frame_order = self.get_frame_order()
+
+        silent = self.get_silent_chunks(mel_chunks)
+        gen = self.datagen(mel_chunks, frame_order, start_index=starting_frame, silent=silent)
+        total_batches = int(np.ceil(float(len(mel_chunks))/self.batch_size))
+
+        if stats is None:
+            stats = PipelineStats(["datagen", "infer", "blend", "encode"])
+        stats.silent_frames = int(silent.sum())
+        completed = queue.Queue()
+        # Bounds the batches that are prepared or inferred but not blended yet
+        in_flight = threading.Semaphore(self.infer_requests + 1)
+        stop = threading.Event()
+        # Identifies this request's micro-batches in the shared scheduler
+        client = object()
+
+        def on_infer_done(future, index, frames, coords, active):
+            stats.exit("infer")
+            if future.cancelled():
+                return
+            error = future.exception()
+            completed.put(error if error else (index, future.result(), frames, coords, active))
+
+        def produce():
+            index = 0
+            try:
+                while not stop.is_set():
+                    if not in_flight.acquire(timeout=0.1):
+                        continue
+                    with stats.busy("datagen"):
+                        batch = next(gen, None)
+                    if batch is None:
+                        break
+                    img_batch, mel_batch, frames, coords, active = batch
+                    if len(active):
+                        stats.enter("infer")
+                        future = self.scheduler.submit(client, mel_batch, img_batch)
+                        future.add_done_callback(
+                            partial(on_infer_done, index=index, frames=frames, coords=coords, active=active))
+                    else:
+                        # Fully silent batch, nothing to infer
+                        completed.put((index, None, frames, coords, active))
+                    index += 1
+                completed.put(index)
+            except Exception as error:
+                completed.put(error)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        pending = {}
+        next_index = 0
+        produced = None
         try:
-            for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen,
-                                                                            total=int(np.ceil(float(len(mel_chunks))/self.batch_size)))):
-                if i == 0:
-                    img_batch = torch.FloatTensor(
-                        np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-                    mel_batch = torch.FloatTensor(
-                        np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-
-                    frame_h, frame_w = new_frames[0].shape[:-1]
-                    out = cv2.VideoWriter('wav2lip/temp/result.avi',
-                                        cv2.VideoWriter_fourcc(*'DIVX'), self.fps, (frame_w, frame_h))
-                    pred_ov = self.compiled_wav2lip_model(
-                        {"audio_sequences": mel_batch.numpy(), "face_sequences": img_batch.numpy()})[0]
-                else:
-                    img_batch = np.transpose(img_batch, (0, 3, 1, 2))
-                    mel_batch = np.transpose(mel_batch, (0, 3, 1, 2))
-                    pred_ov = self.compiled_wav2lip_model(
-                        {"audio_sequences": mel_batch, "face_sequences": img_batch})[0]
-                # pred_ov = compiled_wav2lip_model({"audio_sequences": mel_batch, "face_sequences": img_batch})[0]
-                pred_ov = pred_ov.transpose(0, 2, 3, 1) * 255.
-
-                with ThreadPoolExecutor(max_workers=min(os.cpu_count(), 8)) as executor:
-                    futures = [executor.submit(process_frame, i, p, f, c, self.enhancer, enhance) for i, (p, f, c) in enumerate(zip(pred_ov, frames, coords))]
-                    results = [None] * len(futures)
-                    for future in futures:
-                        index, processed_frame = future.result()
-                        results[index] = processed_frame
-
-                for f in results:
-                    frames_generated += 1
-                    out.write(f)
-
-            if out:
-                out.release()
-
-            combine_audio_with_generated_video(audio_path, output_path)
-
-            return file_id, frames_generated
-        
+            with tqdm(total=total_batches) as progress:
+                while produced is None or next_index < produced:
+                    item = completed.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    if isinstance(item, int):
+                        produced = item
+                        continue
+                    index, pred, frames, coords, active = item
+                    pending[index] = (pred, frames, coords, active)
+                    # Batches may finish out of order, blend them in submission order
+                    while next_index in pending:
+                        pred, frames, coords, active = pending.pop(next_index)
+                        with stats.busy("blend"):
+                            results = self.blend_batch(pred, frames, coords, enhance, active)
+                        next_index += 1
+                        in_flight.release()
+                        progress.update(1)
+                        with stats.busy("encode"):
+                            yield results
         finally:
-            # Ensure resources are properly cleaned up
-            if out:
-                out.release()
-            # Clear memory
-            if 'pred_ov' in locals():
-                del pred_ov
-            if 'gen' in locals():
-                del gen
-            if 'mel_chunks' in locals():
-                del mel_chunks
-            if 'img_batch' in locals():
-                del img_batch
-            if 'mel_batch' in locals():
-                del mel_batch
-
-    def datagen(self, frames, mels, face_det_results, start_index=0):
-        img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-        num_frames = len(frames)
-        
-        for i, m in enumerate(mels):
-            # Start from the specified index, wrapping around the frame list if necessary
-            idx = (start_index + i) % num_frames if not self.static else 0
-            frame_to_save = frames[idx].copy()
-            face, coords = face_det_results[idx].copy()
-            face = cv2.resize(face, (self.img_size, self.img_size))
-
-            img_batch.append(face)
-            mel_batch.append(m)
-            frame_batch.append(frame_to_save)
-            coords_batch.append(coords)
-
-            if len(img_batch) >= self.wav2lip_batch_size:
-                img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-                img_masked = img_batch.copy()
-                img_masked[:, self.img_size//2:] = 0
-
-                img_batch = np.concatenate(
-                    (img_masked, img_batch), axis=3) / 255.
-                mel_batch = np.reshape(
-                    mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-                yield img_batch, mel_batch, frame_batch, coords_batch
-                img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-        if len(img_batch) > 0:
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, self.img_size//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(
-                mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-
-            yield img_batch, mel_batch, frame_batch, coords_batch
+            stop.set()
+            producer.join()
+            self.scheduler.cancel(client)
+            logger.info(f"Wav2lip stage occupancy: {stats.occupancy()}, "
+                        f"silent frames skipped: {stats.silent_frames}/{len(mel_chunks)}")
+
+    def inference(self, audio, reversed=False, starting_frame=0, enhance=False):
+        """Lipsync the audio to an MP4 in ``wav2lip/results``.
+
+        Returns:
+            tuple: The file id, the number of frames and the ``PipelineStats.summary()``
+            of the request.
+        """
+        file_id = str(uuid.uuid4())
+        output_path = Path(f'wav2lip/results/{file_id}.mp4')
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+
+        stats = PipelineStats(INFERENCE_STAGES)
+        with stats.busy("mel"):
+            mel_chunks = self.get_mel_chunks(audio)
+
+        # ffmpeg muxes the audio from a file
+        with self.audio_file(audio) as audio_path:
+            encoder = None
+            frames_generated = 0
+
+            def write(frame):
+                nonlocal encoder, frames_generated
+                if encoder is None:
+                    frame_h, frame_w = frame.shape[:-1]
+                    encoder = create_video_encoder(self.video_encoder, str(output_path), audio_path, self.fps,
+                                                   (frame_w, frame_h), preset=self.encoder_preset)
+                encoder.write(frame)
+                frames_generated += 1
+
+            # Whole frames go through the enhancer's video pipeline, which runs the
+            # lipsync, the batched upscaling and the encoder in separate threads
+            enhance_video = enhance and self.enhancer is not None and self.enhance_region == "frame"
+            try:
+                frames = (f for results in self.generate_frames(mel_chunks, reversed=reversed, starting_frame=starting_frame,
+                                                                enhance=enhance and not enhance_video, stats=stats)
+                          for f in results)
+                if enhance_video:
+                    self.enhancer.enhance_video(frames, write=write, outscale=1, lock=self.lock)
+                else:
+                    for f in frames:
+                        write(f)
+
+                if encoder:
+                    with stats.busy("mux"):
+                        encoder.close()
+                    encoder = None
+
+                self.record_metrics("inference", stats, frames_generated)
+                return file_id, frames_generated, stats.summary()
+
+            finally:
+                # Ensure resources are properly cleaned up
+                if encoder:
+                    encoder.kill()
+
+    def inference_stream(self, audio, reversed=False, starting_frame=0, enhance=False):
+        """Lipsync the audio and yield a fragmented MP4 stream.
+
+        The frames of every batch are encoded as soon as they are blended, so the
+        client receives the first fragments after one batch instead of after the
+        whole clip.
+        """
+        stats = PipelineStats(INFERENCE_STAGES)
+        with stats.busy("mel"):
+            mel_chunks = self.get_mel_chunks(audio)
+
+        # ffmpeg muxes the audio from a file
+        with self.audio_file(audio) as audio_path:
+            encoder = None
+            frames_generated = 0
+            try:
+                for results in self.generate_frames(mel_chunks, reversed=reversed, starting_frame=starting_frame,
+                                                    enhance=enhance, stats=stats):
+                    if encoder is None:
+                        frame_h, frame_w = results[0].shape[:-1]
+                        # a keyframe, and so a fragment, every second whatever the calibrated batch size
+                        encoder = FragmentedMP4Stream(audio_path, self.fps, (frame_w, frame_h), gop=max(1, round(self.fps)))
+                    for f in results:
+                        encoder.write(f)
+                    frames_generated += len(results)
+                    yield from encoder.read()
+
+                if encoder:
+                    with stats.busy("mux"):
+                        tail = list(encoder.close())
+                    yield from tail
+                self.record_metrics("inference_stream", stats, frames_generated)
+            finally:
+                if encoder:
+                    encoder.kill()
+
+    def record_metrics(self, kind, stats, frames_generated):
+        METRICS.record(kind, stats.busy_seconds(), frames_generated, stats.elapsed())
+
+    def datagen(self, mels, frame_order, start_index=0, silent=None):
+        """Yield model inputs in NCHW layout with the frames and face boxes of every batch.
+
+        The face inputs are gathered from the precomputed ``self.face_tensor`` and
+        the frames are read-only views of ``self.frame_store``; the blend allocates
+        the output frames. Model inputs only hold the ``active`` frames of the
+        batch, the frames ``silent`` marks keep the skin frame.
+        """
+        num_frames = len(frame_order)
+
+        for batch_start in range(0, len(mels), self.wav2lip_batch_size):
+            batch_mels = mels[batch_start:batch_start + self.wav2lip_batch_size]
+            # Start from the specified index, wrapping around the frame order if necessary
+            positions = (start_index + batch_start + np.arange(len(batch_mels))) % num_frames
+            indices = frame_order[positions]
+            if silent is not None:
+                active = np.flatnonzero(~silent[batch_start:batch_start + len(batch_mels)])
+            else:
+                active = np.arange(len(batch_mels))
+
+            img_batch = self.face_tensor[indices[active]]
+            mel_batch = np.asarray([batch_mels[i] for i in active], dtype=np.float32).reshape(
+                len(active), 1, *np.shape(batch_mels[0]))
+            frame_batch = [self.frame_store[idx] for idx in indices]
+            coords_batch = [tuple(box) for box in self.face_boxes[indices]]
+
+            yield img_batch, mel_batch, frame_batch, coords_batch, active
 
 if __name__ == "__main__":
     init_time = time.time()
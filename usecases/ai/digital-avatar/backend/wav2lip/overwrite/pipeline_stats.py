@@ -0,0 +1,74 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PipelineStats:
+    """Track how long every stage of a pipeline is busy.
+
+    A stage counts as busy while at least one of its work items is in progress,
+    so overlapping items (e.g. several in-flight infer requests) are not counted
+    twice. The occupancy of a stage is its busy time divided by the wall time
+    of the pipeline; the stage closest to 1.0 is the bottleneck.
+
+    Args:
+        stages (list[str]): Names of the pipeline stages.
+    """
+
+    def __init__(self, stages):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.active = {stage: 0 for stage in stages}
+        self.since = {stage: 0.0 for stage in stages}
+        self.busy_time = {stage: 0.0 for stage in stages}
+        # Frames of the request shown without running the model
+        self.silent_frames = 0
+
+    def enter(self, stage):
+        with self.lock:
+            if self.active[stage] == 0:
+                self.since[stage] = time.perf_counter()
+            self.active[stage] += 1
+
+    def exit(self, stage):
+        with self.lock:
+            self.active[stage] -= 1
+            if self.active[stage] == 0:
+                self.busy_time[stage] += time.perf_counter() - self.since[stage]
+
+    @contextmanager
+    def busy(self, stage):
+        self.enter(stage)
+        try:
+            yield
+        finally:
+            self.exit(stage)
+
+    def busy_seconds(self):
+        """Seconds every stage has been busy so far."""
+        with self.lock:
+            now = time.perf_counter()
+            busy = {}
+            for stage, busy_time in self.busy_time.items():
+                if self.active[stage] > 0:
+                    busy_time += now - self.since[stage]
+                busy[stage] = busy_time
+            return busy
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def occupancy(self):
+        elapsed = max(self.elapsed(), 1e-9)
+        return {stage: round(busy_time / elapsed, 3) for stage, busy_time in self.busy_seconds().items()}
+
+    def summary(self):
+        """Occupancy, busy seconds and silent frames of the request, for its response."""
+        return {
+            "stage_occupancy": self.occupancy(),
+            "stage_seconds": {stage: round(seconds, 4) for stage, seconds in self.busy_seconds().items()},
+            "silent_frames": self.silent_frames,
+        }
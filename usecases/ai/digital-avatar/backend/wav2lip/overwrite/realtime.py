@@ -0,0 +1,112 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import cv2
+import numpy as np
+
+from .audio import MelSpectrogramStream, pcm16_to_float
+from .hparams import hparams as hp
+
+
+class IncrementalMel:
+    """Mel spectrogram of an audio stream, buffered for cutting frame windows.
+
+    The frames come from a ``MelSpectrogramStream`` as soon as their STFT window
+    is complete and match ``melspectrogram`` over the whole clip. Frames before
+    the next window a caller needs are dropped with ``discard_before``.
+    """
+
+    def __init__(self):
+        self.stream = MelSpectrogramStream()
+        self.mel = np.zeros((hp.num_mels, 0), dtype=np.float32)
+        # Absolute index of the first buffered mel frame
+        self.mel_offset = 0
+
+    @property
+    def mel_end(self):
+        """Absolute index one past the last finished mel frame."""
+        return self.mel_offset + self.mel.shape[1]
+
+    def append(self, samples):
+        self.mel = np.concatenate((self.mel, self.stream.append(samples)), axis=1)
+
+    def finish(self):
+        """Mark the end of the stream; the frames of the zero-padded tail become available."""
+        self.mel = np.concatenate((self.mel, self.stream.finish()), axis=1)
+
+    def window(self, start, size):
+        return self.mel[:, start - self.mel_offset:start - self.mel_offset + size]
+
+    def discard_before(self, index):
+        if index > self.mel_offset:
+            self.mel = self.mel[:, index - self.mel_offset:]
+            self.mel_offset = index
+
+
+class RealtimeLipsync:
+    """Lipsync session fed with PCM16 audio chunks that returns blended frames as they become ready.
+
+    A frame is generated as soon as its mel window is complete, so the output
+    trails the audio by one window (0.2 s) plus the time of one small batch.
+    The batches share model calls with concurrent requests through the
+    ``BatchScheduler`` of ``wav2lip``.
+
+    Args:
+        wav2lip (OVWav2Lip): Initialized lipsync model and avatar skin.
+        batch_size (int): Maximum frames per model call. Small batches keep the latency low.
+        reversed (bool): Play the skin backwards.
+        starting_frame (int): Skin position of the first frame.
+    """
+
+    def __init__(self, wav2lip, batch_size=4, reversed=False, starting_frame=0):
+        self.wav2lip = wav2lip
+        self.batch_size = min(batch_size, wav2lip.wav2lip_batch_size)
+        self.starting_frame = starting_frame
+        self.frame_order = wav2lip.get_frame_order(reverse=reversed, double=not wav2lip.static)
+        self.mel_idx_multiplier = 80. / wav2lip.fps
+        self.mel = IncrementalMel()
+        self.frames_generated = 0
+
+    def push(self, pcm):
+        """Add little-endian PCM16 mono 16 kHz audio and return the frames that became ready."""
+        self.mel.append(pcm16_to_float(pcm))
+        return self._generate(self._ready_chunks())
+
+    def finish(self):
+        """End the audio stream and return the remaining frames."""
+        self.mel.finish()
+        chunks = self._ready_chunks()
+        # Like get_mel_chunks, the clip ends with the last full mel window
+        if self.mel.mel_end >= self.wav2lip.mel_step_size:
+            chunks.append(self.mel.window(self.mel.mel_end - self.wav2lip.mel_step_size, self.wav2lip.mel_step_size))
+        return self._generate(chunks)
+
+    def _ready_chunks(self):
+        chunks = []
+        frame = self.frames_generated
+        while True:
+            start = int((frame + len(chunks)) * self.mel_idx_multiplier)
+            if start + self.wav2lip.mel_step_size > self.mel.mel_end:
+                break
+            chunks.append(self.mel.window(start, self.wav2lip.mel_step_size))
+        next_start = int((frame + len(chunks)) * self.mel_idx_multiplier)
+        self.mel.discard_before(min(next_start, self.mel.mel_end - self.wav2lip.mel_step_size))
+        return chunks
+
+    def _generate(self, chunks):
+        frames = []
+        for i in range(0, len(chunks), self.batch_size):
+            batch = chunks[i:i + self.batch_size]
+            gen = self.wav2lip.datagen(batch, self.frame_order, start_index=self.starting_frame + self.frames_generated)
+            img_batch, mel_batch, frame_batch, coords_batch, _ = next(gen)
+            pred = self.wav2lip.scheduler.submit(self, mel_batch, img_batch).result()
+            frames += self.wav2lip.blend_batch(pred, frame_batch, coords_batch)
+            self.frames_generated += len(batch)
+        return frames
+
+
+def encode_jpeg(frame, quality=80):
+    success, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        raise RuntimeError("Failed to encode frame as JPEG")
+    return buffer.tobytes()
@@ -0,0 +1,110 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger('uvicorn.error')
+
+
+class SkinCache:
+    """Per-skin preprocessing results persisted next to the avatar skin.
+
+    Entries are keyed by a hash of the skin file content and of the settings
+    that affect the preprocessing, so a re-uploaded skin or changed settings
+    never reuse stale results. Model files among the settings are best passed
+    through ``model_file_id`` so a replaced checkpoint invalidates them too.
+
+    Args:
+        skin_path (str): Path to the avatar skin video or image.
+        settings (dict): JSON serializable preprocessing settings.
+    """
+
+    def __init__(self, skin_path, settings):
+        self.directory = os.path.dirname(os.path.abspath(skin_path))
+        self.name = os.path.splitext(os.path.basename(skin_path))[0]
+        self.key = self.compute_key(skin_path, settings)
+
+    @staticmethod
+    def compute_key(skin_path, settings, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        with open(skin_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        return digest.hexdigest()[:16]
+
+    @staticmethod
+    def model_file_id(model_path):
+        """Identify a model file, and the weights next to an IR, by path, size and modification time."""
+        paths = [model_path]
+        if model_path.endswith('.xml'):
+            paths.append(os.path.splitext(model_path)[0] + '.bin')
+        file_ids = []
+        for path in paths:
+            stat = os.stat(path) if os.path.exists(path) else None
+            file_ids.append([os.path.abspath(path), stat.st_size if stat else None, stat.st_mtime_ns if stat else None])
+        return file_ids
+
+    def path(self, kind, ext):
+        return os.path.join(self.directory, f"{self.name}.{kind}.{self.key}{ext}")
+
+    def remove_stale(self, kind, ext):
+        current = self.path(kind, ext)
+        for path in glob.glob(os.path.join(self.directory, f"{glob.escape(self.name)}.{kind}.*{ext}")):
+            if path != current:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def load_face_detections(self):
+        """Return the cached ``(boxes, faces)`` arrays or None on a cache miss."""
+        path = self.path('face_det', '.npz')
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return data['boxes'], data['faces']
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning(f"Ignoring unreadable face detection cache {path}: {error}")
+            return None
+
+    def save_face_detections(self, boxes, faces):
+        path = self.path('face_det', '.npz')
+        temp_path = path + '.tmp.npz'
+        try:
+            np.savez(temp_path, boxes=np.asarray(boxes, dtype=np.int32), faces=np.asarray(faces, dtype=np.uint8))
+            os.replace(temp_path, path)
+        except OSError as error:
+            logger.warning(f"Failed to write face detection cache {path}: {error}")
+            return
+        self.remove_stale('face_det', '.npz')
+
+    def load_face_tensor(self):
+        """Return the cached face tensor memory-mapped read-only, or None on a cache miss."""
+        path = self.path('face_tensor', '.npy')
+        if not os.path.isfile(path):
+            return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (OSError, ValueError) as error:
+            logger.warning(f"Ignoring unreadable face tensor cache {path}: {error}")
+            return None
+
+    def save_face_tensor(self, tensor):
+        path = self.path('face_tensor', '.npy')
+        temp_path = path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                np.save(f, tensor)
+            os.replace(temp_path, path)
+        except OSError as error:
+            logger.warning(f"Failed to write face tensor cache {path}: {error}")
+            return
+        self.remove_stale('face_tensor', '.npy')
@@ -0,0 +1,185 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import uuid
+
+import cv2
+
+from .inference_ov import combine_audio_with_generated_video
+
+
+VIDEO_ENCODERS = ["ffmpeg", "opencv"]
+# Denoise and sharpen pass the generated videos always went through
+DEFAULT_VIDEO_FILTER = "hqdn3d,unsharp=5:5:0.5"
+
+
+def ffmpeg_input_args(audio_path, fps, frame_size):
+    """ffmpeg arguments reading raw BGR frames from stdin and the audio track from a file."""
+    width, height = frame_size
+    return [
+        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0',
+        '-i', audio_path,
+        '-map', '0:v:0', '-map', '1:a:0',
+    ]
+
+
+class FFmpegVideoEncoder:
+    """Encode raw BGR frames and mux the audio into an MP4 file in a single ffmpeg pass.
+
+    Args:
+        output_path (str): Path of the MP4 file to write.
+        audio_path (str): Path of the audio file muxed with the video.
+        fps (float): Frame rate of the generated video.
+        frame_size (tuple): Frame size as ``(width, height)``.
+        preset (str): libx264 preset, trading encoding speed for file size.
+        crf (int): libx264 constant rate factor.
+        video_filter (str): ffmpeg filter graph applied to the frames, or None.
+    """
+
+    def __init__(self, output_path, audio_path, fps, frame_size, preset="veryfast", crf=23,
+                 video_filter=DEFAULT_VIDEO_FILTER):
+        command = ['ffmpeg', '-y', '-loglevel', 'error'] + ffmpeg_input_args(audio_path, fps, frame_size)
+        if video_filter:
+            command += ['-vf', video_filter]
+        command += [
+            '-c:v', 'libx264', '-preset', preset, '-crf', str(crf), '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-movflags', '+faststart',
+            str(output_path)
+        ]
+        # A pipe nobody reads until close() could fill up and block ffmpeg, and write() with it
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=self.stderr)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        self.process.communicate()
+        self.stderr.seek(0)
+        stderr = self.stderr.read()
+        self.stderr.close()
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode}: {stderr.decode(errors='replace').strip()}")
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.stderr.close()
+
+
+class OpenCVVideoEncoder:
+    """Write the frames to a temporary AVI with OpenCV and mux the audio with a second ffmpeg pass.
+
+    Kept as a fallback for environments where piping into ffmpeg is not possible.
+    The temporary file is unique per encoder so concurrent requests do not collide.
+    """
+
+    def __init__(self, output_path, audio_path, fps, frame_size, temp_dir="wav2lip/temp"):
+        os.makedirs(temp_dir, exist_ok=True)
+        self.output_path = output_path
+        self.audio_path = audio_path
+        self.temp_path = os.path.join(temp_dir, f"{uuid.uuid4()}.avi")
+        self.writer = cv2.VideoWriter(self.temp_path, cv2.VideoWriter_fourcc(*'DIVX'), fps, frame_size)
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.release()
+        try:
+            combine_audio_with_generated_video(self.audio_path, self.output_path, self.temp_path)
+        finally:
+            self.kill()
+
+    def kill(self):
+        self.writer.release()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def create_video_encoder(backend, output_path, audio_path, fps, frame_size, preset="veryfast"):
+    if backend == "ffmpeg":
+        return FFmpegVideoEncoder(output_path, audio_path, fps, frame_size, preset=preset)
+    if backend == "opencv":
+        return OpenCVVideoEncoder(output_path, audio_path, fps, frame_size)
+    raise ValueError(f"Unsupported video encoder: {backend}. Expected one of {VIDEO_ENCODERS}")
+
+
+class FragmentedMP4Stream:
+    """Encode raw BGR frames into a fragmented MP4 stream with ffmpeg.
+
+    Frames are piped to ffmpeg's stdin and the muxed fMP4 bytes (video + the
+    audio track from ``audio_path``) are collected from its stdout by a
+    background thread, so the caller can forward them to a client while later
+    frames are still being generated.
+
+    Args:
+        audio_path (str): Path of the audio file muxed with the video.
+        fps (float): Frame rate of the generated video.
+        frame_size (tuple): Frame size as ``(width, height)``.
+        gop (int): Keyframe interval in frames. A new fragment starts at every keyframe.
+        fragment_duration (float): Maximum fragment duration in seconds.
+        chunk_size (int): Size of the chunks read from ffmpeg's stdout.
+    """
+
+    def __init__(self, audio_path, fps, frame_size, gop=25, fragment_duration=1.0, chunk_size=64 * 1024):
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue()
+        command = ['ffmpeg', '-y', '-loglevel', 'error'] + ffmpeg_input_args(audio_path, fps, frame_size) + [
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-pix_fmt', 'yuv420p',
+            '-g', str(gop), '-c:a', 'aac', '-shortest',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-frag_duration', str(int(fragment_duration * 1000000)),
+            '-flush_packets', '1',
+            '-f', 'mp4', 'pipe:1'
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.reader = threading.Thread(target=self._read_stdout, daemon=True)
+        self.reader.start()
+
+    def _read_stdout(self):
+        while True:
+            chunk = self.process.stdout.read1(self.chunk_size)
+            if not chunk:
+                break
+            self.chunks.put(chunk)
+        self.chunks.put(None)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def read(self):
+        """Yield the encoded bytes that are available without blocking."""
+        while True:
+            try:
+                chunk = self.chunks.get_nowait()
+            except queue.Empty:
+                return
+            if chunk is None:
+                self.chunks.put(None)
+                return
+            yield chunk
+
+    def close(self):
+        """Finish the stream and yield the remaining encoded bytes."""
+        if not self.process.stdin.closed:
+            self.process.stdin.close()
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        self.reader.join()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode}")
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()